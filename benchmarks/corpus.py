@@ -0,0 +1,174 @@
+import os
+import io
+import json
+import hashlib
+import datetime as dt
+import numpy as np
+import piexif
+from typing import Dict, List, NamedTuple, Any
+from PIL import Image
+from lib.scene_tokens import SceneTokenizer
+
+# a deterministic photo library: the same seed and spec always give byte identical files, so runs on
+# different days (or branches) time the same work. corpus.json records the spec the directory was made from
+CORPUS_FILENAME = 'corpus.json'
+CORPUS_VERSION = 1
+
+
+class CorpusSpec(NamedTuple):
+    seed: int
+    files: int
+    megapixels: List[float]
+    png_every: int = 5
+    no_exif_every: int = 4
+    truncated_every: int = 10
+    cities: int = 20000
+
+
+class CorpusFile(NamedTuple):
+    filename: str
+    megapixels: float
+    format: str
+    orientation: int
+    latitude: float
+    longitude: float
+    has_exif: bool
+    truncated: bool
+
+
+def to_rational(value: float, precision: int = 10000) -> tuple:
+    return (int(round(value * precision)), precision)
+
+
+def to_dms(value: float) -> tuple:
+    value = abs(value)
+    degrees = int(value)
+    minutes = int((value - degrees) * 60)
+    seconds = (value - degrees - minutes / 60) * 3600
+    return ((degrees, 1), (minutes, 1), to_rational(seconds, 100))
+
+
+def exif_bytes(orientation: int, created_date: dt.datetime, latitude: float, longitude: float) -> bytes:
+    return piexif.dump({
+        '0th': {piexif.ImageIFD.Orientation: orientation},
+        'Exif': {piexif.ExifIFD.DateTimeOriginal: created_date.strftime('%Y:%m:%d %H:%M:%S').encode('ascii')},
+        'GPS': {piexif.GPSIFD.GPSLatitudeRef: b'N' if latitude >= 0 else b'S',
+                piexif.GPSIFD.GPSLatitude: to_dms(latitude),
+                piexif.GPSIFD.GPSLongitudeRef: b'E' if longitude >= 0 else b'W',
+                piexif.GPSIFD.GPSLongitude: to_dms(longitude)},
+    })
+
+
+def synthetic_pixels(rng: np.random.RandomState, megapixels: float) -> Image.Image:
+    # smooth low frequency content (like a photo, unlike noise) that jpeg compresses to realistic sizes
+    width = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    height = int(round(width * 3 / 4))
+    small = Image.fromarray(rng.randint(0, 256, size=(12, 16, 3), dtype=np.uint8))
+    return small.resize((width, height), Image.BICUBIC)
+
+
+def cities_rows(spec: CorpusSpec) -> np.ndarray:
+    rng = np.random.RandomState(spec.seed + 1)
+    latitudes = np.degrees(np.arcsin(rng.uniform(-1, 1, spec.cities)))
+    longitudes = rng.uniform(-180, 180, spec.cities)
+    # populations spread over every tier LatLongResolver builds a tree for
+    populations = (10 ** rng.uniform(3.5, 7, spec.cities)).astype(np.int64)
+    return np.rec.fromarrays([latitudes, longitudes, populations], names='latitude,longitude,population')
+
+
+def write_cities_csv(spec: CorpusSpec, filename: str) -> None:
+    # same columns as LatLongResolver.build_cities_dataset writes
+    cities = cities_rows(spec)
+    with open(filename, 'w') as f:
+        f.write('asciiname,latitude,longitude,country code,population,ISO,Country\n')
+        for i, c in enumerate(cities):
+            country = 'C{:02d}'.format(i % 97)
+            f.write('City{},{:.5f},{:.5f},{},{},{},Country{}\n'.format(i, c.latitude, c.longitude, country,
+                                                                    c.population, country, i % 97))
+
+
+def write_stub_labels(models_directory: str, seed: int) -> None:
+    # the label files SceneTokenizer reads, so a stub model never has to download anything
+    rng = np.random.RandomState(seed + 2)
+    with open(os.path.join(models_directory, 'categories_places365.txt'), 'w') as f:
+        for i in range(365):
+            f.write('/s/scene_{} {}\n'.format(i, i))
+    with open(os.path.join(models_directory, 'IO_places365.txt'), 'w') as f:
+        for i in range(365):
+            f.write('/s/scene_{} {}\n'.format(i, 1 + i % 2))
+    attributes = SceneTokenizer.attributes + ['attribute_{}'.format(i) for i in range(102 - len(SceneTokenizer.attributes))]
+    with open(os.path.join(models_directory, 'labels_sunattribute.txt'), 'w') as f:
+        for a in attributes:
+            f.write(a + '\n')
+    np.save(os.path.join(models_directory, 'W_sceneattribute_wideresnet18.npy'), rng.randn(102, 512).astype(np.float32))
+
+
+def corpus_files(spec: CorpusSpec) -> List[CorpusFile]:
+    rng = np.random.RandomState(spec.seed)
+    cities = cities_rows(spec)
+    result = []
+    for i in range(spec.files):
+        megapixels = spec.megapixels[i % len(spec.megapixels)]
+        image_format = 'PNG' if spec.png_every > 0 and i % spec.png_every == spec.png_every - 1 else 'JPEG'
+        # photos are taken near a random city, so every GPS lookup has a real answer
+        city = cities[rng.randint(len(cities))]
+        result.append(CorpusFile('synthetic_{:04d}_{}mp.{}'.format(i, megapixels, 'png' if image_format == 'PNG' else 'jpg'),
+                                 megapixels,
+                                 image_format,
+                                 int(rng.choice([1, 1, 3, 6, 8])),
+                                 float(np.clip(city.latitude + rng.uniform(-0.05, 0.05), -89.9, 89.9)),
+                                 float((city.longitude + rng.uniform(-0.05, 0.05) + 180) % 360 - 180),
+                                 image_format == 'JPEG' and not (spec.no_exif_every > 0 and i % spec.no_exif_every == 0),
+                                 spec.truncated_every > 0 and i % spec.truncated_every == spec.truncated_every - 1))
+    return result
+
+
+def generate_corpus(spec: CorpusSpec, directory: str) -> Dict[str, Any]:
+    # img/ with the photos, models/ with cities.csv and stub labels. reuses the directory when it was
+    # made from the same spec
+    spec_json = {'version': CORPUS_VERSION, 'spec': spec._asdict()}
+    corpus_filename = os.path.join(directory, CORPUS_FILENAME)
+    if os.path.exists(corpus_filename):
+        with open(corpus_filename, 'r') as f:
+            existing = json.load(f)
+        if existing['version'] == CORPUS_VERSION and existing['spec'] == json.loads(json.dumps(spec._asdict())):
+            return existing
+
+    img_directory = os.path.join(directory, 'img')
+    models_directory = os.path.join(directory, 'models')
+    os.makedirs(img_directory, exist_ok=True)
+    os.makedirs(models_directory, exist_ok=True)
+    for f in os.listdir(img_directory):
+        os.remove(os.path.join(img_directory, f))
+
+    files = corpus_files(spec)
+    digest = hashlib.blake2b(digest_size=16)
+    total_bytes = 0
+    base_date = dt.datetime(2015, 1, 1)
+    for i, f in enumerate(files):
+        im = synthetic_pixels(np.random.RandomState(spec.seed * 7919 + i), f.megapixels)
+        buffer = io.BytesIO()
+        if f.format == 'JPEG':
+            options: Dict[str, Any] = {'quality': 90}
+            if f.has_exif:
+                options['exif'] = exif_bytes(f.orientation, base_date + dt.timedelta(days=i * 37, seconds=i * 3607),
+                                             f.latitude, f.longitude)
+            im.save(buffer, format='JPEG', **options)
+        else:
+            im.save(buffer, format='PNG', compress_level=1)
+        data = buffer.getvalue()
+        if f.truncated:
+            data = data[:len(data) * 6 // 10]
+        with open(os.path.join(img_directory, f.filename), 'wb') as out:
+            out.write(data)
+        digest.update(data)
+        total_bytes += len(data)
+
+    write_cities_csv(spec, os.path.join(models_directory, 'cities.csv'))
+    write_stub_labels(models_directory, spec.seed)
+
+    corpus = dict(spec_json, files=len(files), bytes=total_bytes, digest=digest.hexdigest(),
+                  coordinates=[[f.latitude, f.longitude] for f in files if f.has_exif and not f.truncated])
+    with open(corpus_filename, 'w') as f:
+        json.dump(corpus, f)
+    return corpus
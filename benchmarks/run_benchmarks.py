@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import datetime as dt
+import multiprocessing
+import click
+import logging
+import coloredlogs
+from typing import Dict, List, Optional, Any
+from lib.image_decode import DEFAULT_MAX_PIXELS
+from lib.thumbnails import DEFAULT_FORMATS, DEFAULT_SIZES
+from benchmarks.corpus import CorpusSpec, generate_corpus
+from benchmarks.stages import STAGES, run_stage
+
+# python -m benchmarks.run_benchmarks --output results.json [--compare baseline.json]
+# times each stage of generate_photos_gallery on a generated corpus, every stage in its own process
+
+MODEL_FILENAME = 'wideresnet18_places365.pth.tar'
+
+
+def has_places365(models_directory: Optional[str]) -> bool:
+    if models_directory is None or not os.path.exists(os.path.join(models_directory, MODEL_FILENAME)):
+        return False
+    try:
+        import torch  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def run_in_process(name: str, config: Dict[str, Any]) -> Dict[str, Any]:
+    # spawn rather than fork, so nothing (memory, torch threads, open files) is inherited from this process.
+    # not a Pool, end_to_end starts its own pool of workers and pool processes can't have children
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_stage, args=(name, config, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': 'stage process exited with code {}'.format(process.exitcode)}
+    process.join()
+    return result
+
+
+def format_stage(name: str, result: Dict[str, Any]) -> str:
+    if 'skipped' in result or 'error' in result:
+        return '{:<14} {}'.format(name, result.get('skipped', result.get('error')))
+    return '{:<14} {:>10.3f}s {:>12.1f} {}/s {:>9.1f} MB'.format(name, result['seconds'], result['items_per_sec'],
+                                                                 result['unit'], result['peak_rss_mb'])
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any], threshold: float) -> List[str]:
+    # prints old and new throughput for every stage both runs have, returns the stages that got slower
+    # by more than threshold percent
+    if baseline.get('model') != results.get('model') or baseline.get('corpus', {}).get('digest') != \
+            results.get('corpus', {}).get('digest'):
+        print('warning: the runs used different models or corpora, the numbers are not comparable')
+
+    regressions = []
+    print('{:<14} {:>14} {:>14} {:>9}'.format('stage', 'baseline/s', 'current/s', 'change'))
+    for name, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(name)
+        if previous is None or 'items_per_sec' not in previous or 'items_per_sec' not in current:
+            continue
+        change = (current['items_per_sec'] / previous['items_per_sec'] - 1) * 100 if previous['items_per_sec'] else 0
+        print('{:<14} {:>14.1f} {:>14.1f} {:>+8.1f}%'.format(name, previous['items_per_sec'],
+                                                             current['items_per_sec'], change))
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+@click.command()
+@click.option('--corpus_dir', default=os.path.join(tempfile.gettempdir(), 'photos-gallery-benchmark'),
+              type=click.Path(), help='Directory for the generated corpus, reused while the spec is unchanged')
+@click.option('--models_dir', default=None, type=click.Path(),
+              help='Directory with the Places365 weights and cities.csv, a stub model and generated cities are '
+                   'used when it is not given or the weights are not there')
+@click.option('--output', default='benchmark.json', type=click.Path(), help='JSON file for the results')
+@click.option('--compare', 'baseline_file', default=None, type=click.Path(exists=True),
+              help='Earlier results to compare against')
+@click.option('--fail_over', default=None, type=float,
+              help='Exit with an error when a stage is slower than the --compare baseline by more than this percent')
+@click.option('--stages', default=','.join(STAGES), help='Comma separated stages to run')
+@click.option('--seed', default=1, help='Corpus seed')
+@click.option('--files', default=40, help='Number of photos in the corpus')
+@click.option('--megapixels', default='0.3,2,8,12,24', help='Comma separated photo sizes, used in turn')
+@click.option('--repeat', default=3, type=click.IntRange(min=1), help='Repetitions per stage, the fastest is kept')
+@click.option('--batch_size', default=16, type=click.IntRange(min=1))
+@click.option('--workers', default=1, type=click.IntRange(min=1), help='--workers for the end_to_end stage')
+@click.option('--csv_rows', default=100000, help='Rows written by the csv and search_index stages')
+@click.option('--gps_points', default=10000, help='Coordinates resolved by the gps stage')
+def main(corpus_dir, models_dir, output, baseline_file, fail_over, stages, seed, files, megapixels, repeat,
+         batch_size, workers, csv_rows, gps_points):
+    coloredlogs.install(level='INFO')
+
+    names = [s.strip() for s in stages.split(',') if len(s.strip()) > 0]
+    unknown = [s for s in names if s not in STAGES]
+    if len(unknown) > 0:
+        raise click.BadParameter('unknown stages {}'.format(', '.join(unknown)), param_hint='--stages')
+
+    spec = CorpusSpec(seed, files, [float(m) for m in megapixels.split(',')])
+    logging.info('generating corpus in {}'.format(corpus_dir))
+    corpus = generate_corpus(spec, corpus_dir)
+
+    stub = not has_places365(models_dir)
+    if stub:
+        logging.info('no Places365 weights, using the stub classifier')
+    work_directory = tempfile.mkdtemp(prefix='photos-gallery-benchmark-')
+    config = {'img_directory': os.path.abspath(os.path.join(corpus_dir, 'img')),
+              'models_directory': os.path.abspath(os.path.join(corpus_dir, 'models') if stub else models_dir),
+              'work_directory': work_directory,
+              'stub': stub,
+              'coordinates': corpus['coordinates'],
+              'repeat': repeat,
+              'batch_size': batch_size,
+              'workers': workers,
+              'csv_rows': csv_rows,
+              'gps_points': gps_points,
+              'max_pixels': DEFAULT_MAX_PIXELS,
+              'thumbnail_sizes': DEFAULT_SIZES,
+              'thumbnail_formats': DEFAULT_FORMATS}
+
+    results: Dict[str, Any] = {
+        'created': dt.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'model': 'stub' if stub else 'places365',
+        'corpus': {k: v for k, v in corpus.items() if k != 'coordinates'},
+        'settings': {k: v for k, v in config.items() if k not in ('coordinates', 'work_directory', 'img_directory',
+                                                                   'models_directory')},
+        'stages': {},
+    }
+    try:
+        for name in names:
+            logging.info('running {}'.format(name))
+            results['stages'][name] = run_in_process(name, config)
+            print(format_stage(name, results['stages'][name]))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    logging.info('results written to {}'.format(output))
+
+    if baseline_file is not None:
+        with open(baseline_file, 'r') as f:
+            regressions = compare(json.load(f), results, fail_over or 0)
+        if fail_over is not None and len(regressions) > 0:
+            raise click.ClickException('slower than the baseline: {}'.format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
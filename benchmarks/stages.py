@@ -0,0 +1,289 @@
+import os
+import sys
+import time
+import shutil
+import resource
+import statistics
+import datetime as dt
+import numpy as np
+from typing import Dict, List, Callable, Any
+from PIL import Image, ImageFile
+from lib.image_decode import REDUCING_GAP, draft_image, rotate_image
+from lib.raw_preview import open_image
+from lib.metadata_csv import write_rows
+from lib.gallery_export import export_year_shards
+from lib.search_index import build_search_index
+from lib.thumbnails import LEGACY_SIZE, PYRAMID_REDUCING_GAP, ThumbnailPyramid, downscale, prepare_pyramid, save_pyramid
+
+# every stage runs in a fresh process (see run_benchmarks.py), so peak RSS is the stage's own.
+# a stage returns how many items it processed per repetition, and the unit they're counted in
+
+
+def peak_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    # ru_maxrss is kilobytes on linux and bytes on macos
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def timed(fn: Callable[[], int], repeat: int, unit: str) -> Dict[str, Any]:
+    times = []
+    items = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = fn()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {'unit': unit,
+            'items': items,
+            'seconds': best,
+            'median_seconds': statistics.median(times),
+            'items_per_sec': items / best if best > 0 else 0.0}
+
+
+def source_files(config: Dict[str, Any]) -> List[str]:
+    return sorted(os.listdir(config['img_directory']))
+
+
+def read_all(config: Dict[str, Any]) -> Dict[str, bytes]:
+    result = {}
+    for f in source_files(config):
+        with open(os.path.join(config['img_directory'], f), 'rb') as image_file:
+            result[f] = image_file.read()
+    return result
+
+
+def decode(data: bytes, max_size: int, max_pixels: int, reducing_gap: float = REDUCING_GAP) -> Image.Image:
+    im, metadata = open_image(data)
+    orientation = metadata.orientation
+    draft_image(im, (max_size, max_size), max_pixels=max_pixels, reducing_gap=reducing_gap)
+    im.load()
+    return rotate_image(im, orientation)
+
+
+def decoded_images(config: Dict[str, Any], max_size: int, reducing_gap: float = REDUCING_GAP) -> List[Image.Image]:
+    images = []
+    for data in read_all(config).values():
+        try:
+            images.append(decode(data, max_size, config['max_pixels'], reducing_gap))
+        except Exception:
+            pass
+    return images
+
+
+def pyramid(config: Dict[str, Any]) -> ThumbnailPyramid:
+    return ThumbnailPyramid(config['thumbnail_sizes'], config['thumbnail_formats'])
+
+
+def make_classifier(config: Dict[str, Any]):
+    if config['stub']:
+        from benchmarks.stub_classifier import StubClassifier
+        return StubClassifier(config['models_directory'])
+    from lib.places_classifier import PlacesClassifier
+    return PlacesClassifier(config['models_directory'])
+
+
+def stage_decode(config: Dict[str, Any]) -> Dict[str, Any]:
+    # read from disk and decode (draft mode, rotated) to the largest thumbnail size
+    max_size = pyramid(config).largest
+
+    def run() -> int:
+        for f in source_files(config):
+            with open(os.path.join(config['img_directory'], f), 'rb') as image_file:
+                data = image_file.read()
+            try:
+                decode(data, max_size, config['max_pixels'], PYRAMID_REDUCING_GAP).close()
+            except Exception:
+                pass
+        return len(source_files(config))
+
+    return timed(run, config['repeat'], 'files')
+
+
+def stage_exif(config: Dict[str, Any]) -> Dict[str, Any]:
+    files = read_all(config)
+
+    def run() -> int:
+        for data in files.values():
+            try:
+                open_image(data)
+            except Exception:
+                pass
+        return len(files)
+
+    return timed(run, config['repeat'], 'files')
+
+
+def stage_gps(config: Dict[str, Any]) -> Dict[str, Any]:
+    from lib.gps_to_location_resolver import LatLongResolver
+
+    start = time.perf_counter()
+    resolver = LatLongResolver(os.path.join(config['models_directory'], 'cities.csv'))
+    setup_seconds = time.perf_counter() - start
+
+    coordinates = np.array(config['coordinates'] or [[0.0, 0.0]], dtype=np.float64)
+    points = np.resize(coordinates, (config['gps_points'], 2))
+    batch_size = config['batch_size']
+
+    def run() -> int:
+        for i in range(0, len(points), batch_size):
+            resolver.nearest_many(points[i:i + batch_size, 0], points[i:i + batch_size, 1])
+        return len(points)
+
+    result = timed(run, config['repeat'], 'points')
+    result['setup_seconds'] = setup_seconds
+    return result
+
+
+def stage_gps_cached(config: Dict[str, Any]) -> Dict[str, Any]:
+    # the gps stage through an empty, unsaved cache of geohash cells: the corpus has few distinct locations
+    from lib.gps_to_location_resolver import LatLongResolver
+    from lib.gps_cache import CachedResolver, GpsCacheSettings
+
+    resolver = LatLongResolver(os.path.join(config['models_directory'], 'cities.csv'))
+    coordinates = np.array(config['coordinates'] or [[0.0, 0.0]], dtype=np.float64)
+    points = np.resize(coordinates, (config['gps_points'], 2))
+    batch_size = config['batch_size']
+    caches: List[CachedResolver] = []
+
+    def run() -> int:
+        caches.append(CachedResolver(resolver, GpsCacheSettings(None)))
+        for i in range(0, len(points), batch_size):
+            caches[-1].nearest_many(points[i:i + batch_size, 0], points[i:i + batch_size, 1])
+        return len(points)
+
+    result = timed(run, config['repeat'], 'points')
+    result['hit_rate'] = caches[-1].hits / max(caches[-1].hits + caches[-1].misses, 1)
+    return result
+
+
+def stage_classify(config: Dict[str, Any]) -> Dict[str, Any]:
+    classifier = make_classifier(config)
+    images = [downscale(im, LEGACY_SIZE) for im in decoded_images(config, LEGACY_SIZE)]
+    batch_size = config['batch_size']
+
+    def run() -> int:
+        for i in range(0, len(images), batch_size):
+            batch = [classifier.preprocess(im) for im in images[i:i + batch_size]]
+            classifier.tokenizer.tokens_batch(*classifier.forward_vectors(batch))
+        return len(images)
+
+    return timed(run, config['repeat'], 'files')
+
+
+def stage_thumbnail(config: Dict[str, Any]) -> Dict[str, Any]:
+    thumbnails = pyramid(config)
+    images = decoded_images(config, thumbnails.largest, PYRAMID_REDUCING_GAP)
+    directory = os.path.join(config['work_directory'], 'thumbnail')
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    prepare_pyramid(directory, thumbnails)
+
+    def run() -> int:
+        for i, im in enumerate(images):
+            save_pyramid(im, directory, 'image_{}.jpg'.format(i), thumbnails, 'JPEG')
+        return len(images)
+
+    result = timed(run, config['repeat'], 'files')
+    result['bytes_written'] = sum(os.path.getsize(os.path.join(root, f))
+                                  for root, _, files in os.walk(directory) for f in files)
+    return result
+
+
+def synthetic_rows(count: int) -> List[tuple]:
+    rng = np.random.RandomState(count)
+    vocabulary = ['token{}'.format(i) for i in range(2000)]
+    start = dt.datetime(2020, 12, 31)
+    rows = []
+    for i in range(count):
+        tokens = ';'.join(vocabulary[t] for t in rng.randint(0, len(vocabulary), 8))
+        rows.append(('photo_{}.jpg'.format(i), '1.333', start - dt.timedelta(minutes=i * 17), tokens))
+    return rows
+
+
+def stage_csv(config: Dict[str, Any]) -> Dict[str, Any]:
+    # photos.csv plus the per year shards, as write_metadata_csv does
+    rows = synthetic_rows(config['csv_rows'])
+    csv_file = os.path.join(config['work_directory'], 'photos.csv')
+    # a new data directory every repetition, unchanged shards are otherwise not rewritten
+    runs: List[str] = []
+
+    def run() -> int:
+        runs.append(os.path.join(config['work_directory'], 'data_{}'.format(len(runs))))
+        write_rows(csv_file, rows)
+        export_year_shards(rows, runs[-1])
+        return len(rows)
+
+    return timed(run, config['repeat'], 'rows')
+
+
+def stage_search_index(config: Dict[str, Any]) -> Dict[str, Any]:
+    from lib.metadata_csv import read_rows
+
+    csv_file = os.path.join(config['work_directory'], 'photos.csv')
+    write_rows(csv_file, synthetic_rows(config['csv_rows']))
+    data_directory = os.path.join(config['work_directory'], 'data')
+
+    def run() -> int:
+        index = build_search_index(read_rows(csv_file), data_directory)
+        return index['total']
+
+    return timed(run, config['repeat'], 'rows')
+
+
+def stage_end_to_end(config: Dict[str, Any]) -> Dict[str, Any]:
+    # generate_photos_gallery.process() on the corpus, from an empty output directory every time
+    import generate_photos_gallery
+
+    if config['stub']:
+        from benchmarks.stub_classifier import StubClassifier
+        generate_photos_gallery.load_places_classifier = StubClassifier
+
+    work_directory = os.path.join(config['work_directory'], 'end_to_end')
+
+    def run() -> int:
+        shutil.rmtree(work_directory, ignore_errors=True)
+        os.makedirs(os.path.join(work_directory, 'thumbnail'))
+        os.chdir(work_directory)
+        generate_photos_gallery.process(config['img_directory'],
+                                        'thumbnail',
+                                        config['models_directory'],
+                                        'photos.csv',
+                                        'photos.db',
+                                        'embeddings',
+                                        'data',
+                                        config['workers'],
+                                        config['batch_size'],
+                                        config['max_pixels'],
+                                        pyramid(config))
+        return len(source_files(config))
+
+    result = timed(run, config['repeat'], 'files')
+    result['peak_children_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+STAGES = {
+    'decode': stage_decode,
+    'exif': stage_exif,
+    'gps': stage_gps,
+    'gps_cached': stage_gps_cached,
+    'classify': stage_classify,
+    'thumbnail': stage_thumbnail,
+    'csv': stage_csv,
+    'search_index': stage_search_index,
+    'end_to_end': stage_end_to_end,
+}
+
+
+def run_stage(name: str, config: Dict[str, Any], connection) -> None:
+    # entry point of the per stage process, sends back the result (or why the stage was skipped)
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    try:
+        result = STAGES[name](config)
+        result['peak_rss_mb'] = peak_rss_mb()
+    except ImportError as ex:
+        result = {'skipped': 'missing dependency: {}'.format(ex)}
+    except Exception as ex:
+        result = {'error': '{}: {}'.format(type(ex).__name__, ex)}
+    connection.send(result)
+    connection.close()
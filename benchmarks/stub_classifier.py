@@ -0,0 +1,34 @@
+import numpy as np
+from typing import List, Tuple, Union
+from PIL import Image
+from lib.scene_tokens import SceneTokenizer
+
+# stands in for PlacesClassifier when the Places365 weights (or torch) aren't there: same interface, numpy only.
+# the preprocess is the same resize to 224x224 and normalize, the CNN is a fixed random projection of the
+# pooled pixels, so timings cover everything around the model but not the model itself
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+class StubClassifier():
+    def __init__(self, models_directory: str, num_threads: int = 0):
+        self.models_directory = models_directory
+        self.tokenizer = SceneTokenizer(models_directory)
+        rng = np.random.RandomState(365)
+        self.W_logits = rng.randn(16 * 16 * 3, 365).astype(np.float32) * 4
+        self.W_features = rng.rand(16 * 16 * 3, 512).astype(np.float32)
+
+    def preprocess(self, img: Image.Image) -> np.ndarray:
+        pixels = np.asarray(img.convert('RGB').resize((224, 224), Image.BILINEAR), dtype=np.float32) / 255
+        return (pixels - MEAN) / STD
+
+    def forward(self, img: Image.Image) -> List[str]:
+        return self.forward_batch([img])[0]
+
+    def forward_batch(self, images: List[Union[Image.Image, np.ndarray]]) -> List[List[str]]:
+        return self.tokenizer.tokens_batch(*self.forward_vectors(images))
+
+    def forward_vectors(self, images: List[Union[Image.Image, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+        batch = np.stack([i if isinstance(i, np.ndarray) else self.preprocess(i) for i in images])
+        pooled = batch.reshape(len(images), 16, 14, 16, 14, 3).mean(axis=(2, 4)).reshape(len(images), -1)
+        return (pooled.dot(self.W_logits), np.maximum(pooled.dot(self.W_features), 0))
@@ -0,0 +1,184 @@
+import os
+import csv
+import shutil
+import click
+import logging
+import coloredlogs
+from multiprocessing import Pool
+from PIL import ImageFile
+from typing import Dict, List, Optional, Tuple
+from lib.perceptual_hash import BKTree, HashCache, ImageHashes, hamming, hash_image
+
+# finds resized, re-encoded and burst shot copies of the same photo. every photo gets a 64 bit pHash and dHash
+# (cached by filename, size and mtime), the pHashes go into a BK-tree and each photo queries it for the others
+# within --max_distance bits, so the search never compares every pair. a dHash within --max_dhash_distance
+# confirms the match. photos taken within --burst_seconds of each other are matched with the looser
+# --burst_distance, comparing only the photos inside that window of the photos sorted by date. matches are
+# joined into clusters and everything but the largest photo of a cluster is reported, or moved to --trash_dir
+
+
+class SourceFile():
+    def __init__(self, filename: str, size: int, mtime: float):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.hashes: Optional[ImageHashes] = None
+
+
+def scan_source_directory(source_directory: str) -> List[SourceFile]:
+    ret = []
+    with os.scandir(source_directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                ret.append(SourceFile(entry.name, stat.st_size, stat.st_mtime))
+    return sorted(ret, key=lambda s: s.filename)
+
+
+def hash_file(args: Tuple[str, str]) -> Tuple[str, Optional[ImageHashes], Optional[str]]:
+    source_directory, filename = args
+    try:
+        with open(os.path.join(source_directory, filename), 'rb') as f:
+            return (filename, hash_image(f.read()), None)
+    except Exception as ex:
+        return (filename, None, str(ex))
+
+
+def init_worker() -> None:
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def hash_files(source_directory: str, files: List[SourceFile], cache_file: str, workers: int) -> List[SourceFile]:
+    # only files that are new, or changed since they were cached, are decoded. returns the files that have hashes
+    cache = HashCache(cache_file)
+    cached = cache.load()
+    todo: Dict[str, SourceFile] = {}
+    for s in files:
+        entry = cached.get(s.filename)
+        if entry is not None and entry[0] == s.size and entry[1] == s.mtime:
+            s.hashes = entry[2]
+        else:
+            todo[s.filename] = s
+    logging.info('{} photos, {} cached, hashing {}'.format(len(files), len(files) - len(todo), len(todo)))
+
+    pool = Pool(workers, initializer=init_worker) if workers > 1 and len(todo) > 0 else None
+    if pool is None:
+        init_worker()
+    try:
+        jobs = [(source_directory, f) for f in todo]
+        hashed = pool.imap_unordered(hash_file, jobs, chunksize=16) if pool is not None else map(hash_file, jobs)
+        for i, (filename, hashes, error) in enumerate(hashed):
+            if hashes is None:
+                logging.debug('{} could not be hashed: {}'.format(filename, error))
+                continue
+            s = todo[filename]
+            s.hashes = hashes
+            cache.put(s.filename, s.size, s.mtime, hashes)
+            if i % 1000 == 999:
+                logging.info('hashed {} of {}'.format(i + 1, len(todo)))
+                cache.commit()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    cache.remove_missing([s.filename for s in files])
+    cache.close()
+    return [s for s in files if s.hashes is not None]
+
+
+def find_root(parents: List[int], i: int) -> int:
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def find_clusters(files: List[SourceFile], max_distance: int, max_dhash_distance: int, burst_seconds: float,
+                  burst_distance: int) -> List[List[SourceFile]]:
+    tree = BKTree()
+    for i, s in enumerate(files):
+        tree.add(s.hashes.phash, i)
+
+    parents = list(range(len(files)))
+
+    def join(i: int, j: int) -> None:
+        parents[find_root(parents, j)] = find_root(parents, i)
+
+    for i, s in enumerate(files):
+        for _, j in tree.query(s.hashes.phash, max_distance):
+            if j > i and hamming(s.hashes.dhash, files[j].hashes.dhash) <= max_dhash_distance:
+                join(i, j)
+
+    # bursts are only looked for between photos taken within burst_seconds of each other, the looser
+    # threshold would make the tree visit most of its nodes on every query
+    dated = sorted((i for i, s in enumerate(files) if s.hashes.created > 0), key=lambda i: files[i].hashes.created)
+    for n, i in enumerate(dated):
+        s = files[i]
+        for m in range(n + 1, len(dated)):
+            j = dated[m]
+            other = files[j]
+            if other.hashes.created - s.hashes.created > burst_seconds:
+                break
+            if hamming(s.hashes.phash, other.hashes.phash) <= burst_distance:
+                join(i, j)
+
+    clusters: Dict[int, List[SourceFile]] = {}
+    for i, s in enumerate(files):
+        clusters.setdefault(find_root(parents, i), []).append(s)
+    # the keeper goes first: most pixels, then the biggest file
+    return [sorted(c, key=lambda s: (-s.hashes.width * s.hashes.height, -s.size, s.filename))
+            for c in clusters.values() if len(c) > 1]
+
+
+def process(source_directory: str, trash_directory: Optional[str], cache_file: str, report_file: str,
+            max_distance: int, max_dhash_distance: int, burst_seconds: float, burst_distance: int,
+            workers: int) -> None:
+    files = hash_files(source_directory, scan_source_directory(source_directory), cache_file, workers)
+    clusters = find_clusters(files, max_distance, max_dhash_distance, burst_seconds, burst_distance)
+    duplicates = sum(len(c) - 1 for c in clusters)
+    logging.info('{} clusters, {} duplicates'.format(len(clusters), duplicates))
+
+    with open(report_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['cluster', 'filename', 'keep', 'width', 'height', 'size', 'phash_distance'])
+        for n, cluster in enumerate(clusters):
+            keeper = cluster[0]
+            for s in cluster:
+                writer.writerow([n, s.filename, s is keeper, s.hashes.width, s.hashes.height, s.size,
+                                 hamming(keeper.hashes.phash, s.hashes.phash)])
+
+    if trash_directory is None:
+        logging.info('duplicate clusters written to {}'.format(report_file))
+        return
+
+    os.makedirs(trash_directory, exist_ok=True)
+    for cluster in clusters:
+        for s in cluster[1:]:
+            logging.info('Moving {} (duplicate of {}) to trash directory {}'.format(s.filename, cluster[0].filename,
+                                                                                   trash_directory))
+            shutil.move(os.path.join(source_directory, s.filename), os.path.join(trash_directory, s.filename))
+
+
+@click.command()
+@click.option('--source_dir', required=True, help='Source directory of images')
+@click.option('--trash_dir', default=None, help='Directory duplicates are moved to, they are only reported without it')
+@click.option('--cache', default='duplicates_cache.db', help='Filename of the perceptual hash cache')
+@click.option('--report', default='duplicates.csv', help='CSV file of the duplicate clusters found')
+@click.option('--max_distance', default=6, type=click.IntRange(0, 64),
+              help='Most pHash bits two copies of a photo can differ by')
+@click.option('--max_dhash_distance', default=10, type=click.IntRange(0, 64),
+              help='Most dHash bits a pHash match can differ by')
+@click.option('--burst_seconds', default=2.0, help='Photos taken this close together are matched as a burst')
+@click.option('--burst_distance', default=12, type=click.IntRange(0, 64),
+              help='Most pHash bits two photos of a burst can differ by')
+@click.option('--workers', default=os.cpu_count() or 1, type=click.IntRange(min=1),
+              help='Number of processes hashing photos')
+def main(source_dir: str, trash_dir: Optional[str], cache: str, report: str, max_distance: int,
+         max_dhash_distance: int, burst_seconds: float, burst_distance: int, workers: int):
+    coloredlogs.install(level='INFO')
+    process(source_dir, trash_dir, cache, report, max_distance, max_dhash_distance, burst_seconds, burst_distance,
+            workers)
+
+
+if __name__ == '__main__':
+    main()
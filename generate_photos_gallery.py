@@ -3,232 +3,798 @@ import typing
 import PIL
 import os
 import numpy as np
-import datetime as dt
 import logging
 import coloredlogs
 import random
 import functools
+import multiprocessing
+import threading
+import time
+import cProfile
+import pstats
+import tempfile
 import click
-from typing import List, Tuple, Dict, Optional
-from PIL import Image, ImageFile, ExifTags
-from GPSPhoto import gpsphoto
-from lib.gps_to_location_resolver import LatLongResolver
-from lib.places_classifier import PlacesClassifier
-
-
-def open_metadata_file(csv_file: str) -> Dict[str, Tuple[str, dt.datetime, str]]:
-    def chomp(string: str, start_char: str, end_char: str) -> Tuple[str, str]:
-        chomp: str = ''
-        l_index = string.find(start_char)
-        if l_index >= 0:
-            r_index = string.find(end_char, l_index + 1)
-            if r_index < 0:
-                return ('', string)
-
-            chomp = string[l_index:r_index + 1]
-            return (chomp, string[r_index + 1:])
+from typing import List, Tuple, Dict, Optional, NamedTuple
+from PIL import ImageFile
+from lib.photo_metadata import PhotoMetadata
+from lib.gps_cache import DEFAULT_MAX_ENTRIES, DEFAULT_PRECISION, CachedResolver, GpsCacheSettings
+from lib.image_decode import DEFAULT_MAX_PIXELS, draft_image, rotate_image
+from lib.metadata_store import MetadataStore, PhotoRecord, hash_bytes
+from lib.embedding_store import EmbeddingStore
+from lib.metadata_csv import read_rows, read_metadata, write_rows
+from lib.gallery_export import MANIFEST_FILENAME, export_year_shards, write_file
+from lib.search_index import build_search_index
+from lib.scene_tokens import SceneTokenizer
+from lib.profiling import Profiler, format_report
+from lib.pipeline import Pipeline, PipelineAborted, PipelineSettings
+from lib.reconcile import ChangeSet, find_changes, remove_files
+from lib.sharding import (Shard, fragment_filename, in_shard, merge_fragments, merge_stores, parse_shard,
+                          remove_fragments)
+from lib.watcher import DirectoryWatcher
+from lib.raw_preview import open_image
+from lib.thumbnails import (DEFAULT_FORMATS, DEFAULT_SIZES, LEGACY_SIZE, PYRAMID_REDUCING_GAP, ThumbnailPyramid,
+                            downscale, prepare_pyramid, save_pyramid, supported_formats)
+
+if typing.TYPE_CHECKING:
+    from lib.gps_to_location_resolver import LatLongResolver
+    from lib.places_classifier import PlacesClassifier
+
+# rows of stored classifier output read and tokenized at a time by --retokenize
+RETOKENIZE_CHUNK = 8192
+
+
+class ImageResult(NamedTuple):
+    filename: str
+    record: Optional[PhotoRecord]
+    # (logits, avgpool features) when the classifier ran for this image
+    vectors: Optional[Tuple[np.ndarray, np.ndarray]]
+    error: str
+
+
+def load_places_classifier(models_directory: str, num_threads: int = 0) -> 'PlacesClassifier':
+    # torch, torchvision and cv2 take seconds and hundreds of MB to import, so only runs that classify
+    # photos import them
+    from lib.places_classifier import PlacesClassifier
+    return PlacesClassifier(models_directory, num_threads=num_threads)
+
+
+def load_resolver(models_directory: str, gps_cache: Optional[GpsCacheSettings] = None) -> 'LatLongResolver':
+    # same for pandas and scipy. with gps_cache, lookups go through a cache of resolved geohash cells
+    from lib.gps_to_location_resolver import LatLongResolver
+    resolver = LatLongResolver(models_directory + '/cities.csv')
+    return CachedResolver(resolver, gps_cache) if gps_cache is not None else resolver
+
+
+def save_gps_cache(resolver: typing.Any, force: bool = False) -> None:
+    if isinstance(resolver, CachedResolver):
+        if force:
+            resolver.save()
+            if resolver.hits + resolver.misses > 0:
+                logging.info(str(resolver))
         else:
-            return ('', string)
-
-    processed: Dict[str, Tuple[str, dt.datetime, str]] = {}
-    if not os.path.exists(csv_file):
-        return processed
-    # line can have
-    # "filename", ratio, datetime, [token;token]
-    # where tokens are optional
-    with open(csv_file, 'r') as f:
-        line = f.readline()
-        while line:
-            filename, line = chomp(line, '"', '"')
-            split = line[1:].split(',')
-            if len(split) == 3:
-                ar = split[0]
-                c_date = dt.datetime.strptime(split[1].strip(), '%Y-%m-%d %H:%M:%S')
-                tokens = split[2].strip()
-            else:
-                ar = split[0]
-                c_date = dt.datetime.strptime(split[1].strip(), '%Y-%m-%d %H:%M:%S')
-                tokens = ''
-            if '"' in filename:
-                filename = filename.replace('"', '')
-
-            processed[filename] = (ar, c_date, tokens)
-            line = f.readline()
-    return processed
-
-
-def get_aspect_ratio(im: Image) -> float:
-    aspect_ratio = im.size[0] / im.size[1]
-    return aspect_ratio
-
-
-def get_created_date(im: Image) -> dt.datetime:
-    if im._getexif() and 36867 in im._getexif():
-        created_date = im._getexif()[36867]
-    else:
-        created_date = '1990:1:1 0:0:0'
-    created_date = created_date.strip()
+            resolver.maybe_save()
 
-    photo_date = dt.datetime(1990, 1, 1)
-    try:
-        photo_date = dt.datetime.strptime(created_date, '%Y:%m:%d %H:%M:%S')
-    except Exception as ex:
-        logging.debug(ex)
 
-    return photo_date
+def get_aspect_ratio(size: Tuple[int, int], orientation: int) -> float:
+    # size is the stored (unrotated) size, orientations 6 and 8 are rotated by 90 degrees
+    if orientation in (6, 8):
+        return size[1] / size[0]
+    return size[0] / size[1]
 
 
-def get_searchtokens(places_classifier: PlacesClassifier, im: Image) -> str:
+def get_searchtokens(places_classifier: 'PlacesClassifier',
+                     images: List[typing.Any]) -> Tuple[List[str], List[Optional[Tuple[np.ndarray, np.ndarray]]]]:
+    # scene tokens and the (logits, avgpool features) they came from, for each image.
+    # images that failed to preprocess are None and get no scene tokens
+    result: Tuple[List[str], List[Optional[Tuple[np.ndarray, np.ndarray]]]] = ([''] * len(images), [None] * len(images))
+    batch = [i for i in images if i is not None]
+    if len(batch) == 0:
+        return result
     try:
-        result = ';'.join(places_classifier.forward(im))
+        logits, features = places_classifier.forward_vectors(batch)
+        tokens = places_classifier.tokenizer.tokens_batch(logits, features)
+        n = 0
+        for i, image in enumerate(images):
+            if image is not None:
+                result[0][i] = ';'.join(tokens[n])
+                result[1][i] = (logits[n], features[n])
+                n += 1
         return result
     except Exception as ex:
         logging.debug(ex)
-        return ''
+        return ([''] * len(images), [None] * len(images))
 
 
-def rotate_image(im: Image) -> Image:
+def get_gps_search_tokens(filenames: List[str], metadata: List[PhotoMetadata],
+                          resolver: 'LatLongResolver') -> List[str]:
+    # resolves every photo with coordinates in one go, photos without them get no tokens
+    result = [''] * len(metadata)
+    located = [i for i, m in enumerate(metadata) if m.latitude is not None and m.longitude is not None]
+    if len(located) == 0:
+        return result
     try:
-        orientation = -1
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation': break
-        exif = dict(im._getexif().items())
-
-        if orientation in exif and exif[orientation] == 3:
-            im = im.rotate(180, expand=True)
-        elif orientation in exif and exif[orientation] == 6:
-            im = im.rotate(270, expand=True)
-        elif orientation in exif and exif[orientation] == 8:
-            im = im.rotate(90, expand=True)
+        tokens = resolver.nearest_many([metadata[i].latitude for i in located],
+                                       [metadata[i].longitude for i in located])
+        for i, t in zip(located, tokens):
+            if t is not None:
+                result[i] = ';'.join(t)
     except Exception as ex:
-        logging.debug(ex)
+        logging.error('Unable to parse GPS coordinates for {} {}'.format(', '.join(filenames[i] for i in located), ex))
+    return result
 
-    return im
 
+def write_metadata_csv(store: MetadataStore, csv_file: str, data_directory: Optional[str],
+                       force: bool = False) -> None:
+    # photos.csv and the per year shards for the frontend are exports of the store, ordered by date,
+    # and only rewritten when the store changed since they were last written. a --shard only writes its
+    # fragment of photos.csv (data_directory is None), --merge exports the rest
+    if not force and os.path.exists(csv_file) and store.is_exported(csv_file) \
+            and (data_directory is None or os.path.exists(os.path.join(data_directory, MANIFEST_FILENAME))):
+        return
+
+    rows = [(k, v.aspect_ratio, v.created_date, v.tokens) for k, v in store.records()]
+    write_rows(csv_file, rows)
+    if data_directory is not None:
+        export_year_shards(rows, data_directory)
+    store.mark_exported(csv_file)
 
-def get_gps_search_tokens(image_filename: str, resolver: LatLongResolver) -> List[str]:
-    try:
-        data = gpsphoto.getGPSData(image_filename)
-        if 'Latitude' in data and 'Longitude' in data:
-            tokens = resolver.nearest(data['Latitude'], data['Longitude'])
-            return tokens
-        else:
-            return []
-    except Exception as ex:
-        logging.error('Unable to parse GPS coordinates for {} {}'.format(image_filename, ex))
-        return []
 
+def save_embeddings(embeddings: EmbeddingStore, results: List[ImageResult]) -> None:
+    computed = [r for r in results if r.record is not None and r.vectors is not None]
+    if len(computed) > 0:
+        embeddings.append([(r.record.content_hash, r.filename) for r in computed],
+                          np.stack([r.vectors[0] for r in computed]),
+                          np.stack([r.vectors[1] for r in computed]))
 
-def regenerate_metadata_csv(source_directory: str, models_directory: str, csv_file: str) -> None:
+
+def regenerate_metadata_csv(source_directory: str, models_directory: str, csv_file: str, store_file: str,
+                            embeddings_directory: str, data_directory: str, batch_size: int = 16,
+                            max_pixels: int = DEFAULT_MAX_PIXELS, gps_cache: Optional[GpsCacheSettings] = None) -> None:
     if not os.path.exists(models_directory + '/cities.csv'):
         raise ValueError('models directory {} does not contain cities.csv model'.format(models_directory))
 
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
     # todo fix this
-    places_classifier = PlacesClassifier(models_directory)
+    places_classifier = load_places_classifier(models_directory)
     images = os.listdir(source_directory)
-    resolver = LatLongResolver(models_directory + '/cities.csv')
-    metadata = {}
-
-    with open(csv_file, 'w') as csv_out:
-        for f in images:
+    # through the same cache as process(), so a photo gets the same location tokens either way
+    resolver = load_resolver(models_directory, gps_cache)
+    store = MetadataStore(store_file)
+    embeddings = EmbeddingStore(embeddings_directory)
+
+    # everything is recomputed, the store is only written to
+    for batch in batches(images, batch_size):
+        for f in batch:
             logging.info('regenerating {}'.format(f))
-            try:
-                latlong_tokens = get_gps_search_tokens(source_directory + '/' + f, resolver)
-                im = Image.open(source_directory + '/' + f)
-
-                created_date = get_created_date(im)
-                im = rotate_image(im)
-                aspect_ratio = get_aspect_ratio(im)
-                tokens = get_searchtokens(places_classifier, im)
-
-                if len(latlong_tokens) > 0:
-                    tokens = tokens + ';' + ';'.join(latlong_tokens)
+        results = process_images(source_directory, None, batch, places_classifier, resolver, None, max_pixels)
+        for f, result, _, error in results:
+            if result is None:
+                logging.error('{}: {}'.format(f, error))
+                store.remove(f)
+                continue
+            store.put(f, result)
+        save_embeddings(embeddings, results)
+        store.commit()
+        save_gps_cache(resolver)
+    save_gps_cache(resolver, force=True)
+
+    for f in set(store.filenames()) - set(images):
+        store.remove(f)
+    store.commit()
+
+    write_metadata_csv(store, csv_file, data_directory, force=True)
+    store.close()
+
+
+def retokenize_metadata(models_directory: str, csv_file: str, store_file: str, embeddings_directory: str,
+                        data_directory: str) -> None:
+    # recomputes scene tokens from the stored classifier output, no images are read and no CNN is run
+    tokenizer = SceneTokenizer(models_directory)
+    store = MetadataStore(store_file)
+    embeddings = EmbeddingStore(embeddings_directory)
+
+    records = [(f, r) for f, r in store.records() if r.content_hash in embeddings]
+    logging.info('retokenizing {} of {} photos'.format(len(records), len(store)))
+
+    # a chunk at a time, so only one chunk of vectors is ever in memory as float32
+    for start in range(0, len(records), RETOKENIZE_CHUNK):
+        chunk = records[start:start + RETOKENIZE_CHUNK]
+        logits, features = embeddings.get_many([r.content_hash for _, r in chunk])
+        for (f, record), t in zip(chunk, tokenizer.tokens_batch(logits, features)):
+            scene_tokens = ';'.join(t)
+            if scene_tokens != record.scene_tokens:
+                store.put(f, record._replace(scene_tokens=scene_tokens))
+    store.commit()
+
+    write_metadata_csv(store, csv_file, data_directory)
+    store.close()
+
+
+def regenerate_search_dictionary(csv_file: str, search_tokens_csv: str, data_directory: str) -> None:
+    search_tokens: Dict[str, bool] = {}
 
-                metadata[f] = (aspect_ratio, created_date, tokens)
-                im.close()
-            except Exception as ex:
-                logging.exception('{}: {}'.format(f, ex), exc_info=False)
+    def rows():
+        for row in read_rows(csv_file):
+            for t in row.tokens.split(';'):
+                search_tokens[t.rstrip()] = True
+            yield row
+
+    # one pass over photos.csv for both the flat dictionary and the inverted index in data/
+    index = build_search_index(rows(), data_directory)
+
+    write_file(search_tokens_csv, ''.join(k + '\n' for k in sorted(search_tokens)).encode('utf-8'))
+
+    logging.info('search index: {} tokens over {} photos in {} shards'
+                 .format(len(index['tokens']), index['total'], len(index['shards'])))
+
+
+def merge_shards(csv_file: str, search_tokens_csv: str, store_file: str, embeddings_directory: str,
+                 data_directory: str, count: int) -> None:
+    # the store, embeddings, photos.csv, the per year shards and the search index from the fragments of all count
+    # shards, which are then deleted
+    rows = merge_fragments(csv_file, count)
+    merge_stores(rows, store_file, embeddings_directory, count)
+    write_rows(csv_file, rows)
+    export_year_shards(rows, data_directory)
+    store = MetadataStore(store_file)
+    store.mark_exported(csv_file)
+    store.close()
+    logging.info('merged {} shards, {} photos into {}'.format(count, len(rows), csv_file))
+    regenerate_search_dictionary(csv_file, search_tokens_csv, data_directory)
+    remove_fragments(csv_file, store_file, embeddings_directory, count)
+
+
+def batches(items: typing.Sequence[str], batch_size: int) -> List[List[str]]:
+    return [list(items[i:i + batch_size]) for i in range(0, len(items), batch_size)]
+
+
+def read_image(source_directory: str, f: str, profiler: Profiler) -> Tuple[bytes, os.stat_result, str]:
+    # the file's bytes, stat and content hash. the file is read once, the bytes are both hashed and decoded
+    with profiler.stage('read', f):
+        with open(source_directory + '/' + f, 'rb') as image_file:
+            data = image_file.read()
+            stat = os.fstat(image_file.fileno())
+    profiler.read(len(data))
+    with profiler.stage('hash', f):
+        content_hash = hash_bytes(data)
+    return (data, stat, content_hash)
+
+
+def prepare_image(f: str,
+                  data: bytes,
+                  stat: os.stat_result,
+                  content_hash: str,
+                  thumbnail_directory: Optional[str],
+                  places_classifier: 'PlacesClassifier',
+                  store: Optional[MetadataStore],
+                  max_pixels: int,
+                  pyramid: ThumbnailPyramid,
+                  profiler: Profiler,
+                  write: typing.Callable[[str, bytes], None] = write_file) -> tuple:
+    # everything for one file up to the classifier: (filename, record, classifier input, metadata, uncached).
+    # thumbnails are handed to write(filename, data). raises when the image can't be read
+    with profiler.stage('lookup', f):
+        cached = store.lookup(f, stat.st_size, stat.st_mtime, content_hash) if store else None
+
+    with profiler.stage('exif', f):
+        im, photo_metadata = open_image(data)
+        source_format = im.format
+    aspect_ratio = get_aspect_ratio(im.size, photo_metadata.orientation)
+    with profiler.stage('decode', f):
+        # one decode, big enough for the largest thumbnail, every smaller one is resized from the one above it
+        if thumbnail_directory is not None:
+            draft_image(im, (pyramid.largest, pyramid.largest), max_pixels=max_pixels,
+                        reducing_gap=PYRAMID_REDUCING_GAP)
+        else:
+            draft_image(im, (LEGACY_SIZE, LEGACY_SIZE), max_pixels=max_pixels)
+        im.load()
 
-        metadata = {k: v for k, v in sorted(metadata.items(), key=lambda item: item[1][1], reverse=True)}
+    with profiler.stage('rotate', f):
+        im = rotate_image(im, photo_metadata.orientation)
 
-        for k, v in metadata.items():
-            csv_out.write('"{}",{:.3f},{},{}\n'.format(k, v[0], v[1], v[2]))
-        csv_out.close()
+    def write_thumbnail(filename: str, thumbnail: bytes) -> None:
+        profiler.wrote(len(thumbnail))
+        write(filename, thumbnail)
 
+    with profiler.stage('thumbnail', f):
+        if thumbnail_directory is not None:
+            legacy = save_pyramid(im, thumbnail_directory, f, pyramid, source_format, write_thumbnail)
+        else:
+            legacy = downscale(im, LEGACY_SIZE)
 
-def regenerate_search_dictionary(csv_file: str, search_tokens_csv: str) -> None:
-    csv = open_metadata_file(csv_file)
-    search_tokens: Dict[str, bool] = {}
-    for k, v in csv.items():
-        for t in v[2].split(';'):
-            search_tokens[t.rstrip()] = True
+    # the classifier sees the same 640 pixel image whether or not thumbnails are written
+    classifier_input = None
+    if cached is None:
+        with profiler.stage('preprocess', f):
+            try:
+                classifier_input = places_classifier.preprocess(legacy)
+            except Exception as ex:
+                logging.debug(ex)
+    im.close()
+
+    record = PhotoRecord(stat.st_size, stat.st_mtime, content_hash, '{:.3f}'.format(aspect_ratio),
+                         photo_metadata.created_date, '', '')
+    if cached is not None:
+        record = record._replace(scene_tokens=cached.scene_tokens, gps_tokens=cached.gps_tokens)
+    return (f, record, classifier_input, photo_metadata, cached is None)
+
+
+def finish_images(prepared: List[tuple],
+                  places_classifier: 'PlacesClassifier',
+                  resolver: 'LatLongResolver',
+                  profiler: Profiler) -> Dict[str, ImageResult]:
+    # classifies and resolves GPS for the prepared files that weren't in the store, all in one go
+    uncached = [p for p in prepared if p[4]]
+    with profiler.stage('classify'):
+        search_tokens, vectors = get_searchtokens(places_classifier, [p[2] for p in uncached])
+    with profiler.stage('gps'):
+        gps_tokens = get_gps_search_tokens([p[0] for p in uncached], [p[3] for p in uncached], resolver)
+
+    results = {p[0]: ImageResult(p[0], p[1], None, '') for p in prepared}
+    for p, tokens, v, latlong_tokens in zip(uncached, search_tokens, vectors, gps_tokens):
+        results[p[0]] = ImageResult(p[0], p[1]._replace(scene_tokens=tokens, gps_tokens=latlong_tokens), v, '')
+    return results
+
+
+def process_images(source_directory: str,
+                   thumbnail_directory: Optional[str],
+                   filenames: List[str],
+                   places_classifier: 'PlacesClassifier',
+                   resolver: 'LatLongResolver',
+                   store: Optional[MetadataStore] = None,
+                   max_pixels: int = DEFAULT_MAX_PIXELS,
+                   pyramid: ThumbnailPyramid = ThumbnailPyramid(DEFAULT_SIZES, DEFAULT_FORMATS),
+                   profiler: Profiler = Profiler()) -> List[ImageResult]:
+    # returns an ImageResult for each of filenames, in order.
+    # thumbnails are skipped when thumbnail_directory is None. files whose content is already in the store
+    # reuse its search tokens and skip the GPS lookup and classifier
+    prepared = []
+    errors: Dict[str, str] = {}
+
+    for f in filenames:
+        try:
+            data, stat, content_hash = read_image(source_directory, f, profiler)
+            prepared.append(prepare_image(f, data, stat, content_hash, thumbnail_directory, places_classifier, store,
+                                          max_pixels, pyramid, profiler))
+        except Exception as ex:
+            errors[f] = str(ex)
+
+    results = finish_images(prepared, places_classifier, resolver, profiler)
+    return [results[f] if f in results else ImageResult(f, None, None, errors.get(f, '')) for f in filenames]
+
+
+def pipelined_results(source_directory: str,
+                      thumbnail_directory: str,
+                      filenames: List[str],
+                      places_classifier: 'PlacesClassifier',
+                      resolver: 'LatLongResolver',
+                      store_file: str,
+                      max_pixels: int,
+                      pyramid: ThumbnailPyramid,
+                      batch_size: int,
+                      settings: PipelineSettings,
+                      profile: bool) -> typing.Iterator[Tuple[List[ImageResult], Optional[Dict[str, typing.Any]]]]:
+    # process_images split into stages that run at the same time: reader threads prefetch and hash files,
+    # decode threads decode, make thumbnails and preprocess, one thread writes the thumbnails and one batches
+    # up images for the classifier and GPS lookup. yields batches of results like process_images_worker, in the
+    # order of filenames, and the timings of every stage at the end
+    pipeline = Pipeline(settings.queue_depth)
+    local = threading.local()
+    profilers: List[Profiler] = []
+    lock = threading.Lock()
+
+    def thread_profiler() -> Profiler:
+        if not hasattr(local, 'profiler'):
+            local.profiler = Profiler(profile)
+            with lock:
+                profilers.append(local.profiler)
+        return local.profiler
+
+    def thread_store() -> MetadataStore:
+        # sqlite connections can only be used on the thread that opened them
+        if not hasattr(local, 'store'):
+            local.store = MetadataStore(store_file)
+        return local.store
+
+    files = pipeline.source(filenames)
+    read_queue = pipeline.new_queue()
+    decoded_queue = pipeline.new_queue()
+    thumbnail_queue = pipeline.new_queue()
+    results_queue = pipeline.new_queue()
+
+    def failed(f: str, ex: Exception) -> None:
+        pipeline.put(results_queue, ([ImageResult(f, None, None, str(ex))], None))
+
+    def read(f: str) -> None:
+        try:
+            item = (f,) + read_image(source_directory, f, thread_profiler())
+        except PipelineAborted:
+            raise
+        except Exception as ex:
+            failed(f, ex)
+            return
+        pipeline.put(read_queue, item)
 
-    with open(search_tokens_csv, 'w') as f:
-        for k, v in sorted(search_tokens.items(), reverse=False):  # type: ignore
-            f.write(k + '\n')
+    def decode(item: tuple) -> None:
+        f, data, stat, content_hash = item
+        try:
+            prepared = prepare_image(f, data, stat, content_hash, thumbnail_directory, places_classifier,
+                                     thread_store(), max_pixels, pyramid, thread_profiler(),
+                                     lambda filename, thumbnail: pipeline.put(thumbnail_queue, (filename, thumbnail)))
+        except PipelineAborted:
+            raise
+        except Exception as ex:
+            failed(f, ex)
+            return
+        pipeline.put(decoded_queue, prepared)
+
+    def write_thumbnail(item: Tuple[str, bytes]) -> None:
+        with thread_profiler().stage('write'):
+            write_file(*item)
+
+    batch: List[tuple] = []
+
+    def classify(prepared: tuple) -> None:
+        batch.append(prepared)
+        if len(batch) >= batch_size:
+            flush()
+
+    def flush() -> None:
+        if len(batch) > 0:
+            results = finish_images(batch, places_classifier, resolver, thread_profiler())
+            pipeline.put(results_queue, (list(results.values()), None))
+            batch.clear()
+
+    pipeline.stage('read', settings.read_threads, files, [read_queue], read)
+    pipeline.stage('decode', settings.decode_threads, read_queue, [decoded_queue, thumbnail_queue], decode)
+    pipeline.stage('write', 1, thumbnail_queue, [], write_thumbnail)
+    pipeline.stage('classify', 1, decoded_queue, [results_queue], classify, flush)
+    pipeline.start()
+
+    # results finish out of order, they're handed on in the order of filenames like every other path, so photos
+    # with the same date are stored (and written to photos.csv) in the same order
+    order = {f: i for i, f in enumerate(filenames)}
+    pending: Dict[int, ImageResult] = {}
+    next_index = 0
+    for results, _ in pipeline.results(results_queue):
+        for result in results:
+            pending[order[result.filename]] = result
+        ready = []
+        while next_index in pending:
+            ready.append(pending.pop(next_index))
+            next_index += 1
+        if len(ready) > 0:
+            yield (ready, None)
+    if len(pending) > 0:
+        yield ([pending[i] for i in sorted(pending)], None)
+
+    merged = Profiler(profile)
+    for p in profilers:
+        merged.merge(p.snapshot())
+    yield ([], merged.snapshot())
+
+
+def file_stat(source_directory: str, f: str) -> Optional[Tuple[int, float]]:
+    try:
+        stat = os.stat(os.path.join(source_directory, f))
+        return (stat.st_size, stat.st_mtime)
+    except OSError:
+        return None
+
+
+def retry_files(store: MetadataStore, stale: List[str], source_directory: str) -> List[str]:
+    # the stale files to process, less the ones that failed before and haven't changed since. they're retried once
+    # their size or mtime changes, so a file that can never be decoded doesn't load the models on every run
+    failures = store.failures()
+    # forget the failures of files that were deleted
+    stale_files = set(stale)
+    store.remove_failures([f for f in failures if f not in stale_files])
+    store.commit()
+    return [f for f in stale if f not in failures or failures[f] != file_stat(source_directory, f)]
+
+
+def remove_orphans(store: MetadataStore, changes: ChangeSet, source_directory: str) -> bool:
+    # thumbnails and metadata of photos that were deleted, returns whether there were any
+    if changes.unchanged + len(changes.stale) == 0 and len(changes.orphan_records) > 0:
+        # an unmounted or mistyped source directory shouldn't wipe the gallery
+        logging.warning('{} is empty, not removing the thumbnails and metadata of {} photos'
+                        .format(source_directory, len(changes.orphan_records)))
+        return False
+    if len(changes.orphan_thumbnails) + len(changes.orphan_records) == 0:
+        return False
+    logging.info('removing {} thumbnails and the metadata of {} photos no longer in {}'
+                 .format(len(changes.orphan_thumbnails), len(changes.orphan_records), source_directory))
+    remove_files(changes.orphan_thumbnails)
+    for f in changes.orphan_records:
+        store.remove(f)
+    store.commit()
+    return True
+
+
+def store_results(store: MetadataStore, embeddings: EmbeddingStore, results: List[ImageResult],
+                  source_directory: str, log_file: typing.TextIO) -> None:
+    for f, result, _, error in results:
+        if result is None:
+            logging.error('{}: {}'.format(error, f))
+            log_file.write(f + '\n')
+            log_file.flush()
+            stat = file_stat(source_directory, f)
+            if stat is not None:
+                store.put_failure(f, *stat)
+            continue
+
+        store.put(f, result)
+        logging.info('processed: {}'.format(f))
+    save_embeddings(embeddings, results)
+    store.commit()
+
+
+# per process state for --workers, populated once by init_worker
+worker_state: Dict[str, typing.Any] = {}
+
+
+def init_worker(source_directory: str,
+                thumbnail_directory: str,
+                models_directory: str,
+                store_file: str,
+                torch_threads: int,
+                max_pixels: int = DEFAULT_MAX_PIXELS,
+                pyramid: ThumbnailPyramid = ThumbnailPyramid(DEFAULT_SIZES, DEFAULT_FORMATS),
+                profile: bool = False,
+                gps_cache: Optional[GpsCacheSettings] = None) -> None:
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    worker_state['source_directory'] = source_directory
+    worker_state['thumbnail_directory'] = thumbnail_directory
+    worker_state['max_pixels'] = max_pixels
+    worker_state['pyramid'] = pyramid
+    worker_state['profiler'] = Profiler(profile)
+    worker_state['places_classifier'] = load_places_classifier(models_directory, num_threads=torch_threads)
+    worker_state['resolver'] = load_resolver(models_directory, gps_cache)
+    if multiprocessing.parent_process() is not None:
+        # runs when a pool worker exits normally
+        multiprocessing.util.Finalize(None, save_gps_cache, args=(worker_state['resolver'], True), exitpriority=10)
+    # workers only read from the store, the parent process does all the writes
+    worker_state['store'] = MetadataStore(store_file)
+
+
+def process_images_worker(filenames: List[str]) -> Tuple[List[ImageResult], Optional[Dict[str, typing.Any]]]:
+    # the batch's results, and its timings when profiling
+    results = process_images(worker_state['source_directory'],
+                             worker_state['thumbnail_directory'],
+                             filenames,
+                             worker_state['places_classifier'],
+                             worker_state['resolver'],
+                             worker_state['store'],
+                             worker_state['max_pixels'],
+                             worker_state['pyramid'],
+                             worker_state['profiler'])
+    save_gps_cache(worker_state['resolver'])
+    return (results, worker_state['profiler'].snapshot())
 
 
 def process(source_directory: str,
             thumbnail_directory: str,
             models_directory: str,
-            csv_file: str) -> None:
-    MAX_SIZE = (640, 640)
+            csv_file: str,
+            store_file: str,
+            embeddings_directory: str,
+            data_directory: str,
+            workers: int = 1,
+            batch_size: int = 16,
+            max_pixels: int = DEFAULT_MAX_PIXELS,
+            pyramid: ThumbnailPyramid = ThumbnailPyramid(DEFAULT_SIZES, DEFAULT_FORMATS),
+            profile_report: Optional[str] = None,
+            pipeline: Optional[PipelineSettings] = None,
+            shard: Optional[Shard] = None,
+            gps_cache: Optional[GpsCacheSettings] = None) -> None:
     ImageFile.LOAD_TRUNCATED_IMAGES = True
-    places_classifier = PlacesClassifier(models_directory)
     if not os.path.exists(models_directory + '/cities.csv'):
         raise ValueError('{} does not contain cities.csv model'.format(models_directory))
 
-    resolver = LatLongResolver(models_directory + '/cities.csv')
-    thumbnail_directory = os.path.abspath(thumbnail_directory)
-
-    source_files = os.listdir(source_directory)
-    unprocessed_files = source_files
-
-    if os.path.exists('generate.log'):
-        os.remove('generate.log')
-    log_file = open('generate.log', 'w')
-
-    thumbnail_files = os.listdir(thumbnail_directory)
-    unprocessed_files = np.setdiff1d(source_files, thumbnail_files)
-    metadata = open_metadata_file(csv_file)
+    start = time.perf_counter()
+    profiler = Profiler(profile_report is not None)
 
-    csv_out = open(csv_file, 'w')
-
-    logging.info('unprocessed files: {}'.format(len(unprocessed_files)))
-
-    for f in unprocessed_files:
-        try:
-            latlong_tokens = get_gps_search_tokens(source_directory + '/' + f, resolver)
-            im = Image.open(source_directory + '/' + f)
-
-            created_date = get_created_date(im)
-            im = rotate_image(im)
-            aspect_ratio = get_aspect_ratio(im)
-            tokens = get_searchtokens(places_classifier, im)
-
-            im.thumbnail(MAX_SIZE, Image.ANTIALIAS)
-            im.save(thumbnail_directory + '/' + f, format=im.format)
-
-            if len(latlong_tokens) > 0:
-                tokens = tokens + ';' + ';'.join(latlong_tokens)
-
-            if f not in metadata:
-                metadata[f] = ('{:.3f}'.format(aspect_ratio),
-                               created_date,
-                               tokens)
-            logging.info('processed: {}'.format(f))
-            im.close()
-        except Exception as ex:
-            logging.exception('{}: {}'.format(ex, f), exc_info=False)
-            log_file.write(f + '\n')
-            log_file.flush()
+    thumbnail_directory = os.path.abspath(thumbnail_directory)
+    prepare_pyramid(thumbnail_directory, pyramid)
+
+    # files that failed, shards running at the same time each keep their own
+    log_filename = 'generate.log' if shard is None else fragment_filename('generate.log', shard)
+    if os.path.exists(log_filename):
+        os.remove(log_filename)
+    log_file = open(log_filename, 'w')
+
+    merged_csv_file = csv_file
+    if shard is not None:
+        # every shard has its own store, embeddings and fragment of photos.csv, see lib/sharding.py
+        csv_file = fragment_filename(csv_file, shard)
+        store_file = fragment_filename(store_file, shard)
+        embeddings_directory = os.path.join(embeddings_directory, str(shard))
+        logging.info('{}: metadata in {} and {}'.format(shard, store_file, csv_file))
+
+    store = MetadataStore(store_file)
+    imported = csv_file if os.path.exists(csv_file) else merged_csv_file
+    if len(store) == 0 and os.path.exists(imported):
+        logging.info('importing {} into {}'.format(imported, store_file))
+        store.import_metadata({f: m for f, m in read_metadata(imported).items()
+                               if shard is None or in_shard(f, shard)})
+
+    with profiler.stage('scan'):
+        changes = find_changes(source_directory, thumbnail_directory, pyramid, store.stats(),
+                               None if shard is None else functools.partial(in_shard, shard=shard))
+    unprocessed_files = retry_files(store, changes.stale, source_directory)
+    if len(unprocessed_files) < len(changes.stale):
+        # listed in the log again, they still need looking at
+        skipped = sorted(set(changes.stale) - set(unprocessed_files))
+        logging.info('skipping {} files that failed before and are unchanged'.format(len(skipped)))
+        log_file.write(''.join(f + '\n' for f in skipped))
+        log_file.flush()
+    logging.info('unchanged files: {}, unprocessed files: {}'.format(changes.unchanged, len(unprocessed_files)))
+
+    embeddings = EmbeddingStore(embeddings_directory)
+    # resolvers used in this process, their gps caches are saved at the end. workers save their own
+    resolvers: List[typing.Any] = []
+
+    def results() -> typing.Iterator[Tuple[List[ImageResult], Optional[Dict[str, typing.Any]]]]:
+        # the models are only loaded (and torch only imported) when there's something to process
+        if len(unprocessed_files) == 0:
+            return
+        if pipeline is not None:
+            ImageFile.LOAD_TRUNCATED_IMAGES = True
+            resolvers.append(load_resolver(models_directory, gps_cache))
+            yield from pipelined_results(source_directory, thumbnail_directory, unprocessed_files,
+                                         load_places_classifier(models_directory), resolvers[0],
+                                         store_file, max_pixels, pyramid, batch_size, pipeline, profiler.enabled)
+        elif workers > 1:
+            # split the cores between the workers so torch doesn't oversubscribe the box
+            torch_threads = max(1, (os.cpu_count() or 1) // workers)
+            # build the city index once up front, the workers then all map the same files
+            from lib.gps_to_location_resolver import prepare_cities_index
+            prepare_cities_index(models_directory + '/cities.csv')
+            with multiprocessing.Pool(workers,
+                                      initializer=init_worker,
+                                      initargs=(source_directory, thumbnail_directory,
+                                                models_directory, store_file, torch_threads, max_pixels,
+                                                pyramid, profiler.enabled, gps_cache)) as pool:
+                # imap keeps results in unprocessed_files order, so the csv matches the serial path
+                yield from pool.imap(process_images_worker, batches(unprocessed_files, batch_size))
+                # let the workers exit rather than be terminated, so they save their gps caches
+                pool.close()
+                pool.join()
+        else:
+            init_worker(source_directory, thumbnail_directory, models_directory, store_file, 0, max_pixels, pyramid,
+                        profiler.enabled, gps_cache)
+            resolvers.append(worker_state['resolver'])
+            for batch in batches(unprocessed_files, batch_size):
+                yield process_images_worker(batch)
+
+    for batch_results, batch_profile in results():
+        profiler.merge(batch_profile)
+        with profiler.stage('store'):
+            store_results(store, embeddings, batch_results, source_directory, log_file)
+    # only once the stale files are stored: a renamed photo is found by its content hash in the old name's record
+    remove_orphans(store, changes, source_directory)
+    for resolver in resolvers:
+        save_gps_cache(resolver, force=True)
+
+    with profiler.stage('export'):
+        write_metadata_csv(store, csv_file, data_directory if shard is None else None)
+    store.close()
+
+    if profile_report is not None:
+        report = profiler.write_report(profile_report, time.perf_counter() - start)
+        print(format_report(report))
+        logging.info('profile written to {}'.format(profile_report))
+
+
+def watch_directory(source_directory: str,
+                    thumbnail_directory: str,
+                    models_directory: str,
+                    csv_file: str,
+                    store_file: str,
+                    embeddings_directory: str,
+                    data_directory: str,
+                    search_tokens_csv: str,
+                    batch_size: int = 16,
+                    max_pixels: int = DEFAULT_MAX_PIXELS,
+                    pyramid: ThumbnailPyramid = ThumbnailPyramid(DEFAULT_SIZES, DEFAULT_FORMATS),
+                    pipeline: Optional[PipelineSettings] = None,
+                    debounce: float = 2.0,
+                    max_delay: float = 60.0,
+                    poll_interval: float = 5.0,
+                    gps_cache: Optional[GpsCacheSettings] = None) -> None:
+    # runs until interrupted, processing photos as they are added to, replaced in or removed from source_directory.
+    # the classifier and city index are loaded once, with the first new photo, and then kept. thumbnails, photos.csv,
+    # data/ and the search dictionary are all written to a temporary file that is renamed into place, so the site
+    # never serves a half written file
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    if not os.path.exists(models_directory + '/cities.csv'):
+        raise ValueError('{} does not contain cities.csv model'.format(models_directory))
 
-    # order the files by date
-    metadata = {k: v for k, v in sorted(metadata.items(), key=lambda item: item[1][1], reverse=True)}
+    thumbnail_directory = os.path.abspath(thumbnail_directory)
+    prepare_pyramid(thumbnail_directory, pyramid)
+    log_file = open('generate.log', 'a')
+
+    store = MetadataStore(store_file)
+    if len(store) == 0 and os.path.exists(csv_file):
+        logging.info('importing {} into {}'.format(csv_file, store_file))
+        store.import_metadata(read_metadata(csv_file))
+    embeddings = EmbeddingStore(embeddings_directory)
+
+    watcher = DirectoryWatcher(source_directory, poll_interval)
+    logging.info('watching {} {}'.format(source_directory, 'with inotify' if watcher.inotify is not None
+                                         else 'every {}s'.format(poll_interval)))
+    models: List[typing.Any] = []
+
+    def results(filenames: List[str]) -> typing.Iterator[Tuple[List[ImageResult], Optional[Dict[str, typing.Any]]]]:
+        places_classifier, resolver = models
+        if pipeline is not None:
+            yield from pipelined_results(source_directory, thumbnail_directory, filenames, places_classifier, resolver,
+                                         store_file, max_pixels, pyramid, batch_size, pipeline, False)
+        else:
+            for batch in batches(filenames, batch_size):
+                yield (process_images(source_directory, thumbnail_directory, batch, places_classifier, resolver,
+                                      store, max_pixels, pyramid), None)
 
-    for k, v in metadata.items():
-        csv_out.write('"{}",{},{},{}\n'.format(k, v[0], v[1], v[2]))
-    csv_out.close()
+    try:
+        while True:
+            changes = find_changes(source_directory, thumbnail_directory, pyramid, store.stats())
+            unprocessed_files = retry_files(store, changes.stale, source_directory)
+            if len(unprocessed_files) > 0:
+                logging.info('unprocessed files: {}'.format(len(unprocessed_files)))
+                if len(models) == 0:
+                    models.extend([load_places_classifier(models_directory),
+                                   load_resolver(models_directory, gps_cache)])
+                for batch_results, _ in results(unprocessed_files):
+                    store_results(store, embeddings, batch_results, source_directory, log_file)
+            removed = remove_orphans(store, changes, source_directory)
+
+            if len(unprocessed_files) > 0:
+                save_gps_cache(models[1], force=True)
+            if len(unprocessed_files) > 0 or removed:
+                write_metadata_csv(store, csv_file, data_directory)
+                regenerate_search_dictionary(csv_file, search_tokens_csv, data_directory)
+            watcher.wait(debounce, max_delay)
+    except KeyboardInterrupt:
+        logging.info('stopped watching {}'.format(source_directory))
+    finally:
+        watcher.close()
+        store.close()
+        log_file.close()
+
+
+def profile_single_file(source_directory: str,
+                        models_directory: str,
+                        filename: str,
+                        repeat: int,
+                        max_pixels: int,
+                        pyramid: ThumbnailPyramid,
+                        profile_report: str,
+                        gps_cache: Optional[GpsCacheSettings] = None) -> None:
+    # one file through process_images under cProfile, in this process and with nothing written to the store or
+    # thumbnail directory. --profile_repeat keeps it going long enough to attach py-spy
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+    places_classifier = load_places_classifier(models_directory)
+    resolver = load_resolver(models_directory, gps_cache)
+    profiler = Profiler(True)
+    profile = cProfile.Profile()
+
+    with tempfile.TemporaryDirectory() as thumbnail_directory:
+        prepare_pyramid(thumbnail_directory, pyramid)
+        start = time.perf_counter()
+        profile.enable()
+        for _ in range(repeat):
+            results = process_images(source_directory, thumbnail_directory, [filename], places_classifier, resolver,
+                                     None, max_pixels, pyramid, profiler)
+        profile.disable()
+        wall_seconds = time.perf_counter() - start
+
+    if results[0].record is None:
+        logging.error('{}: {}'.format(results[0].error, filename))
+    stats_file = os.path.splitext(profile_report)[0] + '.prof'
+    profile.dump_stats(stats_file)
+    pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+    print(format_report(profiler.write_report(profile_report, wall_seconds)))
+    logging.info('profile written to {} and {}'.format(profile_report, stats_file))
 
 
 @click.command()
@@ -240,24 +806,145 @@ def process(source_directory: str,
               help='Source directory of cities.csv and places365 PyTorch model')
 @click.option('--metadata_file', default='photos.csv', required=True,
               help='Filename for csv that has/will have images metadata')
+@click.option('--metadata_store', default='photos.db', required=True,
+              help='Filename for the sqlite metadata cache that photos.csv is exported from')
+@click.option('--embeddings_dir', default='embeddings', required=True, type=click.Path(),
+              help='Directory for the stored classifier output that --retokenize recomputes search tokens from')
+@click.option('--data_dir', default='data', required=True, type=click.Path(),
+              help='Directory for the per year, precompressed metadata shards the frontend loads')
 @click.option('--search_dictionary_file', default='search-dictionary.csv', required=False,
               help='Filename for csv that has/will have complete search dictionary')
 @click.option('--regenerate_metadata', is_flag=True, help='Refresh images metadata (aspect ratios, search etc)')
-@click.option('--regenerate_search', is_flag=True, help='Refresh search dictionary file from metadata')
+@click.option('--regenerate_search', is_flag=True, help='Refresh search dictionary file and the inverted search index in --data_dir from metadata')
+@click.option('--retokenize', is_flag=True,
+              help='Recompute image content search tokens from stored classifier output, without running the model')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of worker processes used to generate thumbnails and metadata')
+@click.option('--batch_size', default=16, type=click.IntRange(min=1),
+              help='Number of images classified together in one forward pass')
+@click.option('--max_pixels', default=DEFAULT_MAX_PIXELS, type=click.IntRange(min=1),
+              help='Largest decoded image size in pixels, bigger images are skipped and logged')
+@click.option('--thumbnail_sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+              help='Comma separated longest side, in pixels, of each thumbnail size written to thumbnail_dir/<size>/')
+@click.option('--thumbnail_formats', default=','.join(DEFAULT_FORMATS),
+              help='Comma separated thumbnail formats, any of jpeg, webp and avif')
+@click.option('--pipeline', is_flag=True,
+              help='Read, decode, classify and write at the same time in a pipeline of threads, instead of --workers')
+@click.option('--read_threads', default=PipelineSettings().read_threads, type=click.IntRange(min=1),
+              help='Threads reading and hashing files ahead of the decoders, with --pipeline')
+@click.option('--decode_threads', default=os.cpu_count() or 1, type=click.IntRange(min=1),
+              help='Threads decoding images and making thumbnails, with --pipeline')
+@click.option('--queue_depth', default=PipelineSettings().queue_depth, type=click.IntRange(min=1),
+              help='Most items waiting between two --pipeline stages, bounds the memory used')
+@click.option('--shard', default=None,
+              help='i/N, only process the photos in shard i (0 to N-1) of N, into a fragment of the metadata file')
+@click.option('--merge', default=None, type=click.IntRange(min=1),
+              help='Combine the fragments written by N --shard runs into the metadata file, data_dir and the search '
+                   'dictionary')
+@click.option('--gps_cache', default='gps-cache.json',
+              help='File the reverse geocoded locations are cached in between runs, empty to not cache them')
+@click.option('--gps_precision', default=DEFAULT_PRECISION, type=click.IntRange(1, 12),
+              help='Geohash length locations are cached at, coordinates are resolved at the centre of their cell')
+@click.option('--gps_cache_size', default=DEFAULT_MAX_ENTRIES, type=click.IntRange(min=1),
+              help='Most locations kept in --gps_cache, the least recently used are dropped')
+@click.option('--watch', is_flag=True,
+              help='Keep running, and process photos as they are added to source_dir with the models kept loaded')
+@click.option('--debounce', default=2.0, type=click.FloatRange(min=0),
+              help='Seconds without new files before --watch processes them, so a burst is one batch')
+@click.option('--poll_interval', default=5.0, type=click.FloatRange(min=0.1),
+              help='Seconds between scans of source_dir for --watch, when inotify_simple is not installed')
+@click.option('--profile', is_flag=True, help='Time every stage and print a summary, see --profile_report')
+@click.option('--profile_report', default='profile.json', type=click.Path(),
+              help='JSON file for the --profile timings')
+@click.option('--profile_file', default=None,
+              help='Profile just this file from source_dir with cProfile, writes a .prof next to --profile_report')
+@click.option('--profile_repeat', default=1, type=click.IntRange(min=1),
+              help='Number of times --profile_file is processed')
 def main(source_dir,
          thumbnail_dir,
          models_dir,
          metadata_file,
+         metadata_store,
+         embeddings_dir,
+         data_dir,
          search_dictionary_file,
          regenerate_metadata,
-         regenerate_search):
+         regenerate_search,
+         retokenize,
+         workers,
+         batch_size,
+         max_pixels,
+         thumbnail_sizes,
+         thumbnail_formats,
+         pipeline,
+         read_threads,
+         decode_threads,
+         queue_depth,
+         shard,
+         merge,
+         gps_cache,
+         gps_precision,
+         gps_cache_size,
+         watch,
+         debounce,
+         poll_interval,
+         profile,
+         profile_report,
+         profile_file,
+         profile_repeat):
 
-    if regenerate_metadata:
-        regenerate_metadata_csv(source_dir, models_dir, metadata_file)
+    try:
+        sizes = [int(s) for s in thumbnail_sizes.split(',') if len(s.strip()) > 0]
+    except ValueError:
+        raise click.BadParameter('{} is not a list of sizes'.format(thumbnail_sizes), param_hint='--thumbnail_sizes')
+    if any(s <= 0 for s in sizes):
+        raise click.BadParameter('sizes must be positive', param_hint='--thumbnail_sizes')
+    formats = [f.strip().lower() for f in thumbnail_formats.split(',') if len(f.strip()) > 0]
+    unsupported = [f for f in formats if f not in supported_formats()]
+    if len(unsupported) > 0:
+        raise click.BadParameter('{} not supported by this Pillow install'.format(', '.join(unsupported)),
+                                 param_hint='--thumbnail_formats')
+    pyramid = ThumbnailPyramid(sorted(set(sizes)), formats)
+    if pipeline and workers > 1:
+        raise click.BadParameter('use --decode_threads with --pipeline', param_hint='--workers')
+    if shard is not None:
+        if merge is not None:
+            raise click.BadParameter('merge once every --shard has finished', param_hint='--merge')
+        try:
+            shard = parse_shard(shard)
+        except ValueError as ex:
+            raise click.BadParameter(str(ex), param_hint='--shard')
+    if watch and (shard is not None or workers > 1):
+        raise click.BadParameter('--watch runs in one process, with --pipeline for more threads',
+                                 param_hint='--workers' if workers > 1 else '--shard')
+
+    gps_cache_settings = GpsCacheSettings(gps_cache, gps_precision, gps_cache_size) if len(gps_cache) > 0 else None
+
+    if profile_file is not None:
+        profile_single_file(source_dir, models_dir, profile_file, profile_repeat, max_pixels, pyramid, profile_report,
+                            gps_cache_settings)
+    elif regenerate_metadata:
+        regenerate_metadata_csv(source_dir, models_dir, metadata_file, metadata_store, embeddings_dir, data_dir,
+                                batch_size, max_pixels, gps_cache_settings)
     elif regenerate_search:
-        regenerate_search_dictionary(metadata_file, search_dictionary_file)
+        regenerate_search_dictionary(metadata_file, search_dictionary_file, data_dir)
+    elif retokenize:
+        retokenize_metadata(models_dir, metadata_file, metadata_store, embeddings_dir, data_dir)
+    elif merge is not None:
+        try:
+            merge_shards(metadata_file, search_dictionary_file, metadata_store, embeddings_dir, data_dir, merge)
+        except ValueError as ex:
+            raise click.ClickException(str(ex))
+    elif watch:
+        watch_directory(source_dir, thumbnail_dir, models_dir, metadata_file, metadata_store, embeddings_dir, data_dir,
+                        search_dictionary_file, batch_size, max_pixels, pyramid,
+                        PipelineSettings(read_threads, decode_threads, queue_depth) if pipeline else None, debounce,
+                        poll_interval=poll_interval, gps_cache=gps_cache_settings)
     else:
-        process(source_dir, thumbnail_dir, models_dir, metadata_file)
+        process(source_dir, thumbnail_dir, models_dir, metadata_file, metadata_store, embeddings_dir, data_dir,
+                workers, batch_size, max_pixels, pyramid, profile_report if profile else None,
+                PipelineSettings(read_threads, decode_threads, queue_depth) if pipeline else None, shard,
+                gps_cache_settings)
 
 if __name__ == '__main__':
     coloredlogs.install(level='INFO')
@@ -1,7 +1,16 @@
 function popImage(filename) {
+  // the largest thumbnail when there is one, it's a fraction of the original's size
+  var src = "img/" + filename;
+  if (/\.cr2$/i.test(filename)) {
+    // browsers can't show raw files, the 640 pixel thumbnail is the camera's preview
+    src = "thumbnail/" + filename;
+  }
+  if (pyramid && thumbnailFormat && pyramid.sizes.length > 0) {
+    src = pyramidUrl(filename, pyramid.sizes[pyramid.sizes.length - 1]);
+  }
   $.magnificPopup.open({
     items: {
-      src: "img/" + filename
+      src: src
     },
     type: 'image'
 
@@ -11,9 +20,76 @@ function popImage(filename) {
 }
 
 
+// thumbnail/pyramid.json lists the thumbnail sizes (longest side in pixels) and formats in
+// thumbnail/<size>/<filename>.<ext>. without it, or without a format the browser can show,
+// every image is the 640 pixel thumbnail/<filename>
+var pyramid = null;
+var thumbnailFormat = null;
+var aspectRatios = {};
+var formatExtensions = {jpeg: 'jpg', webp: 'webp', avif: 'avif'};
+var formatTests = {
+  avif: 'data:image/avif;base64,AAAAIGZ0eXBhdmlmAAAAAGF2aWZtaWYxbWlhZk1BMUIAAADrbWV0YQAAAAAAAAAhaGRscgAAAAAAAAAAcGljdAAAAAAAAAAAAAAAAAAAAAAOcGl0bQAAAAAAAQAAAB5pbG9jAAAAAEQAAAEAAQAAAAEAAAETAAAAJQAAAChpaW5mAAAAAAABAAAAGmluZmUCAAAAAAEAAGF2MDFDb2xvcgAAAABqaXBycAAAAEtpcGNvAAAAFGlzcGUAAAAAAAAAAQAAAAEAAAAQcGl4aQAAAAADCAgIAAAADGF2MUOBAAwAAAAAE2NvbHJuY2x4AAEADQAGgAAAABdpcG1hAAAAAAAAAAEAAQQBAoMEAAAALW1kYXQSAAoIGAAGiAhoNCAyFxTHh4ZlAgggnlAAAAD2b2M9SPG6ZHSs',
+  webp: 'data:image/webp;base64,UklGRiQAAABXRUJQVlA4IBgAAAAwAQCdASoBAAEAAUAmJaQAA3AA/vz0AAA=',
+};
+
+function canShow(format) {
+  if (!formatTests[format]) {
+    return Promise.resolve(format == 'jpeg');
+  }
+  return new Promise(function(resolve) {
+    var img = new Image();
+    img.onload = function() { resolve(img.width == 1); };
+    img.onerror = function() { resolve(false); };
+    img.src = formatTests[format];
+  });
+}
+
+function firstShowableFormat(formats) {
+  // formats are in order of preference
+  if (formats.length == 0) {
+    return Promise.resolve(null);
+  }
+  return canShow(formats[0]).then(function(ok) {
+    return ok ? formats[0] : firstShowableFormat(formats.slice(1));
+  });
+}
+
+var thumbnailsReady = new Promise(function(resolve) {
+  $.ajax({
+    type: 'GET',
+    url: 'thumbnail/pyramid.json',
+    dataType: 'json',
+    cache: false,
+    success: function(data) {
+      firstShowableFormat(data.formats).then(function(format) {
+        pyramid = data;
+        thumbnailFormat = format;
+        resolve();
+      });
+    },
+    error: function() { resolve(); },
+  });
+});
+
+function pyramidUrl(filename, size) {
+  return 'thumbnail/' + size + '/' + filename + '.' + formatExtensions[thumbnailFormat];
+}
+
 var options = {
   urlForSize: function(filename, size) {
-    return 'thumbnail/' + filename;
+    if (!pyramid || !thumbnailFormat || pyramid.sizes.length == 0) {
+      return 'thumbnail/' + filename;
+    }
+    // size is the tile height, thumbnail sizes are the longest side
+    var needed = size * Math.max(aspectRatios[filename] || 1, 1) * (window.devicePixelRatio || 1);
+    var chosen = pyramid.sizes[pyramid.sizes.length - 1];
+    for (var i=0; i<pyramid.sizes.length; i++) {
+      if (pyramid.sizes[i] >= needed) {
+        chosen = pyramid.sizes[i];
+        break;
+      }
+    }
+    return pyramidUrl(filename, chosen);
   },
   onClickHandler: function(filename) {
     popImage(filename);
@@ -26,25 +102,46 @@ var imageData = [];
 var searchTokens = {};
 var pig;
 
+// data/manifest.json lists the per year shards of photos.csv, newest year first.
+// when it's missing the whole of photos.csv is loaded like before
+var manifest = null;
+var shards = {};
+
+// data/search-index.json maps every token to its postings (sorted photos.csv row numbers, delta + varint
+// encoded) in one of the data/search-*.bin files, and to the number of photos that have it
+var searchIndex = null;
+var postingShards = {};
+
 function onlyUnique(value, index, self) {
   return self.indexOf(value) === index;
 }
 
+function parseLine(line) {
+  // "filename",aspect ratio,datetime,token;token
+  var end = line.lastIndexOf('",');
+  if (line[0] != '"' || end < 0) {
+    return line.split(',');
+  }
+  var filename = line.substring(1, end).replace(/""/g, '"');
+  return [filename].concat(line.substring(end + 2).split(','));
+}
+
 function processData(allText) {
   var allTextLines = allText.split(/\r\n|\n/);
   var imageData = [];
 
   for (var i=0; i<allTextLines.length; i++) {
-      var data = allTextLines[i].split(',');
-      var filename = data[0].replace("\"", "").replace("\"", "").replace('#', '%23')
+      if (allTextLines[i].length == 0) continue;
+      var data = parseLine(allTextLines[i]);
+      var filename = data[0].replace('#', '%23')
       var tokens = []
-      if (data.length == 4) {
+      if (data.length == 4 && data[3].length > 0) {
         tokens = data[3].split(';')
       }
+      aspectRatios[filename] = parseFloat(data[1]);
       imageData.push({filename: filename, aspectRatio: data[1], datetime: data[2], searchTokens: tokens})
   }
 
-  searchTokens = [...new Set(searchTokens)]
   return imageData
 }
 
@@ -59,11 +156,55 @@ function processSearchTokens(allText) {
   return tokens;
 }
 
+function loadShard(entry) {
+  if (!shards[entry.year]) {
+    shards[entry.year] = $.ajax({
+      type: 'GET',
+      url: 'data/' + entry.shard,
+      dataType: 'text',
+    }).then(function(data) {
+      return processData(data);
+    });
+  }
+  return shards[entry.year];
+}
+
+function loadAllImages() {
+  // every shard, concatenated in photos.csv order
+  if (!manifest) {
+    return $.Deferred().resolve(imageData).promise();
+  }
+  var requests = manifest.years.map(loadShard);
+  return $.when.apply($, requests).then(function() {
+    var images = [];
+    for (var i=0; i<arguments.length; i++) {
+      images = images.concat(arguments[i]);
+    }
+    return images;
+  });
+}
+
+function display(images) {
+  thumbnailsReady.then(function() {
+    // remove old images
+    if (pig) pig.disable()
+    $("#pig").empty()
+    $("#pig").empty()
+
+    pig = new Pig(images, options).enable();
+  });
+}
+
 function showImages(year) {
-  // remove old images
-  if (pig) pig.disable()
-  $("#pig").empty()
-  $("#pig").empty()
+  if (manifest) {
+    var entry = manifest.years.find(function(e) { return e.year == year; });
+    if (!entry) {
+      display([]);
+      return;
+    }
+    loadShard(entry).then(display);
+    return;
+  }
 
   images = imageData;
   if (year) {
@@ -75,66 +216,142 @@ function showImages(year) {
     }
   }
 
-  pig = new Pig(images, options).enable();
+  display(images);
 }
 
-function showImagesSearch(searchToken) {
-  // remove old images
-  if (pig) pig.disable()
-  $("#pig").empty()
-  $("#pig").empty()
-
-  images = imageData;
-  images = []
-  for (var i=0; i<imageData.length; i++) {
-    if (imageData[i].searchTokens.includes(searchToken)) {
-      images.push(imageData[i]);
+function decodePostings(bytes, offset, length) {
+  var ids = [];
+  var value = 0, shift = 0, last = 0;
+  for (var i=offset; i<offset + length; i++) {
+    value += (bytes[i] & 0x7f) * Math.pow(2, shift);
+    if (bytes[i] & 0x80) {
+      shift += 7;
+    } else {
+      last += value;
+      ids.push(last);
+      value = 0;
+      shift = 0;
     }
   }
-  pig = new Pig(images, options).enable();
+  return ids;
 }
 
-var years = []
-var searchTokens = []
-var output = []
+function loadPostings(token) {
+  var entry = searchIndex.tokens[token];
+  if (!entry) {
+    return Promise.resolve([]);
+  }
+  var shard = searchIndex.shards[entry[0]];
+  if (!postingShards[shard]) {
+    postingShards[shard] = fetch('data/' + shard).then(function(response) {
+      if (!response.ok) throw new Error(response.statusText);
+      return response.arrayBuffer();
+    }).then(function(buffer) {
+      return new Uint8Array(buffer);
+    });
+  }
+  return postingShards[shard].then(function(bytes) {
+    return decodePostings(bytes, entry[1], entry[2]);
+  });
+}
 
-$.ajax({
-    type: 'GET',
-    url: 'photos.csv',
-    contentType: 'csv',
-    cache: false,
-    processData: false,
-    async: false,
-    success: function(data) {
-      imageData = processData(data)
-      // figure out the years
-      var dates = []
-      var years = []
-      for (var i=0; i<imageData.length; i++) {
-        d = new Date(Date.parse(imageData[i].datetime));
-        dates.push(d);
-        years.push(d.getFullYear());
-      }
+function imagesForIds(ids) {
+  // ids are photos.csv rows, sorted, so only the year shards they fall into have to be loaded
+  var requests = [];
+  var n = 0;
+  manifest.years.forEach(function(entry) {
+    var selected = [];
+    while (n < ids.length && ids[n] < entry.offset + entry.count) {
+      selected.push(ids[n] - entry.offset);
+      n++;
+    }
+    if (selected.length > 0) {
+      requests.push(Promise.resolve(loadShard(entry)).then(function(rows) {
+        return selected.map(function(i) { return rows[i]; });
+      }));
+    }
+  });
+  return Promise.all(requests).then(function(parts) {
+    return [].concat.apply([], parts);
+  });
+}
+
+function showImagesSearch(searchToken) {
+  // the index is only usable when it was built from the same photos.csv the shards were, the same photos in the
+  // same order with the same tokens, not just as many of them
+  if (searchIndex && manifest && searchIndex.version && searchIndex.version == manifest.version) {
+    loadPostings(searchToken).then(imagesForIds).then(display, function() {
+      searchAllImages(searchToken);
+    });
+    return;
+  }
+  searchAllImages(searchToken);
+}
 
-      var flags = [], output = []
-      for(var i=0; i<years.length; i++) {
-        if( flags[years[i]]) continue;
-        flags[years[i]] = true;
-        output.push(years[i]);
+function searchAllImages(searchToken) {
+  loadAllImages().then(function(allImages) {
+    var images = []
+    for (var i=0; i<allImages.length; i++) {
+      if (allImages[i].searchTokens.includes(searchToken)) {
+        images.push(allImages[i]);
       }
+    }
+    display(images);
+  });
+}
 
+function showYears(years) {
+  p = $("#header-p")
+  for (var i=0; i<years.length; i++) {
+    if (!isNaN(years[i])) {
+      var text = "<span><a style=\"font-size: 20px\" href=\"javascript:showImages(" + years[i] + ");\">" + years[i] + "</a>&nbsp;&nbsp;</span>";
+      p.append(text)
+    }
+  }
+}
 
-      p = $("#header-p")
-      for (var i=0; i<output.length; i++) {
-        if (!isNaN(output[i])) {
-          var text = "<span><a style=\"font-size: 20px\" href=\"javascript:showImages(" + output[i] + ");\">" + output[i] + "</a>&nbsp;&nbsp;</span>";
-          p.append(text)
+function loadPhotosCsv() {
+  $.ajax({
+      type: 'GET',
+      url: 'photos.csv',
+      contentType: 'csv',
+      cache: false,
+      processData: false,
+      success: function(data) {
+        imageData = processData(data)
+        // figure out the years
+        var years = []
+        for (var i=0; i<imageData.length; i++) {
+          d = new Date(Date.parse(imageData[i].datetime));
+          years.push(d.getFullYear());
         }
-      }
 
+        var flags = [], output = []
+        for(var i=0; i<years.length; i++) {
+          if( flags[years[i]]) continue;
+          flags[years[i]] = true;
+          output.push(years[i]);
+        }
+
+        showYears(output);
+        d = new Date();
+        showImages(d.getFullYear());
+      },
+  });
+}
+
+$.ajax({
+    type: 'GET',
+    url: 'data/manifest.json',
+    dataType: 'json',
+    cache: false,
+    success: function(data) {
+      manifest = data;
+      showYears(manifest.years.map(function(e) { return e.year; }));
       d = new Date();
       showImages(d.getFullYear());
     },
+    error: loadPhotosCsv,
 });
 
 $.ajax({
@@ -143,11 +360,30 @@ $.ajax({
     contentType: 'csv',
     cache: false,
     processData: false,
-    async: false,
     success: function(data) {
       tokens = processSearchTokens(data);
 
-      $('#search').autocomplete({source: tokens});
+      if (!searchIndex) {
+        $('#search').autocomplete({source: tokens});
+      }
+    },
+});
+
+function autocompleteByPopularity(request, response) {
+  // matching tokens, the ones most photos have first
+  var matches = $.ui.autocomplete.filter(Object.keys(searchIndex.tokens), request.term);
+  matches.sort(function(a, b) { return searchIndex.tokens[b][3] - searchIndex.tokens[a][3]; });
+  response(matches.slice(0, 50));
+}
+
+$.ajax({
+    type: 'GET',
+    url: 'data/search-index.json',
+    dataType: 'json',
+    cache: false,
+    success: function(data) {
+      searchIndex = data;
+      $('#search').autocomplete({source: autocompleteByPopularity});
     },
 });
 
@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import fcntl
+import shutil
+import itertools
+import concurrent.futures
+from typing import List, Tuple, Dict, Callable, NamedTuple, Optional
+
+# linux ioctl to share the source's extents (btrfs, xfs, ...), from linux/fs.h
+FICLONE = 0x40049409
+CHUNK_SIZE = 8 * 1024 * 1024
+# copies queued per thread, enough to keep every thread busy
+QUEUED_PER_THREAD = 2
+
+
+class CopyJob(NamedTuple):
+    source: str
+    destination: str
+    size: int
+    mtime: float
+
+
+def copy_data(source, destination, size: int) -> str:
+    # returns how the data got copied, fastest method the filesystem supports first
+    try:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        return 'reflink'
+    except OSError:
+        pass
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copied = 0
+            while copied < size:
+                n = os.copy_file_range(source.fileno(), destination.fileno(), CHUNK_SIZE)
+                if n == 0:
+                    break
+                copied += n
+            if copied >= size:
+                return 'copy_file_range'
+        except OSError:
+            pass
+        # it failed (e.g. EXDEV on older kernels) or stopped short, start over with a plain copy
+        source.seek(0)
+        destination.seek(0)
+        destination.truncate()
+
+    shutil.copyfileobj(source, destination, CHUNK_SIZE)
+    return 'copy'
+
+
+def copy_file(job: CopyJob) -> str:
+    # copies to a hidden temporary name first, so an interrupted copy never looks like a finished file
+    directory, name = os.path.split(job.destination)
+    temporary = os.path.join(directory, '.' + name + '.part')
+    try:
+        with open(job.source, 'rb') as source, open(temporary, 'wb') as destination:
+            method = copy_data(source, destination, job.size)
+            # e.g. the source was truncated while it was being copied
+            copied = os.fstat(destination.fileno()).st_size
+            if copied != job.size:
+                raise OSError('copied {} of {} bytes'.format(copied, job.size))
+        shutil.copystat(job.source, temporary)
+        os.replace(temporary, job.destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return method
+
+
+class CopyJournal():
+    # append only record of finished copies, so an interrupted import can be resumed without rechecking them
+    def __init__(self, journal_filename: str):
+        self.journal_filename = journal_filename
+        self.done: Dict[Tuple[str, int, float], str] = {}
+        if os.path.exists(journal_filename):
+            with open(journal_filename, 'r') as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) == 5 and fields[0] == 'done':
+                        self.done[(fields[1], int(fields[2]), float(fields[3]))] = fields[4]
+        self.file = open(journal_filename, 'a')
+
+    def is_done(self, source: str, size: int, mtime: float) -> Optional[str]:
+        # destination of an earlier finished copy of this exact source file, if it's still there
+        destination = self.done.get((source, size, mtime))
+        if destination is not None and os.path.exists(destination) and os.path.getsize(destination) == size:
+            return destination
+        return None
+
+    def record(self, job: CopyJob) -> None:
+        self.done[(job.source, job.size, job.mtime)] = job.destination
+        self.file.write('done\t{}\t{}\t{!r}\t{}\n'.format(job.source, job.size, job.mtime, job.destination))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, finished: bool = False) -> None:
+        # a run that finished everything doesn't need its journal anymore
+        self.file.close()
+        if finished and os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+
+
+def format_size(size: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
+
+
+def run_copies(jobs: List[CopyJob],
+               threads: int,
+               journal: CopyJournal,
+               on_copied: Callable[[CopyJob, str], None]) -> List[Tuple[CopyJob, Exception]]:
+    # copies with a bounded pool of threads, calling on_copied (on this thread) as each copy finishes.
+    # only a few jobs per thread are queued at a time, so on ctrl-c the copies already running finish (and are
+    # journaled) and nothing else starts. returns the jobs that failed
+    total_bytes = sum(j.size for j in jobs)
+    copied_files, copied_bytes = 0, 0
+    failures: List[Tuple[CopyJob, Exception]] = []
+    start = time.time()
+    last_report = start
+    remaining = iter(jobs)
+    pending: Dict[concurrent.futures.Future, CopyJob] = {}
+
+    def finished(future: concurrent.futures.Future) -> None:
+        nonlocal copied_files, copied_bytes, last_report
+        job = pending.pop(future)
+        try:
+            method = future.result()
+        except Exception as ex:
+            print('failed to copy {} to {}: {}'.format(job.source, job.destination, ex))
+            failures.append((job, ex))
+            return
+
+        journal.record(job)
+        on_copied(job, method)
+        copied_files += 1
+        copied_bytes += job.size
+
+        now = time.time()
+        if now - last_report >= 1.0 or copied_files == len(jobs):
+            last_report = now
+            print('copied {}/{} files, {} of {}, {}/s'
+                  .format(copied_files, len(jobs), format_size(copied_bytes), format_size(total_bytes),
+                          format_size(copied_bytes / max(now - start, 1e-6))))
+            sys.stdout.flush()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        def submit() -> None:
+            for job in itertools.islice(remaining, threads * QUEUED_PER_THREAD - len(pending)):
+                pending[executor.submit(copy_file, job)] = job
+
+        submit()
+        try:
+            while len(pending) > 0:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finished(future)
+                submit()
+        except KeyboardInterrupt:
+            print('interrupted, waiting for the copies already running')
+            for future in list(pending):
+                if future.cancel():
+                    del pending[future]
+            for future in concurrent.futures.as_completed(list(pending)):
+                finished(future)
+            raise
+
+    return failures
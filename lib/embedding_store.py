@@ -0,0 +1,110 @@
+import os
+import json
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+
+
+class EmbeddingStore():
+    # classifier output kept per photo so search tokens can be recomputed without running the CNN again.
+    # vectors.f16 is an append only float16 matrix, one row of [logits, avgpool features] per content hash.
+    # index.csv maps rows to content hash and filename, a row is only indexed once it is fully written.
+    # an interrupted append can leave a partial row in vectors.f16 or a partial line in index.csv, both are cut
+    # off before the next append so rows stay aligned with the index
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.vectors_filename = os.path.join(directory, 'vectors.f16')
+        self.index_filename = os.path.join(directory, 'index.csv')
+        self.header_filename = os.path.join(directory, 'embeddings.json')
+        self.logits_dim = 0
+        self.features_dim = 0
+        self.rows: Dict[str, int] = {}
+        self.filenames: Dict[str, str] = {}
+        # rows and bytes of index.csv up to its last complete line
+        self.indexed_rows = 0
+        self.index_size = 0
+
+        if os.path.exists(self.header_filename):
+            with open(self.header_filename, 'r') as f:
+                header = json.load(f)
+            self.logits_dim = header['logits_dim']
+            self.features_dim = header['features_dim']
+
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    row, content_hash, filename = line.decode('utf-8').rstrip('\n').split(',', 2)
+                    self.rows[content_hash] = int(row)
+                    self.filenames[content_hash] = filename
+                    self.indexed_rows = max(self.indexed_rows, int(row) + 1)
+                    self.index_size += len(line)
+
+    @property
+    def dim(self) -> int:
+        return self.logits_dim + self.features_dim
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __contains__(self, content_hash: str) -> bool:
+        return content_hash in self.rows
+
+    def row_count(self) -> int:
+        if self.dim == 0 or not os.path.exists(self.vectors_filename):
+            return 0
+        return min(os.path.getsize(self.vectors_filename) // (self.dim * 2), self.indexed_rows)
+
+    def append(self, entries: List[Tuple[str, str]], logits: np.ndarray, features: np.ndarray) -> None:
+        # entries are (content hash, filename) for each row of logits and features
+        new = []
+        seen = set(self.rows)
+        for i, (content_hash, _) in enumerate(entries):
+            if content_hash not in seen:
+                seen.add(content_hash)
+                new.append(i)
+        if len(new) == 0:
+            return
+
+        if self.dim == 0:
+            os.makedirs(self.directory, exist_ok=True)
+            self.logits_dim = logits.shape[1]
+            self.features_dim = features.shape[1]
+            with open(self.header_filename, 'w') as f:
+                json.dump({'logits_dim': self.logits_dim, 'features_dim': self.features_dim}, f)
+
+        vectors = np.hstack((logits[new], features[new])).astype(np.float16)
+        # new rows go right after the last indexed one, whatever an interrupted append left past it is cut off
+        first_row = self.indexed_rows
+        with open(self.vectors_filename, 'ab') as f:
+            f.truncate(first_row * self.dim * 2)
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        lines = []
+        for n, i in enumerate(new):
+            content_hash, filename = entries[i]
+            self.rows[content_hash] = first_row + n
+            self.filenames[content_hash] = filename
+            lines.append('{},{},{}\n'.format(first_row + n, content_hash, filename).encode('utf-8'))
+        with open(self.index_filename, 'ab') as f:
+            f.truncate(self.index_size)
+            f.write(b''.join(lines))
+        self.indexed_rows = first_row + len(new)
+        self.index_size += sum(len(line) for line in lines)
+
+    def vectors(self) -> Optional[np.memmap]:
+        count = self.row_count()
+        if count == 0:
+            return None
+        return np.memmap(self.vectors_filename, dtype=np.float16, mode='r', shape=(count, self.dim))
+
+    def get_many(self, content_hashes: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        # logits and features (as float32) for content hashes that are in the store
+        vectors = self.vectors()
+        rows = [self.rows[h] for h in content_hashes]
+        if vectors is None or len(rows) == 0:
+            return (np.zeros((0, self.logits_dim), dtype=np.float32), np.zeros((0, self.features_dim), dtype=np.float32))
+        selected = np.asarray(vectors[rows], dtype=np.float32)
+        return (selected[:, :self.logits_dim], selected[:, self.logits_dim:])
@@ -0,0 +1,86 @@
+import os
+import json
+import gzip
+import hashlib
+import datetime as dt
+from typing import Dict, List, Tuple, Iterable, Any
+from lib.metadata_csv import format_row
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the frontend loads data/manifest.json, then only the shards it needs. shard names carry a hash of
+# their content so they can be cached forever, the manifest is the only file that has to be revalidated
+MANIFEST_FILENAME = 'manifest.json'
+SHARD_PREFIX = 'photos-'
+
+
+def rows_version() -> 'hashlib.blake2b':
+    # hash of the formatted rows of photos.csv. the manifest and the search index both carry it, the frontend
+    # only uses an index built from the same rows (same photos, same order, same tokens) as the shards
+    return hashlib.blake2b(digest_size=8)
+
+
+def write_file(filename: str, data: bytes) -> None:
+    # write-temp-then-rename, a half written file is never served
+    temporary = filename + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, filename)
+
+
+def write_compressed(filename: str, data: bytes) -> List[str]:
+    # the file plus precompressed .gz (and .br when brotli is installed) copies, returns every filename written
+    written = [filename, filename + '.gz']
+    write_file(filename, data)
+    write_file(filename + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        write_file(filename + '.br', brotli.compress(data, quality=11))
+        written.append(filename + '.br')
+    return written
+
+
+def export_year_shards(rows: Iterable[Tuple[str, str, dt.datetime, str]], data_directory: str) -> Dict[str, Any]:
+    # rows in photos.csv order (newest first), so every year is one contiguous run of rows.
+    # the manifest lists years newest first with their count, offset into photos.csv and shard filename
+    os.makedirs(data_directory, exist_ok=True)
+    years: List[Dict[str, Any]] = []
+    lines: List[str] = []
+    year = None
+    offset = 0
+    written = set()
+    version = rows_version()
+
+    def flush() -> None:
+        if year is None:
+            return
+        data = ''.join(lines).encode('utf-8')
+        shard = '{}{}.{}.csv'.format(SHARD_PREFIX, year, hashlib.blake2b(data, digest_size=6).hexdigest())
+        if not os.path.exists(os.path.join(data_directory, shard + '.gz')):
+            written.update(write_compressed(os.path.join(data_directory, shard), data))
+        else:
+            written.update(os.path.join(data_directory, shard + e) for e in ['', '.gz', '.br'])
+        years.append({'year': year, 'count': len(lines), 'offset': offset, 'shard': shard})
+
+    for filename, aspect_ratio, created_date, tokens in rows:
+        if created_date.year != year:
+            flush()
+            offset += len(lines)
+            year = created_date.year
+            lines = []
+        lines.append(format_row(filename, aspect_ratio, created_date, tokens))
+        version.update(lines[-1].encode('utf-8'))
+    flush()
+
+    manifest = {'total': offset + len(lines), 'version': version.hexdigest(), 'years': years}
+    write_file(os.path.join(data_directory, MANIFEST_FILENAME), json.dumps(manifest, indent=1).encode('utf-8'))
+
+    # shards from earlier exports are no longer referenced
+    for f in os.listdir(data_directory):
+        path = os.path.join(data_directory, f)
+        if f.startswith(SHARD_PREFIX) and path not in written:
+            os.remove(path)
+
+    return manifest
@@ -0,0 +1,154 @@
+import os
+import json
+import math
+import time
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+# reverse geocoding memoized by geohash cell. a coordinate is always resolved at the centre of its cell, cached
+# or not, so the tokens only depend on the cell and a hit returns exactly what the lookup would have.
+# cells are about 150m across at precision 7, 1km at 6 and 5km at 5
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+DEFAULT_PRECISION = 7
+DEFAULT_MAX_ENTRIES = 100000
+
+
+class GpsCacheSettings(NamedTuple):
+    filename: Optional[str]
+    precision: int = DEFAULT_PRECISION
+    max_entries: int = DEFAULT_MAX_ENTRIES
+
+
+def geohash(latitude: float, longitude: float, precision: int) -> str:
+    # bits alternate between longitude and latitude, starting with longitude, 5 bits per character
+    ranges = [[-180.0, 180.0], [-90.0, 90.0]]
+    values = [longitude, latitude]
+    chars = []
+    bit = 0
+    for _ in range(precision):
+        c = 0
+        for _ in range(5):
+            r = ranges[bit % 2]
+            middle = (r[0] + r[1]) / 2
+            c <<= 1
+            if values[bit % 2] >= middle:
+                c |= 1
+                r[0] = middle
+            else:
+                r[1] = middle
+            bit += 1
+        chars.append(BASE32[c])
+    return ''.join(chars)
+
+
+def geohash_centre(cell: str) -> Tuple[float, float]:
+    # (latitude, longitude) of the middle of the cell
+    ranges = [[-180.0, 180.0], [-90.0, 90.0]]
+    bit = 0
+    for ch in cell:
+        c = BASE32.index(ch)
+        for shift in range(4, -1, -1):
+            r = ranges[bit % 2]
+            middle = (r[0] + r[1]) / 2
+            if (c >> shift) & 1:
+                r[0] = middle
+            else:
+                r[1] = middle
+            bit += 1
+    return ((ranges[1][0] + ranges[1][1]) / 2, (ranges[0][0] + ranges[0][1]) / 2)
+
+
+class CachedResolver():
+    # in front of a LatLongResolver, with the same nearest/nearest_many. the least recently used cells are dropped
+    # past max_entries. save() merges with whatever other processes saved in the meantime, so --workers can share
+    # the file, and maybe_save() saves at most every save_interval seconds
+    def __init__(self, resolver, settings: GpsCacheSettings, save_interval: float = 30.0):
+        self.resolver = resolver
+        self.settings = settings
+        self.save_interval = save_interval
+        self.cells: 'OrderedDict[str, List[str]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.saved = time.monotonic()
+        # cached tokens are only valid for the cities.csv they were resolved with
+        stat = os.stat(resolver.cities_filename)
+        self.cities = '{}:{}'.format(stat.st_size, stat.st_mtime)
+        self.cells.update(self.load())
+        self.evict()
+
+    def load(self) -> Dict[str, List[str]]:
+        # least recently used first
+        if self.settings.filename is None or not os.path.exists(self.settings.filename):
+            return OrderedDict()
+        try:
+            with open(self.settings.filename, 'r') as f:
+                cache = json.load(f)
+        except ValueError as ex:
+            logging.warning('ignoring {}: {}'.format(self.settings.filename, ex))
+            return OrderedDict()
+        if cache.get('precision') != self.settings.precision or cache.get('cities') != self.cities:
+            return OrderedDict()
+        return OrderedDict((cell, tokens) for cell, tokens in cache['cells'])
+
+    def evict(self) -> None:
+        while len(self.cells) > self.settings.max_entries:
+            self.cells.popitem(last=False)
+
+    def nearest(self, latitude: float, longitude: float) -> Optional[List[str]]:
+        return self.nearest_many([latitude], [longitude])[0]
+
+    def nearest_many(self, latitudes: Sequence[float], longitudes: Sequence[float]) -> List[Optional[List[str]]]:
+        # None for points that aren't finite, geohash() would put them in a real looking cell
+        located = [i for i, (lat, lon) in enumerate(zip(latitudes, longitudes))
+                   if math.isfinite(lat) and math.isfinite(lon)]
+        cells = [geohash(latitudes[i], longitudes[i], self.settings.precision) for i in located]
+        missing = [c for c in dict.fromkeys(cells) if c not in self.cells]
+        if len(missing) > 0:
+            centres = [geohash_centre(c) for c in missing]
+            tokens = self.resolver.nearest_many([c[0] for c in centres], [c[1] for c in centres])
+            self.cells.update(zip(missing, tokens))
+            self.dirty = True
+
+        result: List[Optional[List[str]]] = [None] * len(latitudes)
+        for i, c in zip(located, cells):
+            self.cells.move_to_end(c)
+            result[i] = list(self.cells[c])
+        self.misses += len(missing)
+        self.hits += len(cells) - len(missing)
+        self.evict()
+        return result
+
+    def save(self) -> None:
+        if self.settings.filename is None or not self.dirty:
+            return
+        # cells only another process resolved go in as the least recently used
+        cells = OrderedDict((c, t) for c, t in self.load().items() if c not in self.cells)
+        cells.update(self.cells)
+        while len(cells) > self.settings.max_entries:
+            cells.popitem(last=False)
+        data = json.dumps({'precision': self.settings.precision, 'cities': self.cities,
+                           'cells': list(cells.items())}).encode('utf-8')
+        # a temporary file of its own, other workers and --shard machines may be saving at the same time
+        try:
+            fd, temporary = tempfile.mkstemp(suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(self.settings.filename)))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, self.settings.filename)
+        except OSError as ex:
+            logging.warning('unable to save {}: {}'.format(self.settings.filename, ex))
+            return
+        self.dirty = False
+        self.saved = time.monotonic()
+
+    def maybe_save(self) -> None:
+        if time.monotonic() - self.saved >= self.save_interval:
+            self.save()
+
+    def __str__(self) -> str:
+        lookups = max(self.hits + self.misses, 1)
+        return 'gps cache: {} hits, {} misses ({:.0f}% hit rate), {} cells'.format(
+            self.hits, self.misses, self.hits * 100 / lookups, len(self.cells))
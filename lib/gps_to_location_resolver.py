@@ -1,47 +1,114 @@
-import requests
 import sys
 import os
 import logging
 import coloredlogs
 import zipfile
-import pandas as pd
+import numpy as np
 import shutil
-from scipy import spatial
-from typing import List
+from typing import List, Optional, Sequence
+
+# population bands of the small, medium and large city trees
+TIERS = [(5000, 20000), (20000, 1000000), (1000000, 10000000)]
+
+
+class StringTable():
+    # interned strings as one utf-8 blob plus offsets, both memory mappable
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    @staticmethod
+    def save(directory: str, name: str, strings: Sequence[str]) -> None:
+        encoded = [s.encode('utf-8') for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        np.save(os.path.join(directory, name + '_blob.npy'), np.frombuffer(b''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(directory, name + '_offsets.npy'), offsets)
+
+    @staticmethod
+    def load(directory: str, name: str) -> 'StringTable':
+        return StringTable(np.load(os.path.join(directory, name + '_blob.npy'), mmap_mode='r'),
+                           np.load(os.path.join(directory, name + '_offsets.npy'), mmap_mode='r'))
+
+
+def cities_index_directory(cities_model_filename: str) -> str:
+    return os.path.splitext(cities_model_filename)[0] + '.index'
+
+
+def build_cities_index(cities_model_filename: str, index_directory: str) -> None:
+    # binary form of cities.csv: unit sphere coordinates ordered by tier (tier i is rows offsets[i]:offsets[i+1]),
+    # and city/country ids into interned string tables. everything is a .npy so it can be np.load'ed with mmap
+    import pandas as pd
+
+    logging.info('building {}'.format(index_directory))
+    cities = pd.read_csv(cities_model_filename)
+    tiers = [cities[(cities.population >= low) & (cities.population < high)] for low, high in TIERS]
+    cities = pd.concat(tiers)
+
+    city_ids, city_names = pd.factorize(cities.asciiname)
+    country_ids, country_names = pd.factorize(cities.Country)
+
+    tmp_directory = index_directory + '.tmp'
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    np.save(os.path.join(tmp_directory, 'points.npy'),
+            to_unit_vectors(cities.latitude.values, cities.longitude.values))
+    np.save(os.path.join(tmp_directory, 'tier_offsets.npy'), np.cumsum([0] + [len(t) for t in tiers]))
+    np.save(os.path.join(tmp_directory, 'city_ids.npy'), city_ids.astype(np.int32))
+    np.save(os.path.join(tmp_directory, 'country_ids.npy'), country_ids.astype(np.int32))
+    StringTable.save(tmp_directory, 'city_names', [str(c) for c in city_names])
+    StringTable.save(tmp_directory, 'country_names', [str(c) for c in country_names])
+
+    shutil.rmtree(index_directory, ignore_errors=True)
+    os.rename(tmp_directory, index_directory)
+
+
+def prepare_cities_index(cities_model_filename: str) -> str:
+    # makes sure cities.csv and an up to date binary index of it exist, returns the index directory
+    if not os.path.exists(cities_model_filename):
+        LatLongResolver.build_cities_dataset(cities_model_filename)
+
+    index_directory = cities_index_directory(cities_model_filename)
+    tier_offsets = os.path.join(index_directory, 'tier_offsets.npy')
+    if not os.path.exists(tier_offsets) or os.path.getmtime(tier_offsets) < os.path.getmtime(cities_model_filename):
+        build_cities_index(cities_model_filename, index_directory)
+    return index_directory
+
 
 class LatLongResolver():
     def __init__(self, cities_model_filename: str):
-        if not os.path.exists(cities_model_filename):
-            self.build_cities_dataset(cities_model_filename)
         self.cities_filename = cities_model_filename
-        self.pd = pd.read_csv(self.cities_filename)
+        self.index_directory = prepare_cities_index(cities_model_filename)
         self.init()
 
     def init(self):
-        # build several trees based on population
-        self.psmall = self.pd[(self.pd.population >= 5000) & (self.pd.population < 20000)]
-        self.pmedium = self.pd[(self.pd.population >= 20000) & (self.pd.population < 1000000)]
-        self.plarge = self.pd[(self.pd.population >= 1000000) & (self.pd.population < 10000000)]
-
-        self.t5000 = spatial.KDTree(list(zip(self.psmall.latitude,
-                                             self.psmall.longitude)))
-
-        self.t6000 = spatial.KDTree(list(zip(self.pmedium.latitude,
-                                             self.pmedium.longitude)))
-
-        self.t7000 = spatial.KDTree(list(zip(self.plarge.latitude,
-                                             self.plarge.longitude)))
-
-    def nearest_helper(self, dataset: pd.DataFrame, tree: spatial.KDTree, latitude: float, longitude: float) -> List[str]:
-        distance, index = tree.query([(latitude, longitude)])
-        result = dataset.iloc[index]
-        country = result.Country.item()
-        city = result.asciiname.item()
-        latitude = result.latitude.item()
-        longitude = result.longitude.item()
-        return [city, country]
-
-    def build_cities_dataset(self, model_filename: str) -> pd.DataFrame:
+        # the arrays are memory mapped, so they are shared between every process using the same index
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(self.index_directory, name + '.npy'), mmap_mode='r')
+
+        self.points = load('points')
+        self.tier_offsets = load('tier_offsets')
+        self.city_ids = load('city_ids')
+        self.country_ids = load('country_ids')
+        self.city_names = StringTable.load(self.index_directory, 'city_names')
+        self.country_names = StringTable.load(self.index_directory, 'country_names')
+
+        from scipy import spatial
+
+        # trees are built on 3d points on the unit sphere, so euclidean nearest is great circle nearest
+        # and there's no seam at the antimeridian or pinch at the poles
+        self.trees = [spatial.cKDTree(self.points[self.tier_offsets[i]:self.tier_offsets[i + 1]])
+                      for i in range(len(TIERS))]
+        self.t5000, self.t6000, self.t7000 = self.trees
+
+    @staticmethod
+    def build_cities_dataset(model_filename: str) -> 'pd.DataFrame':
+        import pandas as pd
+        import requests
+
         if os.path.exists(model_filename):
             return pd.read_csv(model_filename)
 
@@ -88,13 +155,44 @@ class LatLongResolver():
 
         return result
 
-    def nearest(self, latitude: float, longitude: float) -> List[str]:
-        result = [self.nearest_helper(self.psmall, self.t5000, latitude, longitude),
-                  self.nearest_helper(self.pmedium, self.t6000, latitude, longitude),
-                  self.nearest_helper(self.plarge, self.t7000, latitude, longitude)]
+    def nearest(self, latitude: float, longitude: float) -> Optional[List[str]]:
+        return self.nearest_many([latitude], [longitude])[0]
+
+    def nearest_many(self, latitudes: Sequence[float], longitudes: Sequence[float]) -> List[Optional[List[str]]]:
+        # [city, country] of the nearest small, medium and large city for every point, deduplicated. None for
+        # points that aren't finite, the trees refuse the whole query over one of them
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        finite = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+        result: List[Optional[List[str]]] = [None] * len(latitudes)
+        if len(finite) == 0:
+            return result
+        points = to_unit_vectors(latitudes[finite], longitudes[finite])
+
+        tier_results = []
+        for tree, offset in zip(self.trees, self.tier_offsets):
+            distance, index = tree.query(points)
+            tier_results.append((self.city_ids[offset + index], self.country_ids[offset + index]))
+
+        for n, i in enumerate(finite):
+            flat_list = []
+            for cities, countries in tier_results:
+                # ids of -1 are cities.csv rows with a missing name
+                if cities[n] >= 0:
+                    flat_list.append(self.city_names[cities[n]])
+                if countries[n] >= 0:
+                    flat_list.append(self.country_names[countries[n]])
+            result[i] = list(dict.fromkeys(flat_list))
+        return result
+
 
-        flat_list = [item for sublist in result for item in sublist]
-        return list(set(flat_list))
+def to_unit_vectors(latitudes: Sequence[float], longitudes: Sequence[float]) -> np.ndarray:
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_latitudes = np.cos(latitudes)
+    return np.column_stack((cos_latitudes * np.cos(longitudes),
+                            cos_latitudes * np.sin(longitudes),
+                            np.sin(latitudes)))
 
 
 coloredlogs.install(level='INFO')
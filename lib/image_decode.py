@@ -0,0 +1,54 @@
+import logging
+from typing import Tuple
+from PIL import Image
+
+# largest decode we allow per image, ~192MB of RGB. anything bigger after draft mode is refused
+DEFAULT_MAX_PIXELS = 64 * 1000 * 1000
+
+# same default as Image.thumbnail, decode to at least twice the size we need and antialias the rest
+REDUCING_GAP = 2.0
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+def fit_size(image_size: Tuple[int, int], max_size: Tuple[int, int]) -> Tuple[int, int]:
+    # the size Image.thumbnail would produce for max_size
+    x, y = image_size
+    if x > max_size[0]:
+        y = max(round(y * max_size[0] / x), 1)
+        x = max_size[0]
+    if y > max_size[1]:
+        x = max(round(x * max_size[1] / y), 1)
+        y = max_size[1]
+    return (x, y)
+
+
+def draft_image(im: Image, max_size: Tuple[int, int], min_size: Tuple[int, int] = (224, 224),
+                max_pixels: int = DEFAULT_MAX_PIXELS, reducing_gap: float = REDUCING_GAP) -> Image:
+    # asks the JPEG decoder to DCT scale straight to the smallest size that still covers a max_size
+    # thumbnail (with reducing_gap to spare) and min_size for the classifier. other formats are left alone.
+    # raises ImageTooLargeError when the decode would still be bigger than max_pixels
+    target = fit_size(im.size, max_size)
+    requested = (max(int(target[0] * reducing_gap), min_size[0]),
+                 max(int(target[1] * reducing_gap), min_size[1]))
+    try:
+        im.draft(None, requested)
+    except Exception as ex:
+        logging.debug(ex)
+
+    if im.size[0] * im.size[1] > max_pixels:
+        raise ImageTooLargeError('{}x{} image is over the {} pixel decode budget'
+                                 .format(im.size[0], im.size[1], max_pixels))
+    return im
+
+
+def rotate_image(im: Image, orientation: int) -> Image:
+    if orientation == 3:
+        im = im.rotate(180, expand=True)
+    elif orientation == 6:
+        im = im.rotate(270, expand=True)
+    elif orientation == 8:
+        im = im.rotate(90, expand=True)
+    return im
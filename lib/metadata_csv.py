@@ -0,0 +1,157 @@
+import os
+import csv
+import datetime as dt
+import logging
+import numpy as np
+from typing import NamedTuple, Iterator, Iterable, Dict, List, Tuple
+
+# photos.csv has one line per photo, newest first:
+# "filename",aspect ratio,created date,token;token;token
+# the filename is always quoted (with "" escaping a quote) and tokens can be empty.
+# the frontend parses this file too, so the layout must not change
+
+
+class MetadataRow(NamedTuple):
+    filename: str
+    aspect_ratio: str
+    created_date: dt.datetime
+    tokens: str
+
+
+def parse_date(value: str) -> dt.datetime:
+    try:
+        return dt.datetime.fromisoformat(value)
+    except ValueError:
+        return dt.datetime.strptime(value.strip(), '%Y-%m-%d %H:%M:%S')
+
+
+def read_fields(csv_file: str) -> Iterator[Tuple[int, List[str]]]:
+    # (line number, [filename, aspect ratio, date, tokens]) as strings, for every well formed line
+    with open(csv_file, 'r', newline='') as f:
+        for line_number, row in enumerate(csv.reader(f), 1):
+            if len(row) < 3:
+                if len(row) > 0:
+                    logging.error('{}:{} unable to parse {}'.format(csv_file, line_number, row))
+                continue
+            if len(row) != 4:
+                # tokens never contain a comma, but older files might
+                row = row[:3] + [','.join(row[3:])]
+            yield (line_number, row)
+
+
+def read_rows(csv_file: str) -> Iterator[MetadataRow]:
+    # streams the rows of photos.csv, skipping (and logging) lines that can't be parsed
+    for line_number, row in read_fields(csv_file):
+        try:
+            yield MetadataRow(row[0], row[1], parse_date(row[2]), row[3].strip())
+        except ValueError as ex:
+            logging.error('{}:{} unable to parse {}: {}'.format(csv_file, line_number, row, ex))
+
+
+def read_metadata(csv_file: str) -> Dict[str, Tuple[str, dt.datetime, str]]:
+    return {row.filename: (row.aspect_ratio, row.created_date, row.tokens) for row in read_rows(csv_file)}
+
+
+def format_row(filename: str, aspect_ratio: str, created_date: dt.datetime, tokens: str) -> str:
+    return '"{}",{},{},{}\n'.format(filename.replace('"', '""'), aspect_ratio, created_date, tokens)
+
+
+def write_rows(csv_file: str, rows: Iterable[Tuple[str, str, dt.datetime, str]]) -> int:
+    # to a temporary file that is renamed over csv_file, so it's never served or read half written
+    count = 0
+    temporary = csv_file + '.tmp'
+    with open(temporary, 'w', newline='') as f:
+        for row in rows:
+            f.write(format_row(*row))
+            count += 1
+    os.replace(temporary, csv_file)
+    return count
+
+
+class MetadataColumns():
+    # photos.csv in columns: aspect ratios and dates as numpy arrays, and every row's tokens as
+    # a slice token_ids[token_offsets[i]:token_offsets[i + 1]] of ids into the interned token list
+    def __init__(self,
+                 filenames: List[str],
+                 aspect_ratios: np.ndarray,
+                 created_dates: np.ndarray,
+                 token_offsets: np.ndarray,
+                 token_ids: np.ndarray,
+                 tokens: List[str]):
+        self.filenames = filenames
+        self.aspect_ratios = aspect_ratios
+        self.created_dates = created_dates
+        self.token_offsets = token_offsets
+        self.token_ids = token_ids
+        self.tokens = tokens
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    @staticmethod
+    def from_rows(rows: Iterable[MetadataRow]) -> 'MetadataColumns':
+        filenames: List[str] = []
+        aspect_ratios: List[float] = []
+        created_dates: List[dt.datetime] = []
+        token_offsets = [0]
+        token_ids: List[int] = []
+        interned: Dict[str, int] = {}
+
+        for row in rows:
+            filenames.append(row.filename)
+            aspect_ratios.append(float(row.aspect_ratio))
+            created_dates.append(row.created_date)
+            if len(row.tokens) > 0:
+                for t in row.tokens.split(';'):
+                    token_ids.append(interned.setdefault(t, len(interned)))
+            token_offsets.append(len(token_ids))
+
+        return MetadataColumns(filenames,
+                               np.array(aspect_ratios, dtype=np.float32),
+                               np.array(created_dates, dtype='datetime64[s]'),
+                               np.array(token_offsets, dtype=np.int64),
+                               np.array(token_ids, dtype=np.int32),
+                               list(interned))
+
+    @staticmethod
+    def read(csv_file: str) -> 'MetadataColumns':
+        # straight from the csv strings, aspect ratios and dates are converted by numpy in one go
+        filenames: List[str] = []
+        aspect_ratios: List[str] = []
+        created_dates: List[str] = []
+        token_offsets = [0]
+        token_ids: List[int] = []
+        interned: Dict[str, int] = {}
+
+        for _, row in read_fields(csv_file):
+            filenames.append(row[0])
+            aspect_ratios.append(row[1])
+            created_dates.append(row[2].strip())
+            tokens = row[3].strip()
+            if len(tokens) > 0:
+                for t in tokens.split(';'):
+                    token_ids.append(interned.setdefault(t, len(interned)))
+            token_offsets.append(len(token_ids))
+
+        return MetadataColumns(filenames,
+                               np.array(aspect_ratios).astype(np.float32),
+                               np.array(created_dates, dtype='datetime64[s]'),
+                               np.array(token_offsets, dtype=np.int64),
+                               np.array(token_ids, dtype=np.int32),
+                               list(interned))
+
+    def row_tokens(self, i: int) -> List[str]:
+        return [self.tokens[t] for t in self.token_ids[self.token_offsets[i]:self.token_offsets[i + 1]]]
+
+    def row(self, i: int) -> MetadataRow:
+        return MetadataRow(self.filenames[i],
+                           '{:.3f}'.format(self.aspect_ratios[i]),
+                           self.created_dates[i].astype(dt.datetime),
+                           ';'.join(self.row_tokens(i)))
+
+    def years(self) -> np.ndarray:
+        return self.created_dates.astype('datetime64[Y]').astype(np.int64) + 1970
+
+    def token_counts(self) -> np.ndarray:
+        # number of token occurrences for every interned token
+        return np.bincount(self.token_ids, minlength=len(self.tokens))
@@ -0,0 +1,146 @@
+import sqlite3
+import hashlib
+import datetime as dt
+from typing import NamedTuple, Optional, Iterator, List, Tuple, Dict
+
+
+class PhotoRecord(NamedTuple):
+    size: int
+    mtime: float
+    content_hash: str
+    aspect_ratio: str
+    created_date: dt.datetime
+    scene_tokens: str
+    gps_tokens: str
+
+    @property
+    def tokens(self) -> str:
+        # the search tokens column of photos.csv
+        if len(self.gps_tokens) > 0:
+            return self.scene_tokens + ';' + self.gps_tokens
+        return self.scene_tokens
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class MetadataStore():
+    # persistent photo metadata keyed by filename, with size/mtime for cheap change detection and a content
+    # hash so renamed and copied files can reuse metadata computed for another filename.
+    # every change bumps a generation counter, photos.csv only needs exporting when it moved.
+    COLUMNS = 'size, mtime, content_hash, aspect_ratio, created_date, scene_tokens, gps_tokens'
+
+    def __init__(self, store_filename: str):
+        self.store_filename = store_filename
+        self.connection = sqlite3.connect(store_filename, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS photos ('
+                                'filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, content_hash TEXT, '
+                                'aspect_ratio TEXT, created_date TEXT, scene_tokens TEXT, gps_tokens TEXT)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS photos_content_hash ON photos (content_hash)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+        # files that couldn't be processed, at the size and mtime they failed at
+        self.connection.execute('CREATE TABLE IF NOT EXISTS failures ('
+                                'filename TEXT PRIMARY KEY, size INTEGER, mtime REAL)')
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def to_record(self, row: Tuple) -> PhotoRecord:
+        return PhotoRecord(row[0], row[1], row[2], row[3],
+                           dt.datetime.fromisoformat(row[4]), row[5], row[6])
+
+    def __len__(self) -> int:
+        return self.connection.execute('SELECT COUNT(*) FROM photos').fetchone()[0]
+
+    def get(self, filename: str) -> Optional[PhotoRecord]:
+        row = self.connection.execute('SELECT {} FROM photos WHERE filename = ?'.format(self.COLUMNS),
+                                      (filename,)).fetchone()
+        return self.to_record(row) if row else None
+
+    def find_by_hash(self, content_hash: str) -> Optional[PhotoRecord]:
+        row = self.connection.execute('SELECT {} FROM photos WHERE content_hash = ? LIMIT 1'.format(self.COLUMNS),
+                                      (content_hash,)).fetchone()
+        return self.to_record(row) if row else None
+
+    def lookup(self, filename: str, size: int, mtime: float, content_hash: str) -> Optional[PhotoRecord]:
+        # unchanged file first, then the same content under any other name
+        record = self.get(filename)
+        if record and record.size == size and record.mtime == mtime:
+            return record
+        return self.find_by_hash(content_hash)
+
+    def put(self, filename: str, record: PhotoRecord) -> None:
+        # update in place so rowid, and with it the csv order of equal dates, stays stable
+        values = (record.size, record.mtime, record.content_hash, record.aspect_ratio,
+                  str(record.created_date), record.scene_tokens, record.gps_tokens)
+        cursor = self.connection.execute('UPDATE photos SET size = ?, mtime = ?, content_hash = ?, aspect_ratio = ?, '
+                                         'created_date = ?, scene_tokens = ?, gps_tokens = ? WHERE filename = ?',
+                                         values + (filename,))
+        if cursor.rowcount == 0:
+            self.connection.execute('INSERT INTO photos (filename, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+                                    .format(self.COLUMNS), (filename,) + values)
+        self.connection.execute('DELETE FROM failures WHERE filename = ?', (filename,))
+        self.bump_generation()
+
+    def remove(self, filename: str) -> None:
+        cursor = self.connection.execute('DELETE FROM photos WHERE filename = ?', (filename,))
+        if cursor.rowcount > 0:
+            self.bump_generation()
+        self.connection.execute('DELETE FROM failures WHERE filename = ?', (filename,))
+
+    def failures(self) -> Dict[str, Tuple[int, float]]:
+        return {row[0]: (row[1], row[2])
+                for row in self.connection.execute('SELECT filename, size, mtime FROM failures')}
+
+    def put_failure(self, filename: str, size: int, mtime: float) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO failures (filename, size, mtime) VALUES (?, ?, ?)',
+                                (filename, size, mtime))
+
+    def remove_failures(self, filenames: List[str]) -> None:
+        self.connection.executemany('DELETE FROM failures WHERE filename = ?', [(f,) for f in filenames])
+
+    def filenames(self) -> Iterator[str]:
+        for row in self.connection.execute('SELECT filename FROM photos'):
+            yield row[0]
+
+    def stats(self) -> Dict[str, Tuple[int, float]]:
+        # filename to the (size, mtime) its metadata was computed from
+        return {row[0]: (row[1], row[2])
+                for row in self.connection.execute('SELECT filename, size, mtime FROM photos')}
+
+    def records(self) -> Iterator[Tuple[str, PhotoRecord]]:
+        # newest first, the order photos.csv is written in
+        for row in self.connection.execute('SELECT filename, {} FROM photos ORDER BY created_date DESC, rowid'
+                                           .format(self.COLUMNS)):
+            yield (row[0], self.to_record(row[1:]))
+
+    def get_setting(self, key: str, default: str = '') -> str:
+        row = self.connection.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_setting(self, key: str, value: str) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    def bump_generation(self) -> None:
+        self.set_setting('generation', str(int(self.get_setting('generation', '0')) + 1))
+
+    def is_exported(self, csv_file: str) -> bool:
+        return self.get_setting('exported_generation') == self.get_setting('generation', '0') \
+            and self.get_setting('exported_file') == csv_file
+
+    def mark_exported(self, csv_file: str) -> None:
+        self.set_setting('exported_generation', self.get_setting('generation', '0'))
+        self.set_setting('exported_file', csv_file)
+        self.commit()
+
+    def import_metadata(self, metadata: Dict[str, Tuple[str, dt.datetime, str]]) -> None:
+        # rows from an existing photos.csv, without size, mtime or hash they only ever match by filename
+        for filename, (aspect_ratio, created_date, tokens) in metadata.items():
+            self.put(filename, PhotoRecord(-1, -1.0, '', aspect_ratio, created_date, tokens, ''))
+        self.commit()
+
+    def commit(self) -> None:
+        self.connection.commit()
@@ -0,0 +1,142 @@
+import sqlite3
+import numpy as np
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Any
+from PIL import Image
+from lib.image_decode import DEFAULT_MAX_PIXELS, draft_image, rotate_image
+from lib.raw_preview import open_image
+from lib.photo_metadata import DEFAULT_DATE
+
+# 64 bit perceptual hashes, close in hamming distance for resized, re-encoded or slightly edited copies:
+# dhash compares neighbouring pixels of a 9x8 grayscale image, phash is the sign of the low frequencies
+# of a 32x32 DCT against their median
+HASH_SIZE = 8
+PHASH_SIZE = 32
+
+
+class ImageHashes(NamedTuple):
+    dhash: int
+    phash: int
+    width: int
+    height: int
+    # seconds since the epoch from EXIF DateTimeOriginal, 0 when the photo doesn't have one
+    created: float
+
+
+def dct_matrix(n: int) -> np.ndarray:
+    # orthonormal DCT-II as a matrix, so a 2d DCT is m @ x @ m.T without scipy
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+
+DCT = dct_matrix(PHASH_SIZE)
+
+
+def bits_to_int(bits: np.ndarray) -> int:
+    return int(''.join('1' if b else '0' for b in bits.flatten()), 2)
+
+
+def dhash(gray: Image.Image) -> int:
+    pixels = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+def phash(gray: Image.Image) -> int:
+    pixels = np.asarray(gray.resize((PHASH_SIZE, PHASH_SIZE), Image.BILINEAR), dtype=np.float64)
+    low = (DCT @ pixels @ DCT.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    # the DC term is the average brightness, leave it out of the median
+    return bits_to_int(low > np.median(low[1:]))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def hash_image(data: bytes, max_pixels: int = DEFAULT_MAX_PIXELS) -> ImageHashes:
+    # from a draft mode decode, JPEGs are DCT scaled to 1/8 which is plenty for a 32x32 hash
+    im, metadata = open_image(data)
+    width, height = im.size
+    draft_image(im, (PHASH_SIZE, PHASH_SIZE), min_size=(PHASH_SIZE * 2, PHASH_SIZE * 2), max_pixels=max_pixels)
+    gray = rotate_image(im.convert('L'), metadata.orientation)
+    if metadata.orientation in (6, 8):
+        width, height = height, width
+    created = metadata.created_date.timestamp() if metadata.created_date != DEFAULT_DATE else 0.0
+    return ImageHashes(dhash(gray), phash(gray), width, height, created)
+
+
+class BKTree():
+    # metric tree over hamming distance: a node's children are keyed by their distance to it, so a radius r
+    # query only descends into children whose key is within r of the query's distance to the node
+    def __init__(self):
+        # node is [hash, items, {distance: child}]
+        self.root: Optional[List[Any]] = None
+        self.size = 0
+
+    def add(self, h: int, item: Any) -> None:
+        self.size += 1
+        if self.root is None:
+            self.root = [h, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [item], {}]
+                return
+            node = child
+
+    def query(self, h: int, radius: int) -> Iterator[Tuple[int, Any]]:
+        # (distance, item) for every item within radius of h
+        if self.root is None:
+            return
+        stack = [self.root]
+        while len(stack) > 0:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                for item in node[1]:
+                    yield (d, item)
+            for key, child in node[2].items():
+                if d - radius <= key <= d + radius:
+                    stack.append(child)
+
+    def __len__(self) -> int:
+        return self.size
+
+
+class HashCache():
+    # hashes by filename, valid while the file's size and mtime are unchanged, so reruns only hash new files
+    def __init__(self, cache_filename: str):
+        self.connection = sqlite3.connect(cache_filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                                'filename TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                                'dhash TEXT, phash TEXT, width INTEGER, height INTEGER, created REAL)')
+        self.connection.commit()
+
+    def load(self) -> Dict[str, Tuple[int, float, ImageHashes]]:
+        return {filename: (size, mtime, ImageHashes(int(d, 16), int(p, 16), width, height, created))
+                for filename, size, mtime, d, p, width, height, created in self.connection.execute(
+                    'SELECT filename, size, mtime, dhash, phash, width, height, created FROM hashes')}
+
+    def put(self, filename: str, size: int, mtime: float, hashes: ImageHashes) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO hashes (filename, size, mtime, dhash, phash, width, height, '
+                                'created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (filename, size, mtime, '{:016x}'.format(hashes.dhash),
+                                 '{:016x}'.format(hashes.phash), hashes.width, hashes.height, hashes.created))
+
+    def remove_missing(self, filenames: List[str]) -> None:
+        present = set(filenames)
+        gone = [(f,) for f, in self.connection.execute('SELECT filename FROM hashes') if f not in present]
+        self.connection.executemany('DELETE FROM hashes WHERE filename = ?', gone)
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,91 @@
+import math
+import datetime as dt
+import logging
+from typing import NamedTuple, Optional, Dict, Any
+from PIL import Image
+
+# exif tags we care about, see PIL.ExifTags.TAGS and PIL.ExifTags.GPSTAGS
+ORIENTATION = 274
+DATE_TIME_ORIGINAL = 36867
+GPS_INFO = 34853
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+DEFAULT_DATE = dt.datetime(1990, 1, 1)
+
+
+class PhotoMetadata(NamedTuple):
+    created_date: dt.datetime
+    orientation: int
+    latitude: Optional[float]
+    longitude: Optional[float]
+
+
+def to_float(value: Any) -> float:
+    # older Pillow gives (numerator, denominator) tuples, newer gives IFDRational
+    if isinstance(value, tuple):
+        return value[0] / value[1]
+    return float(value)
+
+
+def parse_date(created_date: Any) -> dt.datetime:
+    try:
+        return dt.datetime.strptime(str(created_date).strip(), '%Y:%m:%d %H:%M:%S')
+    except Exception as ex:
+        logging.debug(ex)
+        return DEFAULT_DATE
+
+
+def parse_coordinate(dms: Any, ref: Any, negative_ref: str, limit: float) -> Optional[float]:
+    # None unless it's a finite coordinate within +-limit degrees, 0/0 rationals come out as nan
+    degrees, minutes, seconds = [to_float(v) for v in dms]
+    coordinate = degrees + minutes / 60.0 + seconds / 3600.0
+    if not math.isfinite(coordinate) or abs(coordinate) > limit:
+        return None
+    if isinstance(ref, bytes):
+        ref = ref.decode('ascii', 'ignore')
+    if str(ref).strip('\x00 ').upper() == negative_ref:
+        coordinate = -coordinate
+    return coordinate
+
+
+def parse_gps(gps_info: Dict[int, Any]) -> Optional[tuple]:
+    try:
+        latitude = parse_coordinate(gps_info[GPS_LATITUDE], gps_info.get(GPS_LATITUDE_REF, 'N'), 'S', 90.0)
+        longitude = parse_coordinate(gps_info[GPS_LONGITUDE], gps_info.get(GPS_LONGITUDE_REF, 'E'), 'W', 180.0)
+        if latitude is None or longitude is None:
+            return None
+        return (latitude, longitude)
+    except Exception as ex:
+        logging.debug('Unable to parse GPS coordinates {}'.format(ex))
+        return None
+
+
+def metadata_from_exif(exif: Optional[Dict[int, Any]]) -> PhotoMetadata:
+    if not exif:
+        return PhotoMetadata(DEFAULT_DATE, 1, None, None)
+
+    created_date = parse_date(exif[DATE_TIME_ORIGINAL]) if DATE_TIME_ORIGINAL in exif else DEFAULT_DATE
+    orientation = exif.get(ORIENTATION, 1)
+
+    latlong = None
+    if isinstance(exif.get(GPS_INFO), dict):
+        latlong = parse_gps(exif[GPS_INFO])
+
+    if latlong is None:
+        return PhotoMetadata(created_date, orientation, None, None)
+    return PhotoMetadata(created_date, orientation, latlong[0], latlong[1])
+
+
+def read_photo_metadata(im: Image) -> PhotoMetadata:
+    # parses the exif block once, straight from the already opened image
+    exif = None
+    try:
+        getexif = getattr(im, '_getexif', None)
+        if getexif is not None:
+            exif = getexif()
+    except Exception as ex:
+        logging.debug(ex)
+    return metadata_from_exif(exif)
@@ -0,0 +1,127 @@
+import queue
+import threading
+import logging
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional
+
+# threads connected by bounded queues. a full queue blocks whoever is putting into it, so no more than
+# `depth` items wait between two stages and memory stays bounded whatever the speed of each stage.
+# every stage runs concurrently, so throughput is set by the slowest stage rather than the sum of them.
+# the first exception in any stage stops all of them, and is raised again by join()
+DONE = object()
+
+
+class PipelineSettings(NamedTuple):
+    read_threads: int = 4
+    decode_threads: int = 4
+    queue_depth: int = 32
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Pipeline():
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.abort = threading.Event()
+        self.error: Optional[BaseException] = None
+        self.threads: List[threading.Thread] = []
+
+    def new_queue(self, depth: Optional[int] = None) -> queue.Queue:
+        return queue.Queue(self.depth if depth is None else depth)
+
+    def put(self, q: queue.Queue, item: Any) -> None:
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self, q: queue.Queue) -> Any:
+        while True:
+            if self.abort.is_set():
+                raise PipelineAborted()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def fail(self, ex: BaseException) -> None:
+        if self.error is None:
+            self.error = ex
+        self.abort.set()
+
+    def source(self, items: List[Any]) -> queue.Queue:
+        # an already full (and finished) queue to feed the first stage from
+        q: queue.Queue = queue.Queue()
+        for item in items:
+            q.put(item)
+        q.put(DONE)
+        return q
+
+    def stage(self,
+              name: str,
+              threads: int,
+              inbox: queue.Queue,
+              outboxes: List[queue.Queue],
+              work: Callable[[Any], None],
+              finish: Optional[Callable[[], None]] = None) -> None:
+        # runs work(item) on `threads` threads for every item in inbox, work puts its output into the outboxes
+        # itself. when inbox is done the last thread to finish calls finish() (say for a last, partial batch)
+        # and then marks every outbox done
+        remaining = [threads]
+        lock = threading.Lock()
+
+        def run() -> None:
+            try:
+                while True:
+                    item = self.get(inbox)
+                    if item is DONE:
+                        # leave it there for the other threads of this stage
+                        inbox.put(DONE)
+                        break
+                    work(item)
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    if finish is not None:
+                        finish()
+                    for outbox in outboxes:
+                        self.put(outbox, DONE)
+            except PipelineAborted:
+                pass
+            except BaseException as ex:
+                logging.error('{} stage failed: {}'.format(name, ex))
+                self.fail(ex)
+
+        for i in range(threads):
+            self.threads.append(threading.Thread(target=run, name='{}-{}'.format(name, i), daemon=True))
+
+    def start(self) -> None:
+        for t in self.threads:
+            t.start()
+
+    def results(self, outbox: queue.Queue) -> Iterator[Any]:
+        # everything that reaches outbox, on the calling thread, until the stages feeding it are done.
+        # stopping early (or an exception in the caller) stops every stage
+        finished = False
+        try:
+            while True:
+                item = self.get(outbox)
+                if item is DONE:
+                    finished = True
+                    break
+                yield item
+        except PipelineAborted:
+            pass
+        finally:
+            if not finished:
+                self.abort.set()
+            for t in self.threads:
+                t.join()
+        if self.error is not None:
+            raise self.error
@@ -4,29 +4,35 @@
 # updated, cleaned it up, class'ified it, self contained
 
 import torch
-from torch.autograd import Variable as V
 import torchvision.models as models
 from torchvision import transforms as trn
-from torch.nn import functional as F
-from typing import List
+from typing import List, Tuple, Union
 import os
-import re
 import numpy as np
 import cv2
 from PIL import Image
+from lib.scene_tokens import SceneTokenizer
 
 class PlacesClassifier():
-    def __init__(self, models_directory):
-        self.features_blobs = []
-        self.classes = None
-        self.labels_IO = None
-        self.labels_attribute = None
-        self.W_attribute = None
+    def __init__(self, models_directory, num_threads: int = 0):
+        # num_threads of 0 keeps torch's default of one thread per core
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
         self.models_directory = models_directory
-        self.classes, self.labels_IO, self.labels_attribute, self.W_attribute = self.load_labels()
+        self.tokenizer = SceneTokenizer(models_directory)
+        self.classes = self.tokenizer.classes
+        self.labels_IO = self.tokenizer.labels_IO
+        self.labels_attribute = self.tokenizer.labels_attribute
+        self.W_attribute = self.tokenizer.W_attribute
         self.model = self.load_model()
         self.tf = self.returnTF()
 
+        # get the softmax weight, once. this is a view onto the fc layer, so clamping it
+        # also clamps the weights used by forward() (as the per call version always did)
+        params = list(self.model.parameters())
+        self.weight_softmax = params[-2].data.numpy()
+        self.weight_softmax[self.weight_softmax < 0] = 0
+
     def recursion_change_bn(self, module):
         if isinstance(module, torch.nn.BatchNorm2d):
             module.track_running_stats = 1
@@ -35,51 +41,6 @@ class PlacesClassifier():
                 module1 = self.recursion_change_bn(module1)
         return module
 
-    def load_labels(self):
-        # prepare all the labels
-        # scene category relevant
-        file_name_category = self.models_directory + '/categories_places365.txt'
-        if not os.access(file_name_category, os.W_OK):
-            synset_url = 'https://raw.githubusercontent.com/csailvision/places365/master/categories_places365.txt'
-            os.system('wget -P {} '.format(self.models_directory) + synset_url)
-        classes = list()
-        with open(file_name_category) as class_file:
-            for line in class_file:
-                classes.append(line.strip().split(' ')[0][3:])
-        classes = tuple(classes)
-
-        # indoor and outdoor relevant
-        file_name_IO = self.models_directory + '/IO_places365.txt'
-        if not os.access(file_name_IO, os.W_OK):
-            synset_url = 'https://raw.githubusercontent.com/csailvision/places365/master/IO_places365.txt'
-            os.system('wget -P {} '.format(self.models_directory) + synset_url)
-        with open(file_name_IO) as f:
-            lines = f.readlines()
-            labels_IO = []
-            for line in lines:
-                items = line.rstrip().split()
-                labels_IO.append(int(items[-1]) - 1)  # 0 is indoor, 1 is outdoor
-        labels_IO = np.array(labels_IO)
-
-        # scene attribute relevant
-        file_name_attribute = self.models_directory + '/labels_sunattribute.txt'
-        if not os.access(file_name_attribute, os.W_OK):
-            synset_url = 'https://raw.githubusercontent.com/csailvision/places365/master/labels_sunattribute.txt'
-            os.system('wget -P {} '.format(self.models_directory) + synset_url)
-        with open(file_name_attribute) as f:
-            lines = f.readlines()
-            labels_attribute = [item.rstrip() for item in lines]
-        file_name_W = self.models_directory + '/W_sceneattribute_wideresnet18.npy'
-        if not os.access(file_name_W, os.W_OK):
-            synset_url = 'http://places2.csail.mit.edu/models_places365/W_sceneattribute_wideresnet18.npy'
-            os.system('wget -P {} '.format(self.models_directory) + synset_url)
-        W_attribute = np.load(file_name_W)
-
-        return classes, labels_IO, labels_attribute, W_attribute
-
-    def hook_feature(self, module, input, output):
-        self.features_blobs.append(np.squeeze(output.data.cpu().numpy()))
-
     def returnCAM(self, feature_conv, weight_softmax, class_idx):
         # generate the class activation maps upsample to 256x256
         size_upsample = (256, 256)
@@ -126,68 +87,30 @@ class PlacesClassifier():
         model.avgpool = torch.nn.AvgPool2d(kernel_size=14, stride=1, padding=0)
 
         model.eval()
-
-        model.eval()
-        # hook the feature extractor
-        features_names = ['layer4', 'avgpool']  # this is the last conv layer of the resnet
-        for name in features_names:
-            model._modules.get(name).register_forward_hook(self.hook_feature)
         return model
 
+    def preprocess(self, img: Image) -> torch.Tensor:
+        return self.tf(img)
+
     def forward(self, img: Image) -> List[str]:
-        attributes = ['clouds',
-                      'biking',
-                      'swimming',
-                      'driving',
-                      'sunny',
-                      'leaves',
-                      'snow',
-                      'trees',
-                      'climbing',
-                      'hiking',
-                      'rugged',
-                      'ocean',
-                      'scene']
-        # load the model
-        tokens = []
-
-        # get the softmax weight
-        params = list(self.model.parameters())
-        weight_softmax = params[-2].data.numpy()
-        weight_softmax[weight_softmax < 0] = 0
-
-        input_img = V(self.tf(img).unsqueeze(0))
-
-        # forward pass
-        logit = self.model.forward(input_img)
-        h_x = F.softmax(logit, 1).data.squeeze()
-        probs, idx = h_x.sort(0, True)
-        probs = probs.numpy()
-        idx = idx.numpy()
-
-        # output the IO prediction
-        io_image = np.mean(self.labels_IO[idx[:10]])  # vote for the indoor or outdoor
-        if io_image < 0.5:
-            tokens.append('indoor')
-        else:
-            tokens.append('outdoor')
-
-        # output the prediction of scene category
-        for i in range(0, 5):
-            if probs[i] > 0.25:
-                tokens.append(self.classes[idx[i]])
-
-        # output the scene attributes
-        responses_attribute = self.W_attribute.dot(self.features_blobs[1])
-        self.features_blobs = []
-        idx_a = np.argsort(responses_attribute)
-        for i in range(-1, -10, -1):
-            t = self.labels_attribute[idx_a[i]]
-            if t in attributes:
-                tokens.append(self.labels_attribute[idx_a[i]])
-
-        result = []
-        for token in tokens:
-            for t in re.split('[, /_-]+', token):
-                result.append(t)
-        return list(set(result))
+        return self.forward_batch([img])[0]
+
+    def forward_batch(self, images: List[Union[Image.Image, torch.Tensor]]) -> List[List[str]]:
+        return self.tokenizer.tokens_batch(*self.forward_vectors(images))
+
+    def forward_vectors(self, images: List[Union[Image.Image, torch.Tensor]]) -> Tuple[np.ndarray, np.ndarray]:
+        # returns the N x 365 logits and N x 512 avgpool features that the tokens are computed from.
+        # images can be PIL images or tensors already run through preprocess()
+        input_img = torch.stack([i if isinstance(i, torch.Tensor) else self.preprocess(i) for i in images])
+
+        # capture the avgpool features for this call only, so no state is left on the classifier
+        features = []
+        handle = self.model.avgpool.register_forward_hook(
+            lambda module, input, output: features.append(output))
+        try:
+            with torch.no_grad():
+                logit = self.model.forward(input_img)
+        finally:
+            handle.remove()
+
+        return (logit.numpy(), features[0].reshape(len(images), -1).numpy())
@@ -0,0 +1,119 @@
+import json
+import time
+import contextlib
+import numpy as np
+from typing import Dict, List, Any, Optional
+
+# per stage timings for --profile. a disabled Profiler hands out one shared no-op context manager,
+# so leaving the `with profiler.stage(...)` lines in the hot path costs next to nothing.
+# worker processes profile into their own Profiler and send snapshot()s back to be merge()d
+NOOP = contextlib.nullcontext()
+
+
+class StageTimer():
+    def __init__(self, profiler: 'Profiler', name: str, filename: Optional[str]):
+        self.profiler = profiler
+        self.name = name
+        self.filename = filename
+
+    def __enter__(self) -> 'StageTimer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.profiler.record(self.name, time.perf_counter() - self.start, self.filename)
+
+
+class Profiler():
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.stages: Dict[str, List[float]] = {}
+        self.files: Dict[str, float] = {}
+        self.files_read = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def stage(self, name: str, filename: Optional[str] = None):
+        # time spent in the block goes to the stage, and to filename's total when it's for one file
+        if not self.enabled:
+            return NOOP
+        return StageTimer(self, name, filename)
+
+    def record(self, name: str, seconds: float, filename: Optional[str] = None) -> None:
+        self.stages.setdefault(name, []).append(seconds)
+        if filename is not None:
+            self.files[filename] = self.files.get(filename, 0.0) + seconds
+
+    def read(self, n: int) -> None:
+        # called once for every file read, with its size
+        if self.enabled:
+            self.files_read += 1
+            self.bytes_read += n
+
+    def wrote(self, n: int) -> None:
+        if self.enabled:
+            self.bytes_written += n
+
+    def snapshot(self) -> Optional[Dict[str, Any]]:
+        # everything recorded since the last snapshot, None when disabled
+        if not self.enabled:
+            return None
+        result = {'stages': self.stages, 'files': self.files, 'files_read': self.files_read,
+                  'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written}
+        self.stages, self.files, self.files_read, self.bytes_read, self.bytes_written = {}, {}, 0, 0, 0
+        return result
+
+    def merge(self, snapshot: Optional[Dict[str, Any]]) -> None:
+        if not self.enabled or snapshot is None:
+            return
+        for name, samples in snapshot['stages'].items():
+            self.stages.setdefault(name, []).extend(samples)
+        for filename, seconds in snapshot['files'].items():
+            self.files[filename] = self.files.get(filename, 0.0) + seconds
+        self.files_read += snapshot['files_read']
+        self.bytes_read += snapshot['bytes_read']
+        self.bytes_written += snapshot['bytes_written']
+
+    def report(self, wall_seconds: float, slowest: int = 20) -> Dict[str, Any]:
+        stages = {}
+        for name, samples in self.stages.items():
+            s = np.array(samples)
+            stages[name] = {'count': len(s),
+                            'total': float(s.sum()),
+                            'mean': float(s.mean()),
+                            'p50': float(np.percentile(s, 50)),
+                            'p90': float(np.percentile(s, 90)),
+                            'p99': float(np.percentile(s, 99)),
+                            'max': float(s.max())}
+        return {'wall_seconds': wall_seconds,
+                'files': self.files_read,
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'stages': stages,
+                'slowest_files': [{'filename': f, 'seconds': s}
+                                  for f, s in sorted(self.files.items(), key=lambda i: -i[1])[:slowest]]}
+
+    def write_report(self, filename: str, wall_seconds: float, slowest: int = 20) -> Dict[str, Any]:
+        report = self.report(wall_seconds, slowest)
+        with open(filename, 'w') as f:
+            json.dump(report, f, indent=1)
+        return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    # stage table, worst total first. with several workers stage totals add up to more than the wall time
+    lines = ['{:<14} {:>8} {:>10} {:>9} {:>9} {:>9} {:>9}'.format('stage', 'count', 'total s', 'p50 ms', 'p90 ms',
+                                                                   'p99 ms', 'max ms')]
+    for name, s in sorted(report['stages'].items(), key=lambda i: -i[1]['total']):
+        lines.append('{:<14} {:>8} {:>10.2f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'
+                     .format(name, s['count'], s['total'], s['p50'] * 1000, s['p90'] * 1000, s['p99'] * 1000,
+                             s['max'] * 1000))
+    seconds = max(report['wall_seconds'], 1e-6)
+    lines.append('{} files in {:.1f}s, {:.1f} files/s, read {:.1f} MB, wrote {:.1f} MB'
+                 .format(report['files'], report['wall_seconds'], report['files'] / seconds,
+                         report['bytes_read'] / 1e6, report['bytes_written'] / 1e6))
+    if len(report['slowest_files']) > 0:
+        lines.append('slowest files:')
+        for f in report['slowest_files']:
+            lines.append('  {:>8.1f} ms  {}'.format(f['seconds'] * 1000, f['filename']))
+    return '\n'.join(lines)
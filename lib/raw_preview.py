@@ -0,0 +1,111 @@
+import io
+import struct
+from typing import Any, Dict, NamedTuple, Tuple
+from PIL import Image
+from lib.photo_metadata import GPS_INFO, PhotoMetadata, metadata_from_exif, read_photo_metadata
+
+# canon .cr2 files are TIFF files. IFD0 points (StripOffsets, StripByteCounts) at the JPEG the camera rendered
+# at full size, and has the orientation and the offsets of the EXIF and GPS IFDs. IFD1 is a small JPEG thumbnail,
+# IFD2 an uncompressed one and IFD3 the sensor data, a lossless JPEG that starts with FFD8 too and is bigger than
+# the preview. only IFD0 is read: it's parsed here in pure python, and the JPEG and EXIF then go down the same path
+# as any other JPEG, at JPEG speed
+
+STRIP_OFFSETS = 273
+STRIP_BYTE_COUNTS = 279
+EXIF_IFD = 34665
+
+# tiff field type to (struct format, size)
+TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('s', 1),
+         8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8)}
+
+
+class RawFormatError(ValueError):
+    pass
+
+
+class RawPreview(NamedTuple):
+    jpeg: bytes
+    # tags of IFD0 and the EXIF IFD, with the GPS IFD as a dict under GPS_INFO, as Image._getexif() has them
+    exif: Dict[int, Any]
+
+
+def is_cr2(data: bytes) -> bool:
+    # a TIFF header followed by 'CR', plain TIFFs are left to PIL
+    return data[:4] in (b'II*\x00', b'MM\x00*') and data[8:10] == b'CR'
+
+
+def read_value(data: bytes, endian: str, field_type: int, count: int, offset: int) -> Any:
+    fmt, size = TYPES[field_type]
+    if field_type in (2, 7):
+        value = data[offset:offset + count]
+        return value.rstrip(b'\x00').decode('ascii', 'ignore') if field_type == 2 else value
+    values = struct.unpack_from('{}{}'.format(endian, fmt * count), data, offset)
+    if field_type in (5, 10):
+        # (numerator, denominator) pairs, which photo_metadata.to_float understands
+        values = tuple(values[i:i + 2] for i in range(0, len(values), 2))
+    return values[0] if count == 1 else values
+
+
+def read_ifd(data: bytes, endian: str, offset: int) -> Tuple[Dict[int, Any], int]:
+    # the IFD's tags, and the offset of the next IFD (0 for the last one)
+    if offset <= 0 or offset + 2 > len(data):
+        raise RawFormatError('IFD offset {} outside the file'.format(offset))
+    count = struct.unpack_from(endian + 'H', data, offset)[0]
+    tags = {}
+    for i in range(count):
+        entry = offset + 2 + i * 12
+        if entry + 12 > len(data):
+            raise RawFormatError('IFD at {} runs past the end of the file'.format(offset))
+        tag, field_type, n = struct.unpack_from(endian + 'HHI', data, entry)
+        if field_type not in TYPES:
+            continue
+        size = TYPES[field_type][1] * n
+        # values of up to 4 bytes are stored in the entry itself, longer ones elsewhere
+        value_offset = entry + 8 if size <= 4 else struct.unpack_from(endian + 'I', data, entry + 8)[0]
+        if value_offset + size > len(data):
+            continue
+        tags[tag] = read_value(data, endian, field_type, n, value_offset)
+    next_offset = offset + 2 + count * 12
+    return (tags, struct.unpack_from(endian + 'I', data, next_offset)[0] if next_offset + 4 <= len(data) else 0)
+
+
+def extract_preview(data: bytes) -> RawPreview:
+    # the full size JPEG preview and the EXIF of a .cr2 file, raises RawFormatError without one
+    if data[:4] == b'II*\x00':
+        endian = '<'
+    elif data[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        raise RawFormatError('not a TIFF based raw file')
+    if len(data) < 8:
+        raise RawFormatError('truncated TIFF header')
+
+    ifd0 = read_ifd(data, endian, struct.unpack_from(endian + 'I', data, 4)[0])[0]
+    start, length = ifd0.get(STRIP_OFFSETS), ifd0.get(STRIP_BYTE_COUNTS)
+    # a single strip, the preview is never split into several
+    if not isinstance(start, int) or not isinstance(length, int) or start + length > len(data) or \
+            data[start:start + 2] != b'\xff\xd8':
+        raise RawFormatError('no embedded JPEG preview')
+
+    exif = dict(ifd0)
+    if isinstance(exif.get(EXIF_IFD), int):
+        try:
+            exif.update(read_ifd(data, endian, exif.pop(EXIF_IFD))[0])
+        except RawFormatError:
+            pass
+    if isinstance(exif.get(GPS_INFO), int):
+        try:
+            exif[GPS_INFO] = read_ifd(data, endian, exif[GPS_INFO])[0]
+        except RawFormatError:
+            del exif[GPS_INFO]
+    return RawPreview(data[start:start + length], exif)
+
+
+def open_image(data: bytes) -> Tuple[Image.Image, PhotoMetadata]:
+    # the image PIL opens, or a raw file's preview, with its metadata. the preview has no EXIF of its own,
+    # it's in the raw file's IFDs (the orientation too, the camera doesn't rotate the preview)
+    if is_cr2(data):
+        preview = extract_preview(data)
+        return (Image.open(io.BytesIO(preview.jpeg)), metadata_from_exif(preview.exif))
+    im = Image.open(io.BytesIO(data))
+    return (im, read_photo_metadata(im))
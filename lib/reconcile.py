@@ -0,0 +1,87 @@
+import os
+import logging
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from lib.thumbnails import FORMATS, PYRAMID_FILENAME, ThumbnailPyramid
+
+# what a run of generate_photos_gallery has to do, from one scandir of the source directory, the thumbnail
+# directory and each pyramid size directory, plus the size and mtime the store has for every photo.
+# a photo is stale when a thumbnail is missing or older than it, or when its size or mtime changed since its
+# metadata was computed. thumbnails and metadata of photos that are no longer there are orphans
+
+
+class ChangeSet(NamedTuple):
+    # sorted, so runs process photos in the same order
+    stale: List[str]
+    orphan_thumbnails: List[str]
+    orphan_records: List[str]
+    unchanged: int
+
+
+# files still being written: sync_directory copies to a hidden .name.part, and exports write a .tmp first
+PARTIAL_SUFFIXES = ('.part', '.tmp')
+
+
+def is_partial(name: str) -> bool:
+    return name.startswith('.') or name.endswith(PARTIAL_SUFFIXES)
+
+
+def scan_files(directory: str) -> Dict[str, Tuple[int, float]]:
+    # filename to (size, mtime) of the regular files in directory, without hidden and half written ones
+    ret = {}
+    if not os.path.isdir(directory):
+        return ret
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and not is_partial(entry.name):
+                stat = entry.stat()
+                ret[entry.name] = (stat.st_size, stat.st_mtime)
+    return ret
+
+
+def find_changes(source_directory: str,
+                 thumbnail_directory: str,
+                 pyramid: ThumbnailPyramid,
+                 records: Dict[str, Tuple[int, float]],
+                 select: Optional[Callable[[str], bool]] = None) -> ChangeSet:
+    # only photos (and thumbnails of photos) whose filename select() accepts are considered, when it's given
+    def selected(names: Dict[str, Tuple[int, float]]) -> Dict[str, Tuple[int, float]]:
+        return names if select is None else {f: v for f, v in names.items() if select(f)}
+
+    sources = selected(scan_files(source_directory))
+    legacy = selected(scan_files(thumbnail_directory))
+    legacy.pop(PYRAMID_FILENAME, None)
+    levels: Dict[int, Set[str]] = {size: set(scan_files(os.path.join(thumbnail_directory, str(size))))
+                                   for size in pyramid.sizes}
+    if select is not None:
+        levels = {size: {name for name in names if select(os.path.splitext(name)[0])}
+                  for size, names in levels.items()}
+    extensions = [FORMATS[f].extension for f in pyramid.formats]
+
+    stale = []
+    for f, (size, mtime) in sources.items():
+        thumbnail = legacy.get(f)
+        record = records.get(f)
+        if thumbnail is None or thumbnail[1] < mtime or record is None:
+            stale.append(f)
+        elif record[0] >= 0 and (record[0] != size or record[1] != mtime):
+            # rows imported from photos.csv have no size or mtime (-1) and only go stale with their thumbnail
+            stale.append(f)
+        elif any('{}.{}'.format(f, extension) not in names for names in levels.values() for extension in extensions):
+            stale.append(f)
+
+    orphan_thumbnails = [os.path.join(thumbnail_directory, f) for f in legacy if f not in sources]
+    for size, names in levels.items():
+        orphan_thumbnails.extend(os.path.join(thumbnail_directory, str(size), name) for name in names
+                                 if os.path.splitext(name)[0] not in sources)
+    orphan_records = [f for f in records if f not in sources]
+    return ChangeSet(sorted(stale), sorted(orphan_thumbnails), sorted(orphan_records), len(sources) - len(stale))
+
+
+def remove_files(filenames: List[str]) -> None:
+    for f in filenames:
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            logging.error('could not remove {}: {}'.format(f, ex))
@@ -0,0 +1,113 @@
+# scene tokens from the output of the Places365 wideresnet18, split out of places_classifier so tokens can be
+# recomputed from stored logits and features with numpy alone (no torch)
+
+import os
+import re
+import numpy as np
+from typing import List, Tuple
+
+
+class SceneTokenizer():
+    attributes = ['clouds',
+                  'biking',
+                  'swimming',
+                  'driving',
+                  'sunny',
+                  'leaves',
+                  'snow',
+                  'trees',
+                  'climbing',
+                  'hiking',
+                  'rugged',
+                  'ocean',
+                  'scene']
+    # scene categories above this probability become tokens
+    category_threshold = 0.25
+
+    def __init__(self, models_directory: str):
+        self.models_directory = models_directory
+        self.classes, self.labels_IO, self.labels_attribute, self.W_attribute = self.load_labels()
+
+    def load_labels(self):
+        # prepare all the labels
+        # scene category relevant
+        file_name_category = self.models_directory + '/categories_places365.txt'
+        if not os.access(file_name_category, os.W_OK):
+            synset_url = 'https://raw.githubusercontent.com/csailvision/places365/master/categories_places365.txt'
+            os.system('wget -P {} '.format(self.models_directory) + synset_url)
+        classes = list()
+        with open(file_name_category) as class_file:
+            for line in class_file:
+                classes.append(line.strip().split(' ')[0][3:])
+        classes = tuple(classes)
+
+        # indoor and outdoor relevant
+        file_name_IO = self.models_directory + '/IO_places365.txt'
+        if not os.access(file_name_IO, os.W_OK):
+            synset_url = 'https://raw.githubusercontent.com/csailvision/places365/master/IO_places365.txt'
+            os.system('wget -P {} '.format(self.models_directory) + synset_url)
+        with open(file_name_IO) as f:
+            lines = f.readlines()
+            labels_IO = []
+            for line in lines:
+                items = line.rstrip().split()
+                labels_IO.append(int(items[-1]) - 1)  # 0 is indoor, 1 is outdoor
+        labels_IO = np.array(labels_IO)
+
+        # scene attribute relevant
+        file_name_attribute = self.models_directory + '/labels_sunattribute.txt'
+        if not os.access(file_name_attribute, os.W_OK):
+            synset_url = 'https://raw.githubusercontent.com/csailvision/places365/master/labels_sunattribute.txt'
+            os.system('wget -P {} '.format(self.models_directory) + synset_url)
+        with open(file_name_attribute) as f:
+            lines = f.readlines()
+            labels_attribute = [item.rstrip() for item in lines]
+        file_name_W = self.models_directory + '/W_sceneattribute_wideresnet18.npy'
+        if not os.access(file_name_W, os.W_OK):
+            synset_url = 'http://places2.csail.mit.edu/models_places365/W_sceneattribute_wideresnet18.npy'
+            os.system('wget -P {} '.format(self.models_directory) + synset_url)
+        W_attribute = np.load(file_name_W)
+
+        return classes, labels_IO, labels_attribute, W_attribute
+
+    def tokens_batch(self, logits: np.ndarray, features_avgpool: np.ndarray) -> List[List[str]]:
+        # logits is N x 365, features_avgpool is N x 512, one list of tokens per row
+        logits = np.asarray(logits, dtype=np.float32)
+        features_avgpool = np.asarray(features_avgpool, dtype=np.float32)
+        if len(logits) == 0:
+            return []
+
+        # softmax, sorted descending
+        h_x = np.exp(logits - logits.max(axis=1, keepdims=True))
+        h_x /= h_x.sum(axis=1, keepdims=True)
+        idx = np.argsort(-h_x, axis=1, kind='stable')[:, :10]
+        probs = np.take_along_axis(h_x, idx, axis=1)
+
+        # vote for the indoor or outdoor
+        io_image = np.mean(self.labels_IO[idx], axis=1)
+
+        # top 9 scene attributes, best first
+        responses_attribute = features_avgpool.dot(self.W_attribute.T)
+        idx_a = np.argsort(responses_attribute, axis=1)[:, -1:-10:-1]
+
+        result = []
+        for n in range(len(logits)):
+            tokens = ['indoor' if io_image[n] < 0.5 else 'outdoor']
+
+            # output the prediction of scene category
+            for i in range(0, 5):
+                if probs[n, i] > self.category_threshold:
+                    tokens.append(self.classes[idx[n, i]])
+
+            # output the scene attributes
+            for i in idx_a[n]:
+                if self.labels_attribute[i] in self.attributes:
+                    tokens.append(self.labels_attribute[i])
+
+            split_tokens = []
+            for token in tokens:
+                for t in re.split('[, /_-]+', token):
+                    split_tokens.append(t)
+            # first seen order rather than set order, which changes from process to process
+            result.append(list(dict.fromkeys(split_tokens)))
+        return result
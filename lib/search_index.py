@@ -0,0 +1,90 @@
+import os
+import json
+import hashlib
+import numpy as np
+from typing import Dict, List, Iterable, Any
+from lib.metadata_csv import MetadataRow, format_row
+from lib.gallery_export import rows_version, write_file
+
+# token -> photo ids, where a photo id is the row number in photos.csv (and so also manifest offset + row in its
+# year shard). postings are delta + varint encoded into one .bin per token prefix, search-index.json says
+# where each token's postings are, and how many photos have it so autocomplete can rank by popularity
+INDEX_FILENAME = 'search-index.json'
+SHARD_PREFIX = 'search-'
+
+
+def token_prefix(token: str) -> str:
+    c = token[:1].lower()
+    return c if c.isascii() and c.isalnum() else '_'
+
+
+def encode_postings(ids: np.ndarray) -> bytes:
+    # little endian base 128 varints of the gaps between sorted ids
+    deltas = np.diff(np.asarray(ids, dtype=np.uint64), prepend=np.uint64(0))
+    lengths = np.ones(len(deltas), dtype=np.int64)
+    for k in range(1, 10):
+        lengths += deltas >= (np.uint64(1) << np.uint64(7 * k))
+    starts = np.cumsum(lengths) - lengths
+    out = np.zeros(int(lengths.sum()), dtype=np.uint8)
+    for k in range(int(lengths.max(initial=0))):
+        mask = lengths > k
+        values = (deltas[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = np.where(lengths[mask] > k + 1, 0x80, 0).astype(np.uint64)
+        out[starts[mask] + k] = (values | more).astype(np.uint8)
+    return out.tobytes()
+
+
+def decode_postings(data: bytes) -> List[int]:
+    ids = []
+    value, shift, last = 0, 0, 0
+    for b in data:
+        value |= (b & 0x7f) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            last += value
+            ids.append(last)
+            value, shift = 0, 0
+    return ids
+
+
+def build_search_index(rows: Iterable[MetadataRow], data_directory: str) -> Dict[str, Any]:
+    # one pass over the rows, in photos.csv order
+    postings: Dict[str, List[int]] = {}
+    total = 0
+    version = rows_version()
+    for photo_id, row in enumerate(rows):
+        total += 1
+        version.update(format_row(*row).encode('utf-8'))
+        for t in set(t.rstrip() for t in row.tokens.split(';')):
+            if len(t) > 0:
+                postings.setdefault(t, []).append(photo_id)
+
+    os.makedirs(data_directory, exist_ok=True)
+    by_prefix: Dict[str, List[str]] = {}
+    for t in sorted(postings):
+        by_prefix.setdefault(token_prefix(t), []).append(t)
+
+    tokens: Dict[str, List[Any]] = {}
+    shards: Dict[str, str] = {}
+    for prefix, prefix_tokens in by_prefix.items():
+        chunks = []
+        offset = 0
+        for t in prefix_tokens:
+            encoded = encode_postings(np.array(postings[t]))
+            tokens[t] = [prefix, offset, len(encoded), len(postings[t])]
+            chunks.append(encoded)
+            offset += len(encoded)
+        data = b''.join(chunks)
+        shard = '{}{}.{}.bin'.format(SHARD_PREFIX, prefix, hashlib.blake2b(data, digest_size=6).hexdigest())
+        write_file(os.path.join(data_directory, shard), data)
+        shards[prefix] = shard
+
+    index = {'total': total, 'version': version.hexdigest(), 'shards': shards, 'tokens': tokens}
+    write_file(os.path.join(data_directory, INDEX_FILENAME), json.dumps(index, separators=(',', ':')).encode('utf-8'))
+
+    for f in os.listdir(data_directory):
+        if f.startswith(SHARD_PREFIX) and f.endswith('.bin') and f not in shards.values():
+            os.remove(os.path.join(data_directory, f))
+
+    return index
@@ -0,0 +1,124 @@
+import os
+import shutil
+import hashlib
+import logging
+from typing import List, NamedTuple
+from lib.metadata_csv import MetadataRow, read_rows
+from lib.metadata_store import MetadataStore, PhotoRecord
+from lib.embedding_store import EmbeddingStore
+
+# --shard i/N splits source_dir between N machines (or runs) sharing a filesystem, with no coordination: each
+# photo belongs to the shard its filename hashes to. a shard writes its thumbnails straight into thumbnail_dir
+# (shards never write the same file) and its metadata into its own store and fragment of photos.csv,
+# photos.shard-i-of-N.csv. --merge N combines the fragments once every shard has finished: the csv fragments into
+# photos.csv, the shard stores into photos.db and embeddings/shard-i-of-N into embeddings, and then deletes them.
+# a failed shard is simply run again, it picks up where it stopped and its fragment is only replaced when it
+# completes (write_rows renames the finished file into place)
+
+# rows of vectors copied at a time when merging embeddings
+EMBEDDING_CHUNK = 4096
+
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+    def __str__(self) -> str:
+        return 'shard-{}-of-{}'.format(self.index, self.count)
+
+
+def parse_shard(value: str) -> Shard:
+    # 'i/N' with i from 0 to N - 1
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ValueError('{} is not i/N'.format(value))
+    if count < 1 or index < 0 or index >= count:
+        raise ValueError('{} is not a shard from 0/N to N-1/N'.format(value))
+    return Shard(index, count)
+
+
+def shard_of(filename: str, count: int) -> int:
+    # stable across machines, runs and python versions (unlike hash())
+    digest = hashlib.blake2b(filename.encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % count
+
+
+def in_shard(filename: str, shard: Shard) -> bool:
+    return shard_of(filename, shard.count) == shard.index
+
+
+def fragment_filename(filename: str, shard: Shard) -> str:
+    # photos.csv to photos.shard-i-of-N.csv, photos.db to photos.shard-i-of-N.db
+    root, extension = os.path.splitext(filename)
+    return '{}.{}{}'.format(root, shard, extension)
+
+
+def merge_fragments(csv_file: str, count: int) -> List[MetadataRow]:
+    # the rows of every fragment of csv_file, newest first. photos with the same date are ordered by filename,
+    # the order a run over the whole source_dir processes (and so stores) them in
+    fragments = [fragment_filename(csv_file, Shard(i, count)) for i in range(count)]
+    missing = [str(Shard(i, count)) for i, f in enumerate(fragments) if not os.path.exists(f)]
+    if len(missing) > 0:
+        raise ValueError('no fragment for {}, run those shards first'.format(', '.join(missing)))
+
+    rows = []
+    for f in fragments:
+        fragment_rows = list(read_rows(f))
+        logging.info('{}: {} photos'.format(f, len(fragment_rows)))
+        rows.extend(fragment_rows)
+    rows.sort(key=lambda row: row.filename)
+    rows.sort(key=lambda row: row.created_date, reverse=True)
+    return rows
+
+
+def merge_stores(rows: List[MetadataRow], store_file: str, embeddings_directory: str, count: int) -> None:
+    # the shard stores and embeddings into the main ones, so the next run has every photo's size, mtime and
+    # content hash, and --retokenize every photo's vectors. rows are the merged fragments, photos that aren't in
+    # any of them were deleted while the shards ran
+    store = MetadataStore(store_file)
+    records = []
+    for i in range(count):
+        shard_store_file = fragment_filename(store_file, Shard(i, count))
+        if os.path.exists(shard_store_file):
+            shard_store = MetadataStore(shard_store_file)
+            records.extend(shard_store.records())
+            shard_store.close()
+    # new photos in filename order, the order merge_fragments gives photos with the same date
+    for filename, record in sorted(records, key=lambda r: r[0]):
+        store.put(filename, record)
+    merged = set(filename for filename, _ in records)
+    # fragment rows without a shard store, only matched by filename from now on like an imported photos.csv
+    for row in rows:
+        if row.filename not in merged:
+            store.put(row.filename, PhotoRecord(-1, -1.0, '', row.aspect_ratio, row.created_date, row.tokens, ''))
+    filenames = set(row.filename for row in rows)
+    for filename in list(store.filenames()):
+        if filename not in filenames:
+            store.remove(filename)
+    store.commit()
+    store.close()
+
+    embeddings = EmbeddingStore(embeddings_directory)
+    for i in range(count):
+        shard_directory = os.path.join(embeddings_directory, str(Shard(i, count)))
+        if not os.path.isdir(shard_directory):
+            continue
+        shard_embeddings = EmbeddingStore(shard_directory)
+        hashes = sorted(shard_embeddings.rows, key=lambda h: shard_embeddings.rows[h])
+        for start in range(0, len(hashes), EMBEDDING_CHUNK):
+            chunk = hashes[start:start + EMBEDDING_CHUNK]
+            logits, features = shard_embeddings.get_many(chunk)
+            embeddings.append([(h, shard_embeddings.filenames[h]) for h in chunk], logits, features)
+    logging.info('merged {} shard stores into {} and {}'.format(count, store_file, embeddings_directory))
+
+
+def remove_fragments(csv_file: str, store_file: str, embeddings_directory: str, count: int) -> None:
+    for i in range(count):
+        shard = Shard(i, count)
+        shard_store_file = fragment_filename(store_file, shard)
+        for f in [fragment_filename(csv_file, shard), shard_store_file, shard_store_file + '-wal',
+                  shard_store_file + '-shm']:
+            if os.path.exists(f):
+                os.remove(f)
+        shutil.rmtree(os.path.join(embeddings_directory, str(shard)), ignore_errors=True)
@@ -0,0 +1,117 @@
+import os
+import io
+import json
+from typing import Callable, Dict, List, NamedTuple, Optional, Any
+from PIL import Image
+from lib.image_decode import fit_size
+from lib.gallery_export import write_file
+
+try:
+    # registers AVIF with Pillow versions that don't have it built in
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# thumbnail/<size>/<filename>.<ext>, one directory per size (the longest side in pixels) and one file per format.
+# thumbnail/<filename> is still the 640 pixel thumbnail in the original format, for older frontends and browsers.
+# thumbnail/pyramid.json tells the frontend which sizes and formats exist
+DEFAULT_SIZES = [100, 250, 640, 1600]
+DEFAULT_FORMATS = ['webp']
+LEGACY_SIZE = 640
+PYRAMID_FILENAME = 'pyramid.json'
+# the decode for a pyramid only has to cover its largest size, with no gap to spare: that level is the only one
+# resized from the decode, every smaller one is resized from the level above it. at the default 1600 a 2x gap
+# asks for 3200 pixels, and a 24MP JPEG would not be DCT scaled at all
+PYRAMID_REDUCING_GAP = 1.0
+
+
+class ThumbnailFormat(NamedTuple):
+    pil_format: str
+    extension: str
+    options: Dict[str, Any]
+
+
+FORMATS = {
+    'jpeg': ThumbnailFormat('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ThumbnailFormat('WEBP', 'webp', {'quality': 78, 'method': 4}),
+    'avif': ThumbnailFormat('AVIF', 'avif', {'quality': 55, 'speed': 6}),
+}
+
+
+class ThumbnailPyramid(NamedTuple):
+    sizes: List[int]
+    formats: List[str]
+
+    @property
+    def largest(self) -> int:
+        return max(self.sizes + [LEGACY_SIZE])
+
+
+def supported_formats() -> List[str]:
+    Image.init()
+    return [name for name, f in FORMATS.items() if f.pil_format in Image.SAVE]
+
+
+def thumbnail_filename(thumbnail_directory: str, size: int, filename: str, format_name: str) -> str:
+    return os.path.join(thumbnail_directory, str(size), '{}.{}'.format(filename, FORMATS[format_name].extension))
+
+
+def pyramid_filenames(thumbnail_directory: str, filename: str, pyramid: ThumbnailPyramid) -> List[str]:
+    # every thumbnail save_pyramid writes for filename
+    return [os.path.join(thumbnail_directory, filename)] + \
+        [thumbnail_filename(thumbnail_directory, size, filename, format_name)
+         for size in pyramid.sizes for format_name in pyramid.formats]
+
+
+def prepare_pyramid(thumbnail_directory: str, pyramid: ThumbnailPyramid) -> None:
+    for size in pyramid.sizes:
+        os.makedirs(os.path.join(thumbnail_directory, str(size)), exist_ok=True)
+    with open(os.path.join(thumbnail_directory, PYRAMID_FILENAME), 'w') as f:
+        json.dump({'sizes': sorted(pyramid.sizes), 'formats': pyramid.formats, 'legacy': LEGACY_SIZE}, f)
+
+
+def encodable(im: Image, format_name: str) -> Image:
+    if format_name == 'jpeg' and im.mode not in ('RGB', 'L'):
+        return im.convert('RGB')
+    if im.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        return im.convert('RGBA' if 'transparency' in im.info or im.mode in ('P', 'PA') else 'RGB')
+    return im
+
+
+def downscale(im: Image, size: int) -> Image:
+    # a new image that fits in size x size, or im itself when it already does
+    target = fit_size(im.size, (size, size))
+    if target == im.size:
+        return im
+    return im.resize(target, Image.LANCZOS)
+
+
+def encode(im: Image, pil_format: Optional[str], **options) -> bytes:
+    buffer = io.BytesIO()
+    im.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+def save_pyramid(im: Image,
+                 thumbnail_directory: str,
+                 filename: str,
+                 pyramid: ThumbnailPyramid,
+                 legacy_format: Optional[str],
+                 write: Callable[[str, bytes], None] = write_file) -> Image:
+    # im is the decoded, rotated image. every level is resized from the level above it rather than from im,
+    # so each resize only works on a few times its output size. thumbnails are encoded here and handed to
+    # write(filename, data), which by default writes them to a temporary file that is renamed into place.
+    # returns the LEGACY_SIZE level
+    legacy = im
+    level = im
+    for size in sorted(set(pyramid.sizes + [LEGACY_SIZE]), reverse=True):
+        level = downscale(level, size)
+        if size in pyramid.sizes:
+            for format_name in pyramid.formats:
+                f = FORMATS[format_name]
+                write(thumbnail_filename(thumbnail_directory, size, filename, format_name),
+                      encode(encodable(level, format_name), f.pil_format, **f.options))
+        if size == LEGACY_SIZE:
+            legacy = level
+            write(os.path.join(thumbnail_directory, filename), encode(level, legacy_format))
+    return legacy
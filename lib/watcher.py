@@ -0,0 +1,62 @@
+import time
+import logging
+from typing import Dict, Optional, Tuple
+from lib.reconcile import scan_files
+
+try:
+    # linux only, without it the directory is polled
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+class DirectoryWatcher():
+    # tells when files in a directory were added, replaced or removed: inotify when inotify_simple is installed,
+    # otherwise by comparing a scandir of the directory every poll_interval seconds
+    def __init__(self, directory: str, poll_interval: float = 5.0):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.inotify = None
+        self.snapshot: Optional[Dict[str, Tuple[int, float]]] = None
+
+        if inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+                flags = inotify_simple.flags
+                # only once a file is completely written or moved in, not while it's being copied
+                self.inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM |
+                                       flags.DELETE)
+            except OSError as ex:
+                logging.warning('unable to watch {} with inotify, polling it instead: {}'.format(directory, ex))
+                self.inotify = None
+        if self.inotify is None:
+            self.snapshot = scan_files(directory)
+
+    def changed(self, timeout: float) -> bool:
+        # whether anything changed within timeout seconds
+        if self.inotify is not None:
+            return len(self.inotify.read(timeout=int(timeout * 1000))) > 0
+
+        deadline = time.monotonic() + timeout
+        while True:
+            current = scan_files(self.directory)
+            if current != self.snapshot:
+                self.snapshot = current
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def wait(self, debounce: float, max_delay: float) -> None:
+        # blocks until something changes, and then until nothing has changed for debounce seconds, so a burst of
+        # new files is handled as one batch. a steady trickle of files is still handled every max_delay seconds
+        while not self.changed(3600):
+            pass
+        start = time.monotonic()
+        while time.monotonic() - start < max_delay and self.changed(debounce):
+            pass
+
+    def close(self) -> None:
+        if self.inotify is not None:
+            self.inotify.close()
@@ -1,7 +1,7 @@
 #!/bin/bash
 if [ $# -eq 0 ]
   then
-    echo "sync_aws.sh s3bucketname img-directory thumbnail-directory metadata-file.csv search-dictionary.csv"
+    echo "sync_aws.sh s3bucketname img-directory thumbnail-directory metadata-file.csv search-dictionary.csv [data-directory]"
     exit 1
 fi
 
@@ -10,15 +10,35 @@ echo "img-directory $2"
 echo "thumbnail-directory $3"
 echo "metadata-file $4"
 echo "search-dictionary $5"
+echo "data-directory $6"
 
 # sync with AWS
 echo "Syncing with AWS"
 aws s3 sync --sse "AES256" --follow-symlinks $2 s3://$1/img/
-aws s3 sync --sse "AES256" --follow-symlinks $3 s3://$1/thumbnail/
+aws s3 sync --sse "AES256" --follow-symlinks --exclude "*.avif" --exclude "*.cr2" --exclude "*.CR2" $3 s3://$1/thumbnail/
+# the cli doesn't know the avif mime type
+aws s3 sync --sse "AES256" --follow-symlinks --exclude "*" --include "*.avif" --content-type "image/avif" $3 s3://$1/thumbnail/
+# thumbnails of raw files keep the raw file's name but are JPEGs
+aws s3 sync --sse "AES256" --follow-symlinks --exclude "*" --include "*.cr2" --include "*.CR2" --content-type "image/jpeg" $3 s3://$1/thumbnail/
 aws s3 sync --sse "AES256" --follow-symlinks ../js s3://$1/js/
 aws s3 sync --sse "AES256" --follow-symlinks ../css s3://$1/css/
 aws s3 cp --sse "AES256" ../index.html s3://$1/index.html
 aws s3 cp --sse "AES256" $4 s3://$1/photos.csv
 aws s3 cp --sse "AES256" $5 s3://$1/search-tokens.csv
 
-
+if [ -n "$6" ]; then
+  # shards have a content hash in their name, upload the gzipped copy under the plain name and cache it forever
+  for f in $6/photos-*.csv.gz; do
+    aws s3 cp --sse "AES256" --content-encoding gzip --content-type "text/csv" \
+      --cache-control "public, max-age=31536000, immutable" $f s3://$1/data/$(basename $f .gz)
+  done
+  for f in $6/search-*.bin; do
+    [ -e "$f" ] || continue
+    aws s3 cp --sse "AES256" --content-type "application/octet-stream" \
+      --cache-control "public, max-age=31536000, immutable" $f s3://$1/data/$(basename $f)
+  done
+  aws s3 cp --sse "AES256" --cache-control "no-cache" $6/manifest.json s3://$1/data/manifest.json
+  if [ -e "$6/search-index.json" ]; then
+    aws s3 cp --sse "AES256" --cache-control "no-cache" $6/search-index.json s3://$1/data/search-index.json
+  fi
+fi
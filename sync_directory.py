@@ -1,15 +1,49 @@
 import sys
 import os
+import hashlib
+import sqlite3
 import click
-from shutil import copy2
-from typing import List, Callable, Dict, Optional, Tuple
+from lib.copy_engine import CopyJob, CopyJournal, run_copies
+from typing import List, Dict, Optional, Tuple
+
+# bytes hashed from the start and end of a file before we pay for a full hash
+PARTIAL_HASH_SIZE = 64 * 1024
+
 
 class FileDesc():
-    def __init__(self, root: str, file_name: str):
+    def __init__(self, root: str, file_name: str, filesize: int = 0, mtime: float = 0.0):
         self.root = root
         self.filename = file_name
-        self.filesize = 0
+        self.filesize = filesize
+        self.mtime = mtime
         self.full = root + '/' + file_name
+        # filled in lazily, only for files whose size collides with another file
+        self.partial_hash: Optional[str] = None
+        self.full_hash: Optional[str] = None
+
+    def get_partial_hash(self) -> str:
+        if self.partial_hash is None:
+            h = hashlib.blake2b(digest_size=16)
+            with open(self.full, 'rb') as f:
+                h.update(f.read(PARTIAL_HASH_SIZE))
+                if self.filesize > 2 * PARTIAL_HASH_SIZE:
+                    f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+                    h.update(f.read(PARTIAL_HASH_SIZE))
+            self.partial_hash = h.hexdigest()
+        return self.partial_hash
+
+    def get_full_hash(self) -> str:
+        if self.full_hash is None:
+            if self.filesize <= 2 * PARTIAL_HASH_SIZE:
+                # the partial hash already covered the whole file
+                self.full_hash = self.get_partial_hash()
+            else:
+                h = hashlib.blake2b(digest_size=16)
+                with open(self.full, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        h.update(chunk)
+                self.full_hash = h.hexdigest()
+        return self.full_hash
 
     def __str__(self):
         return '{} {}'.format(self.filename, self.root)
@@ -19,87 +53,209 @@ class FileDesc():
 
 
 def recursive_full_path(directory: str) -> List[FileDesc]:
+    # one scandir pass, the size and mtime come from the directory entries
     ret: List[FileDesc] = []
+    stack = [os.path.abspath(directory)]
 
-    for root, dirs, files in os.walk(os.path.abspath(directory)):
-        for f in files:
-            ret.append(FileDesc(root, f))
+    while stack:
+        root = stack.pop()
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        ret.append(FileDesc(root, entry.name, stat.st_size, stat.st_mtime))
+        except OSError as e:
+            print('unable to scan {}: {}'.format(root, e))
     return ret
 
 
-def comparison(source_list: List[FileDesc],
-               destination_list: List[FileDesc],
-               func: Callable[[FileDesc, Dict[str, FileDesc]], bool]) -> List[FileDesc]:
-    destination = {}
-    return_list = []
-
-    for d in destination_list:
-        destination[d.filename] = d
+class DestinationManifest():
+    # (name, size, mtime, hashes) of every file under the destination, plus the mtime of every directory.
+    # a directory whose mtime hasn't moved is trusted without listing it, so an import only pays for one
+    # stat per destination directory. only sync_directory.py is expected to write into the destination,
+    # anything else that edits files in place needs a --verify run
+    def __init__(self, manifest_filename: str):
+        self.connection = sqlite3.connect(manifest_filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS directories ('
+                                'path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'directory TEXT, name TEXT, size INTEGER, mtime REAL, '
+                                'partial_hash TEXT, full_hash TEXT, PRIMARY KEY (directory, name))')
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def load_files(self, directory: str) -> List[FileDesc]:
+        ret = []
+        for name, size, mtime, partial_hash, full_hash in self.connection.execute(
+                'SELECT name, size, mtime, partial_hash, full_hash FROM files WHERE directory = ?', (directory,)):
+            f = FileDesc(directory, name, size, mtime)
+            f.partial_hash, f.full_hash = partial_hash, full_hash
+            ret.append(f)
+        return ret
+
+    def insert_file(self, f: FileDesc) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO files (directory, name, size, mtime, partial_hash, full_hash) '
+                                'VALUES (?, ?, ?, ?, ?, ?)',
+                                (f.root, f.filename, f.filesize, f.mtime, f.partial_hash, f.full_hash))
+
+    def update_directory(self, directory: str, mtime: int) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO directories (path, parent, mtime) VALUES (?, ?, ?)',
+                                (directory, os.path.dirname(directory), mtime))
+
+    def scan(self, directory: str, verify: bool = False) -> List[FileDesc]:
+        # the destination as FileDescs, rescanning only directories that changed since the last run
+        # (or every directory when verifying). returns the files, changes are written to the manifest
+        root = os.path.abspath(directory)
+        known = dict(self.connection.execute('SELECT path, mtime FROM directories'))
+        ret: List[FileDesc] = []
+        seen = set()
+        added, removed, changed = 0, 0, 0
+        stack = [root]
+
+        while stack:
+            d = stack.pop()
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except OSError as e:
+                print('unable to scan {}: {}'.format(d, e))
+                continue
+            seen.add(d)
+
+            if not verify and known.get(d) == mtime:
+                ret.extend(self.load_files(d))
+                stack.extend(row[0] for row in self.connection.execute(
+                    'SELECT path FROM directories WHERE parent = ?', (d,)))
+                continue
+
+            old = {f.filename: f for f in self.load_files(d)}
+            files = []
+            with os.scandir(d) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        f = FileDesc(d, entry.name, stat.st_size, stat.st_mtime)
+                        previous = old.pop(entry.name, None)
+                        if previous is None:
+                            added += 1
+                        elif previous.filesize == f.filesize and previous.mtime == f.mtime:
+                            f.partial_hash, f.full_hash = previous.partial_hash, previous.full_hash
+                        else:
+                            changed += 1
+                        files.append(f)
+            removed += len(old)
+
+            self.connection.execute('DELETE FROM files WHERE directory = ?', (d,))
+            for f in files:
+                self.insert_file(f)
+            self.update_directory(d, mtime)
+            ret.extend(files)
+
+        # directories that are gone, only under this root
+        for path in known:
+            if path not in seen and (path == root or path.startswith(root + os.sep)):
+                removed += self.connection.execute('SELECT COUNT(*) FROM files WHERE directory = ?',
+                                                   (path,)).fetchone()[0]
+                self.connection.execute('DELETE FROM files WHERE directory = ?', (path,))
+                self.connection.execute('DELETE FROM directories WHERE path = ?', (path,))
+        self.connection.commit()
+
+        if verify:
+            print('manifest verified: {} files, {} added, {} removed, {} changed'
+                  .format(len(ret), added, removed, changed))
+        return ret
+
+    def save_hashes(self, files: List[FileDesc]) -> None:
+        # keeps hashes computed while matching, so the next import doesn't hash the same files again
+        for f in files:
+            if f.partial_hash is not None or f.full_hash is not None:
+                self.connection.execute('UPDATE files SET partial_hash = ?, full_hash = ? '
+                                        'WHERE directory = ? AND name = ? AND size = ? AND mtime = ?',
+                                        (f.partial_hash, f.full_hash, f.root, f.filename, f.filesize, f.mtime))
+        self.connection.commit()
+
+    def add_copy(self, f: FileDesc) -> None:
+        # records a file that was just copied into the destination, in its own transaction
+        stat = os.stat(f.full)
+        f.filesize, f.mtime = stat.st_size, stat.st_mtime
+        self.insert_file(f)
+        self.update_directory(f.root, os.stat(f.root).st_mtime_ns)
+        self.connection.commit()
+
+
+class ContentIndex():
+    # finds files with the same content: size first, then partial hash, then full hash
+    def __init__(self, files: List[FileDesc]):
+        self.by_size: Dict[int, List[FileDesc]] = {}
+        self.by_name: Dict[str, FileDesc] = {}
+        for f in files:
+            self.add(f)
+
+    def add(self, f: FileDesc) -> None:
+        self.by_size.setdefault(f.filesize, []).append(f)
+        self.by_name[f.filename] = f
+
+    def find(self, f: FileDesc) -> Optional[FileDesc]:
+        candidates = [c for c in self.by_size.get(f.filesize, []) if c.full != f.full]
+        if len(candidates) == 0:
+            return None
+        candidates = [c for c in candidates if c.get_partial_hash() == f.get_partial_hash()]
+        for c in candidates:
+            if c.get_full_hash() == f.get_full_hash():
+                return c
+        return None
+
+
+def unique_filename(filename: str, taken: Dict[str, FileDesc]) -> str:
+    # photo.jpg -> photo (1).jpg, photo (2).jpg, ...
+    if '.' in filename:
+        stem, extension = filename[:filename.index('.')], filename[filename.index('.'):]
+    else:
+        stem, extension = filename, ''
+    n = 1
+    while '{} ({}){}'.format(stem, n, extension) in taken:
+        n += 1
+    return '{} ({}){}'.format(stem, n, extension)
+
+
+def plan_copies(source_list: List[FileDesc],
+                destination_list: List[FileDesc]) -> Tuple[List[Tuple[FileDesc, str]], List[Tuple[FileDesc, FileDesc]]]:
+    # returns the (source, destination filename) pairs to copy and the (source, existing copy) pairs to skip.
+    # files already in the destination (or earlier in the source) under any name are skipped, a different file
+    # with a name that is already taken is copied under a new ' (n)' name
+    index = ContentIndex(destination_list)
+    copies: List[Tuple[FileDesc, str]] = []
+    skipped: List[Tuple[FileDesc, FileDesc]] = []
 
     for source in source_list:
-        ret = func(source, destination)
-        if ret:
-            return_list.append(source)
-
-    return return_list
-
-
-def directory_comparison(source_directory: str,
-                         dest_directory: str,
-                         func: Callable[[FileDesc, Dict[str, FileDesc]], bool]) -> List[FileDesc]:
-    source_list = recursive_full_path(source_directory)
-    destination_list = recursive_full_path(dest_directory)
-
-    return comparison(source_list,
-                      destination_list,
-                      func)
-
-
-def get_missing_files(source_directory: str, dest_directory: str) -> List[FileDesc]:
-    return directory_comparison(source_directory,
-                                dest_directory,
-                                lambda source_f, dest: source_f.filename not in dest)
-
-
-def get_duplicate_files(source_directory: str, dest_directory: str) -> List[FileDesc]:
-    return directory_comparison(source_directory,
-                                dest_directory,
-                                lambda source_f, dest: source_f.filename in dest)
-
-
-def get_duplicate_different_size(source_directory: str, dest_directory: str) -> List[FileDesc]:
-    duplicates = get_duplicate_files(source_directory, dest_directory)
-
-    different_dup = []
-    for dup in duplicates:
-        try:
-            source_size = os.path.getsize(dup.root + '/' + dup.filename)
-            dest_size = os.path.getsize(dest_directory + '/' + dup.filename)
-            if source_size != dest_size:
-                different_dup.append(dup)
-        except OSError as e:
+        existing = index.find(source)
+        if existing is not None:
+            skipped.append((source, existing))
             continue
 
-    return different_dup
+        filename = source.filename
+        if filename in index.by_name:
+            filename = unique_filename(filename, index.by_name)
+        copies.append((source, filename))
 
+        planned = FileDesc(source.root, filename, source.filesize, source.mtime)
+        planned.full = source.full
+        planned.partial_hash, planned.full_hash = source.partial_hash, source.full_hash
+        index.add(planned)
 
-def get_duplicate_same_size(source_directory: str, dest_directory: str) -> List[FileDesc]:
-    duplicates = get_duplicate_files(source_directory, dest_directory)
+    return (copies, skipped)
 
-    exact_dup = []
-    for dup in duplicates:
-        try:
-            source_size = os.path.getsize(dup.root + '/' + dup.filename)
-            dest_size = os.path.getsize(dest_directory + '/' + dup.filename)
-            if source_size == dest_size:
-                exact_dup.append(dup)
-        except OSError as e:
-            continue
 
-    return exact_dup
-
-
-def copy_source_recursive_to_destination(source_directory: str, dest_directory: str, test: bool = False):
+def copy_source_recursive_to_destination(source_directory: str, dest_directory: str, test: bool = False,
+                                         manifest_filename: str = 'sync_manifest.db',
+                                         journal_filename: str = 'sync_directory.journal',
+                                         threads: int = 4):
     extensions = ['.jpg', '.png', '.jpeg', '.gif', '.avi', '.mov', '.mpg', '.mp4', '.cr2']
 
     def is_extension(f: FileDesc):
@@ -110,38 +266,70 @@ def copy_source_recursive_to_destination(source_directory: str, dest_directory:
         return False
 
     logfile = open('sync_directory.log', 'a')
-
-    # copy missing files first
-    missing_files = get_missing_files(source_directory, dest_directory)
-    missing_files = list(filter(is_extension, missing_files))
-    for f in missing_files:
-        print('cp {} to {}'.format(f.full, dest_directory))
-        if not test:
-            copy2(f.full, dest_directory)
-            logfile.write('{},{}\n'.format(f.full, dest_directory))
-
-    dupes_different_size = get_duplicate_different_size(source_directory, dest_directory)
-    dupes_different_size = list(filter(is_extension, dupes_different_size))
-    for f in dupes_different_size:
-        diff_filename = f.filename[:f.filename.index('.')] + ' (1)' + f.filename[f.filename.index('.'):]
-        print('duplicate filename but different file size: cp {} to {}'
-              .format(f.full, dest_directory + '/' + diff_filename))
-        if not test:
-            copy2(f.full, dest_directory + '/' + diff_filename)
-            logfile.write('{},{}\n'.format(f.full, dest_directory + '/' + diff_filename))
-
-    dupes_same_size = get_duplicate_same_size(source_directory, dest_directory)
-    dupes_same_size = list(filter(is_extension, dupes_same_size))
-    for f in dupes_same_size:
-        print('skipping duplicate (same file size): {}'.format(f))
+    manifest = DestinationManifest(manifest_filename)
+    journal = CopyJournal(journal_filename)
+    dest_root = os.path.abspath(dest_directory)
+
+    source_list = list(filter(is_extension, recursive_full_path(source_directory)))
+
+    # files an interrupted run already copied don't need matching again
+    resumed = [f for f in source_list if journal.is_done(f.full, f.filesize, f.mtime)]
+    if len(resumed) > 0:
+        print('resuming, {} files were already copied'.format(len(resumed)))
+        source_list = [f for f in source_list if not journal.is_done(f.full, f.filesize, f.mtime)]
+
+    destination_list = manifest.scan(dest_directory)
+    copies, skipped = plan_copies(source_list, destination_list)
+    manifest.save_hashes(destination_list)
+
+    jobs = []
+    hashes = {}
+    for f, filename in copies:
+        if filename != f.filename:
+            print('duplicate filename but different file: cp {} to {}'
+                  .format(f.full, dest_directory + '/' + filename))
+        else:
+            print('cp {} to {}'.format(f.full, dest_directory))
+        jobs.append(CopyJob(f.full, dest_root + '/' + filename, f.filesize, f.mtime))
+        hashes[f.full] = (f.partial_hash, f.full_hash)
+
+    for f, existing in skipped:
+        print('skipping duplicate (same content as {}): {}'.format(existing.full, f))
+
+    def on_copied(job: CopyJob, method: str) -> None:
+        logfile.write('{},{}\n'.format(job.source, job.destination))
+        logfile.flush()
+        copied = FileDesc(dest_root, os.path.basename(job.destination))
+        copied.partial_hash, copied.full_hash = hashes[job.source]
+        manifest.add_copy(copied)
+
+    failures = []
+    if not test:
+        failures = run_copies(jobs, threads, journal, on_copied)
+    journal.close(finished=not test and len(failures) == 0)
+    logfile.close()
+    manifest.close()
 
 
 @click.command()
-@click.option('--source_dir', required=True, help='Source directory of images to import')
+@click.option('--source_dir', required=False, help='Source directory of images to import')
 @click.option('--destination_dir', required=True, help='Destination directory of images')
 @click.option('--test_run', is_flag=True, help='Show actions without importing files')
-def main(source_dir: str, destination_dir: str, test_run: bool):
-    copy_source_recursive_to_destination(source_dir, destination_dir, test_run)
+@click.option('--manifest', default='sync_manifest.db', help='Filename of the destination directory manifest')
+@click.option('--verify', is_flag=True, help='Reconcile the destination manifest with what is on disk')
+@click.option('--journal', default='sync_directory.journal',
+              help='Filename of the journal of finished copies, used to resume an interrupted import')
+@click.option('--threads', default=4, type=click.IntRange(min=1), help='Number of files copied at the same time')
+def main(source_dir: str, destination_dir: str, test_run: bool, manifest: str, verify: bool, journal: str,
+         threads: int):
+    if verify:
+        destination_manifest = DestinationManifest(manifest)
+        destination_manifest.scan(destination_dir, verify=True)
+        destination_manifest.close()
+    if source_dir:
+        copy_source_recursive_to_destination(source_dir, destination_dir, test_run, manifest, journal, threads)
+    elif not verify:
+        raise click.UsageError('--source_dir is required unless --verify is given')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,50 @@
+import os
+import numpy as np
+from lib.embedding_store import EmbeddingStore
+
+LOGITS_DIM = 5
+FEATURES_DIM = 3
+
+
+def vectors(seed: int, count: int) -> tuple:
+    rng = np.random.RandomState(seed)
+    return (rng.rand(count, LOGITS_DIM).astype(np.float32), rng.rand(count, FEATURES_DIM).astype(np.float32))
+
+
+def entries(prefix: str, count: int) -> list:
+    return [('{}{}'.format(prefix, i), '{}{}.jpg'.format(prefix, i)) for i in range(count)]
+
+
+def check(store: EmbeddingStore, prefix: str, logits: np.ndarray, features: np.ndarray) -> None:
+    stored_logits, stored_features = store.get_many([h for h, _ in entries(prefix, len(logits))])
+    np.testing.assert_array_equal(stored_logits, logits.astype(np.float16).astype(np.float32))
+    np.testing.assert_array_equal(stored_features, features.astype(np.float16).astype(np.float32))
+
+
+def test_append_and_reopen(tmp_path):
+    logits, features = vectors(0, 4)
+    EmbeddingStore(str(tmp_path)).append(entries('a', 4), logits, features)
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 4
+    check(store, 'a', logits, features)
+
+
+def test_append_after_interrupted_write(tmp_path):
+    logits, features = vectors(0, 4)
+    EmbeddingStore(str(tmp_path)).append(entries('a', 4), logits, features)
+    # an append that was killed halfway: part of a row in vectors.f16 and part of a line in index.csv
+    with open(os.path.join(str(tmp_path), 'vectors.f16'), 'ab') as f:
+        f.write(b'\x00' * 7)
+    with open(os.path.join(str(tmp_path), 'index.csv'), 'a') as f:
+        f.write('4,b0')
+
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 4
+    more_logits, more_features = vectors(1, 3)
+    store.append(entries('b', 3), more_logits, more_features)
+
+    store = EmbeddingStore(str(tmp_path))
+    assert len(store) == 7
+    assert store.row_count() == 7
+    check(store, 'a', logits, features)
+    check(store, 'b', more_logits, more_features)
@@ -0,0 +1,77 @@
+import os
+import generate_photos_gallery
+from benchmarks.corpus import CorpusSpec, generate_corpus
+from benchmarks.stub_classifier import StubClassifier
+from lib.metadata_csv import read_metadata
+from lib.metadata_store import MetadataStore
+
+
+class CountingClassifier(StubClassifier):
+    loads = 0
+    images = 0
+
+    def __init__(self, models_directory: str, num_threads: int = 0):
+        CountingClassifier.loads += 1
+        super().__init__(models_directory, num_threads)
+
+    def forward_vectors(self, images):
+        CountingClassifier.images += len(images)
+        return super().forward_vectors(images)
+
+
+def run(tmp_path) -> None:
+    generate_photos_gallery.process(str(tmp_path / 'img'), 'thumbnail', str(tmp_path / 'models'), 'photos.csv',
+                                    'photos.db', 'embeddings', 'data')
+
+
+def prepare(tmp_path, monkeypatch) -> None:
+    generate_corpus(CorpusSpec(seed=0, files=3, megapixels=[0.05], truncated_every=0, cities=100), str(tmp_path))
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.setattr(generate_photos_gallery, 'load_places_classifier', CountingClassifier)
+    CountingClassifier.loads = 0
+    CountingClassifier.images = 0
+    os.makedirs('thumbnail')
+
+
+def test_renamed_photo_is_not_classified_again(tmp_path, monkeypatch):
+    prepare(tmp_path, monkeypatch)
+    run(tmp_path)
+    assert CountingClassifier.images == 3
+    old = sorted(os.listdir('img'))[0]
+    os.rename(os.path.join('img', old), os.path.join('img', 'renamed.jpg'))
+
+    CountingClassifier.images = 0
+    run(tmp_path)
+    assert CountingClassifier.images == 0
+    store = MetadataStore('photos.db')
+    assert store.get(old) is None
+    assert store.get('renamed.jpg') is not None
+    assert len(store) == 3
+    store.close()
+    assert sorted(read_metadata('photos.csv')) == sorted(os.listdir('img'))
+
+
+def test_failed_file_is_skipped_until_it_changes(tmp_path, monkeypatch):
+    prepare(tmp_path, monkeypatch)
+    with open(os.path.join('img', 'broken.jpg'), 'wb') as f:
+        f.write(b'not a photo')
+    run(tmp_path)
+    assert CountingClassifier.loads == 1
+    assert CountingClassifier.images == 3
+
+    # nothing left to retry, the models aren't loaded
+    run(tmp_path)
+    assert CountingClassifier.loads == 1
+    with open('generate.log') as f:
+        assert f.read() == 'broken.jpg\n'
+
+    with open(os.path.join('img', 'broken.jpg'), 'wb') as f:
+        f.write(b'still not a photo')
+    run(tmp_path)
+    assert CountingClassifier.loads == 2
+
+    os.remove(os.path.join('img', 'broken.jpg'))
+    run(tmp_path)
+    store = MetadataStore('photos.db')
+    assert store.failures() == {}
+    store.close()
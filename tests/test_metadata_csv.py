@@ -0,0 +1,26 @@
+import datetime as dt
+import numpy as np
+from lib.metadata_csv import MetadataColumns, MetadataRow, read_rows, write_rows
+
+ROWS = [MetadataRow('a, "quoted" name.jpg', '1.333', dt.datetime(2021, 3, 4, 5, 6, 7), 'beach;paris;france'),
+        MetadataRow('b.jpg', '0.750', dt.datetime(2019, 1, 2, 3, 4, 5), ''),
+        MetadataRow('c.jpg', '1.500', dt.datetime(2019, 1, 1), 'beach')]
+
+
+def test_round_trip(tmp_path):
+    csv_file = str(tmp_path / 'photos.csv')
+    assert write_rows(csv_file, ROWS) == 3
+    assert list(read_rows(csv_file)) == ROWS
+
+
+def test_columns(tmp_path):
+    csv_file = str(tmp_path / 'photos.csv')
+    write_rows(csv_file, ROWS)
+    columns = MetadataColumns.read(csv_file)
+    assert len(columns) == 3
+    assert [columns.row(i) for i in range(3)] == ROWS
+    assert list(columns.years()) == [2021, 2019, 2019]
+    assert dict(zip(columns.tokens, columns.token_counts())) == {'beach': 2, 'paris': 1, 'france': 1}
+    from_rows = MetadataColumns.from_rows(ROWS)
+    np.testing.assert_array_equal(from_rows.token_ids, columns.token_ids)
+    np.testing.assert_array_equal(from_rows.created_dates, columns.created_dates)
@@ -0,0 +1,125 @@
+import io
+import struct
+import datetime as dt
+import numpy as np
+import pytest
+from PIL import Image
+from lib.raw_preview import RawFormatError, extract_preview, is_cr2, open_image
+
+CR2_SLICE = 0xc640
+
+
+def jpeg(width: int, height: int) -> bytes:
+    pixels = (np.random.RandomState(width).rand(height, width, 3) * 255).astype('uint8')
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def lossless_jpeg(size: int) -> bytes:
+    # what IFD3 holds: SOI and a lossless (SOF3) frame, bigger than the preview
+    return b'\xff\xd8\xff\xc3' + bytes(size)
+
+
+def build_cr2(endian: str = '<') -> tuple:
+    # the layout canon cameras write: IFD0 the full size preview with the EXIF and GPS IFDs, IFD1 a small JPEG,
+    # IFD2 an uncompressed RGB thumbnail, IFD3 the sensor data
+    preview = jpeg(600, 400)
+    thumbnail = jpeg(160, 120)
+    rgb = bytes(48 * 32 * 3)
+    sensor = lossless_jpeg(len(preview) * 4)
+    date = b'2019:07:14 16:20:00\x00'
+
+    def short(v):
+        return struct.pack(endian + 'H', v)
+
+    def long(v):
+        return struct.pack(endian + 'I', v)
+
+    def rational(*values):
+        return b''.join(struct.pack(endian + 'II', n, d) for n, d in values)
+
+    def ifd(entries, offset, next_offset):
+        # the IFD at offset, with values over 4 bytes right after it
+        out = short(len(entries))
+        extra = b''
+        data_offset = offset + 2 + 12 * len(entries) + 4
+        for tag, field_type, count, payload in entries:
+            if len(payload) <= 4:
+                out += struct.pack(endian + 'HHI', tag, field_type, count) + payload.ljust(4, b'\x00')
+            else:
+                out += struct.pack(endian + 'HHII', tag, field_type, count, data_offset + len(extra))
+                extra += payload
+        return out + long(next_offset) + extra
+
+    def size(entries):
+        return len(ifd(entries, 0, 0))
+
+    # offsets are worked out on a first pass with placeholders
+    placeholder = long(0)
+    ifd0_entries = [(256, 3, 1, short(5184)), (274, 3, 1, short(6)), (273, 4, 1, placeholder),
+                    (279, 4, 1, long(len(preview))), (34665, 4, 1, placeholder), (34853, 4, 1, placeholder)]
+    exif_entries = [(36867, 2, len(date), date)]
+    gps_entries = [(1, 2, 2, b'N\x00'), (2, 5, 3, rational((48, 1), (51, 1), (2964, 100))), (3, 2, 2, b'E\x00'),
+                   (4, 5, 3, rational((2, 1), (17, 1), (4020, 100)))]
+    ifd1_entries = [(513, 4, 1, placeholder), (514, 4, 1, long(len(thumbnail)))]
+    ifd2_entries = [(273, 4, 1, placeholder), (279, 4, 1, long(len(rgb)))]
+    ifd3_entries = [(259, 3, 1, short(6)), (273, 4, 1, placeholder), (279, 4, 1, long(len(sensor))),
+                    (CR2_SLICE, 3, 3, short(1) + short(2000) + short(2000))]
+
+    ifd0_offset = 16
+    exif_offset = ifd0_offset + size(ifd0_entries)
+    gps_offset = exif_offset + size(exif_entries)
+    ifd1_offset = gps_offset + size(gps_entries)
+    ifd2_offset = ifd1_offset + size(ifd1_entries)
+    ifd3_offset = ifd2_offset + size(ifd2_entries)
+    preview_offset = ifd3_offset + size(ifd3_entries)
+    thumbnail_offset = preview_offset + len(preview)
+    rgb_offset = thumbnail_offset + len(thumbnail)
+    sensor_offset = rgb_offset + len(rgb)
+
+    ifd0_entries[2] = (273, 4, 1, long(preview_offset))
+    ifd0_entries[4] = (34665, 4, 1, long(exif_offset))
+    ifd0_entries[5] = (34853, 4, 1, long(gps_offset))
+    ifd1_entries[0] = (513, 4, 1, long(thumbnail_offset))
+    ifd2_entries[0] = (273, 4, 1, long(rgb_offset))
+    ifd3_entries[1] = (273, 4, 1, long(sensor_offset))
+
+    header = (b'II*\x00' if endian == '<' else b'MM\x00*') + long(ifd0_offset) + b'CR\x02\x00' + long(ifd3_offset)
+    data = (header + ifd(ifd0_entries, ifd0_offset, ifd1_offset) + ifd(exif_entries, exif_offset, 0) +
+            ifd(gps_entries, gps_offset, 0) + ifd(ifd1_entries, ifd1_offset, ifd2_offset) +
+            ifd(ifd2_entries, ifd2_offset, ifd3_offset) + ifd(ifd3_entries, ifd3_offset, 0) +
+            preview + thumbnail + rgb + sensor)
+    assert len(data) == sensor_offset + len(sensor)
+    return (data, preview)
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_extract_preview_takes_ifd0_not_the_sensor_data(endian):
+    data, preview = build_cr2(endian)
+    assert is_cr2(data)
+    assert extract_preview(data).jpeg == preview
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_open_image(endian):
+    data, _ = build_cr2(endian)
+    im, metadata = open_image(data)
+    assert im.format == 'JPEG'
+    assert im.size == (600, 400)
+    assert metadata.created_date == dt.datetime(2019, 7, 14, 16, 20)
+    assert metadata.orientation == 6
+    assert metadata.latitude == pytest.approx(48.858233, abs=1e-6)
+    assert metadata.longitude == pytest.approx(2.2945, abs=1e-6)
+
+
+def test_plain_tiff_is_not_raw():
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8)).save(buffer, 'TIFF')
+    assert not is_cr2(buffer.getvalue())
+
+
+def test_truncated_file():
+    data, _ = build_cr2()
+    with pytest.raises(RawFormatError):
+        extract_preview(data[:200])
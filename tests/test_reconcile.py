@@ -0,0 +1,14 @@
+import os
+from lib.reconcile import find_changes
+from lib.thumbnails import DEFAULT_FORMATS, DEFAULT_SIZES, ThumbnailPyramid
+
+
+def test_copies_in_progress_are_not_photos(tmp_path):
+    source = tmp_path / 'img'
+    os.makedirs(str(source))
+    for name in ['a.jpg', '.b.jpg.part', 'c.jpg.tmp', '.DS_Store']:
+        (source / name).write_bytes(b'data')
+    changes = find_changes(str(source), str(tmp_path / 'thumbnail'), ThumbnailPyramid(DEFAULT_SIZES, DEFAULT_FORMATS),
+                           {})
+    assert changes.stale == ['a.jpg']
+    assert changes.unchanged == 0